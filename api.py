@@ -1,59 +1,627 @@
-from fastapi import FastAPI, HTTPException     # httpexception is used to raise http errors (eg: 404, 400, 500) when api fails
+from fastapi import FastAPI, HTTPException, Header, Request     # httpexception is used to raise http errors (eg: 404, 400, 500) when api fails
 import os    # to check if file exists
-from db import get_connection, initialize_database
-from main import move_file, source_dir
+from contextlib import asynccontextmanager
+from db import get_readers, initialize_database
+from catalog import get_catalog
+import catalog
+import main
+from main import move_file
 from fastapi import UploadFile, File      # UploadFile handles incoming files accessing their data; File is used to specify that the endpoint expects a file upload
-from typing import List
+from fastapi.responses import PlainTextResponse, JSONResponse, StreamingResponse, Response
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
+from pydantic import BaseModel
+import asyncio
+import glob
+import json
+import shutil
+import threading
+import uuid
+import zlib
+from datetime import datetime, timedelta
+import feed
+import jobs
+import metrics
+import profiler
+import retention
+import search
+import uploads
 
-initialize_database()    # initialize the database and create the files_table if it doesn't exist; this ensures that the database is ready to store file metadata before any API requests are processed
+try:
+    import brotli    # optional (pip install brotli): lets /files answer with br to clients that accept it; gzip is always available
+except ImportError:
+    brotli = None
+
+# server-side folders /move-batch may take files from (os.pathsep-separated, eg: "/mnt/nfs/drop:/srv/scans"); defaults to the intake folders
+BATCH_ROOTS = [os.path.realpath(root) for root in os.environ.get("FILE_SORTER_BATCH_ROOTS", "").split(os.pathsep) if root]
+MAX_BATCH_FILES = 100_000    # per request
+WATCH = os.environ.get("FILE_SORTER_SERVE_WATCH") == "1"    # `sorter.py serve --watch`: run the watcher inside the API process
+UPLOAD_WRITE_SIZE = 1024 * 1024    # bytes gathered from a chunk's body before each pwrite
+FILES_PAGE = 1000    # rows per query (and per chunk of the body) when /files streams its answer
+FEED_KEEPALIVE = 15.0    # seconds; an idle /events stream sends a comment this often so proxies don't close it
+
+# runs once when the server starts (not at import time, so importing api.py stays cheap)
+@asynccontextmanager
+async def lifespan(app):
+    main.setup()    # logging + category folders
+    initialize_database()    # initialize the database and create the files_table if it doesn't exist; this ensures that the database is ready to store file metadata before any API requests are processed
+    jobs.mark_interrupted()     # jobs a previous server process didn't get to finish
+    uploads.expire()    # resumable uploads abandoned long ago
+    get_catalog().listeners.append(feed.publish)     # every committed move goes out on /events
+    stopped = threading.Event()
+    hosted = None
+    if WATCH:   # so the watcher's moves go through this process's db writer, and therefore /events, too
+        hosted = threading.Thread(target=host_watcher, args=(stopped,), name="watcher", daemon=True)
+        hosted.start()
+    yield
+    if hosted is not None:
+        stopped.set()
+        hosted.join()
+
+
+def host_watcher(stopped):
+    import watcher      # watchdog is only loaded when the API hosts the watcher
+    watching = watcher.start()
+    try:
+        watching.supervise(stopped)
+    finally:
+        watching.stop()
+
+
+app = FastAPI(title="File Organizer API", lifespan=lifespan)    # creates fastapi application instance (we register endpoints to this app)
+
+# runs target(job) as a background job and answers with its id; 429 when too many jobs are queued already (the client should retry later)
+def start_job(kind, total, target):
+    try:
+        job = jobs.start(kind, total, target)
+    except jobs.Busy as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    return JSONResponse({"job_id": job.id, "files": total}, status_code=202)
+
+
+# main.move_batch() over `paths` as a background job
+def start_move_job(kind, paths):
+    return start_job(kind, len(paths), lambda job: main.move_batch(paths, key=f"job-{job.id}", progress=job.progress, cancelled=job.cancelled))
+
+
+# an uploaded file's name without any folder part (a client can send "../../etc/cron.d/x", or "C:\\Users\\me\\x" from a browser on
+# Windows); None if nothing usable is left or it is hidden (the sorter would skip it)
+def upload_name(filename):
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    return name if name and not name.startswith(".") else None
+
+
+# saves an uploaded file under a name of its own in the hidden staging folder of resumable uploads (uploads.UPLOAD_DIR: never over another
+# file, and the watcher leaves it alone); it is sorted from there under its real name and recorded as uploaded to source_dir, where it
+# would have been saved before. Returns (staged path, (name, source)); uploads.expire() removes staged files a crash left behind
+def save_upload(file):
+    os.makedirs(uploads.UPLOAD_DIR, exist_ok=True)
+    temp_path = os.path.join(uploads.UPLOAD_DIR, f"{uuid.uuid4().hex}{uploads.STAGED_SUFFIX}")
+    try:
+        with open(temp_path, "xb") as f:
+            shutil.copyfileobj(file.file, f)     # in chunks, not the whole upload in memory
+    except BaseException:
+        discard(temp_path)
+        raise
+    name = upload_name(file.filename)
+    return temp_path, (name, os.path.join(main.source_dir, name))
+
+
+def discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:     # sorted after all
+        pass
 
-app = FastAPI(title="File Organizer API")    # creates fastapi application instance (we register endpoints to this app)
 
 # api endpoint (URL) that handles post requests (like file uploads)
+# background=true: the files are only saved (staged, see save_upload()) before the response (a job id, see GET /jobs/{id}); sorting them happens afterwards
 @app.post("/upload-files")
-def upload_file(files: List[UploadFile] = File(...)):
+def upload_file(files: List[UploadFile] = File(...), background: bool = False):
 # List[UploadFile] = File(...): Expects multiple uploaded files, treat them as an UploadFile object, and receive it from the request using the File tool
 # UploadFile object has properties like filename, content_type, and methods like .read()
 # File(...) marks it as a required parameter   
 
-    os.makedirs(source_dir, exist_ok=True)   # create source folder (source_dir) if it doesn't exist (in case user tries to upload before running main.py for the first time, which creates the source_dir) - this prevents "No such file or directory" error when trying to save the uploaded file
-
     processed_files = []
+    rejected = [file.filename for file in files if upload_name(file.filename) is None]
+    if rejected:    # checked before anything is saved, so a bad name doesn't leave the other files of the request half-done
+        raise HTTPException(status_code=400, detail={"error": "filenames must be plain, non-hidden file names", "filenames": rejected[:20]})
+
+    if background:
+        staged = {}
+        try:
+            for file in files:
+                temp_path, upload = save_upload(file)
+                staged[temp_path] = upload
+            return start_job("upload", len(staged), lambda job: main.move_batch(list(staged), key=f"job-{job.id}", progress=job.progress,
+                                                                                cancelled=job.cancelled, staged=staged))
+        except BaseException:   # eg: 429, too many jobs: nothing will ever sort them
+            for temp_path in staged:
+                discard(temp_path)
+            raise
 
     try:
         for file in files:      # for each uploaded file through the endpoint
-            temp_path = os.path.join(source_dir, file.filename)     # create a temporary path for the uploaded file in the source_dir
-        
-            with open(temp_path, "wb") as f:
-                f.write(file.file.read())   # read the contents of the uploaded file and write it to the temp_path; we open the file in binary mode ("wb") to ensure that all types of files (text, images, pdf, etc.) are handled correctly without encoding issues
-        # file.file.read() reads the entire content of the uploaded file into memory, and f.write() writes that content to the temporary file on disk. This effectively saves the uploaded file to the source_dir 
-
-        # these above 2 steps basically save the uploaded file temporarily in the main FileSorter folder. this is done bcoz move_file() expects the file to be in the source_dir and we are uploading the file through the FastAPI endpoint (SwaggerUI), so technically the file isnt yet present in the FileSorter folder (for it to start the file sorting process). So we first save it there so move_file() can process it  
-    
-            move_file(temp_path)   # automatically moves it to the correct subfolder
-            processed_files.append(file.filename)
+            # save the uploaded file on disk first: move_file() sorts files that are on disk, and an upload through the FastAPI endpoint
+            # (SwaggerUI) isn't there yet
+            temp_path, (name, source) = save_upload(file)
+            try:
+                move_file(temp_path, name=name, outside=True, source=source)   # automatically moves it to the correct subfolder
+            except BaseException:
+                discard(temp_path)      # the client gets the error and has to send it again
+                raise
+            processed_files.append(name)
 
     except Exception as e:
+            metrics.inc("sorter_errors_total", stage="upload")
             raise HTTPException(status_code=500, detail=str(e))
 
     return {"status": "success", "processed_files": processed_files}
 
 
-# GET endpoint that returns DB rows (files from files_table)
-@app.get("/files")
-def list_files():
-    conn = get_connection()
-    cursor = conn.cursor()
+class UploadRequest(BaseModel):
+    filename: str
+    size: int       # bytes
+
+
+# Resumable upload of one (very large) file, see uploads.py:
+#   POST /uploads {"filename", "size"}      -> upload_id
+#   PUT /uploads/{id}?offset=N  <raw bytes> -> writes them at offset N (several PUTs may run in parallel, for different ranges)
+#   GET /uploads/{id}                       -> what arrived so far ("offset" to continue from, "missing" ranges)
+#   POST /uploads/{id}/complete             -> sorts the file (a rename into its destination folder), same answer as move_file()
+#   DELETE /uploads/{id}                    -> gives up and deletes what was received
+@app.post("/uploads", status_code=201)
+def create_upload(request: UploadRequest):
+    try:
+        return uploads.create(request.filename, request.size).status()
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def get_upload(upload_id):
+    upload = uploads.load(upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+
+@app.get("/uploads/{upload_id}")
+def upload_status(upload_id: str):
+    return get_upload(upload_id).status()
+
+
+# the body is streamed to disk as it arrives (pwrite at the right offset every MiB or so, never the whole chunk in memory); whatever made it
+# to disk is recorded even if the connection drops halfway, so the client only resends the rest
+@app.put("/uploads/{upload_id}")
+async def put_upload_chunk(upload_id: str, request: Request, offset: int = 0):
+    upload = await run_in_threadpool(get_upload, upload_id)
+    if offset < 0 or offset > upload.size:
+        raise HTTPException(status_code=416, detail=f"offset must be between 0 and {upload.size}")
+
+    fd = os.open(upload.data_path, os.O_WRONLY)
+    position = offset
+    buffered = bytearray()
+    try:
+        async for data in request.stream():
+            if position + len(buffered) + len(data) > upload.size:
+                raise HTTPException(status_code=413, detail=f"chunk goes past the declared size ({upload.size} bytes)")
+            buffered += data
+            if len(buffered) >= UPLOAD_WRITE_SIZE:
+                await run_in_threadpool(uploads.write_at, fd, bytes(buffered), position)
+                position += len(buffered)
+                buffered.clear()
+    finally:
+        if buffered:    # the rest of the body, or what arrived before the connection dropped
+            await run_in_threadpool(uploads.write_at, fd, bytes(buffered), position)
+            position += len(buffered)
+        if position > offset:
+            await run_in_threadpool(os.fsync, fd)     # only what is durably on disk is reported as received
+        os.close(fd)
+        if position > offset:
+            upload = await run_in_threadpool(uploads.add_range, upload_id, offset, position)
+    return upload.status()
+
+
+@app.post("/uploads/{upload_id}/complete")
+def complete_upload(upload_id: str):
+    get_upload(upload_id)
+    try:
+        return uploads.complete(upload_id)
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        metrics.inc("sorter_errors_total", stage="upload")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.delete("/uploads/{upload_id}", status_code=204)
+def abort_upload(upload_id: str):
+    get_upload(upload_id)
+    uploads.abort(upload_id)
+
+
+class BatchMoveRequest(BaseModel):
+    paths: List[str] = []           # server-side file paths
+    glob: Optional[str] = None      # and/or a pattern (`**` matches subfolders), eg: "/mnt/nfs/drop/*.pdf"
+
+
+def allowed(path, roots):
+    return any(path == root or path.startswith(root + os.sep) for root in roots)
+
+
+# the real paths (symlinks and ".." resolved) of the given files that are under an allowlisted root, and the ones that aren't
+def resolve_paths(candidates, roots):
+    paths, rejected = [], []
+    for candidate in dict.fromkeys(candidates):     # drops duplicates, keeps the order
+        path = os.path.realpath(candidate)
+        if not allowed(path, roots):
+            rejected.append(candidate)
+        elif os.path.isfile(path) and not os.path.basename(path).startswith("."):
+            paths.append(path)
+    return paths, rejected
+
+
+# the part of a glob before its first wildcard, eg: /mnt/nfs/drop for /mnt/nfs/drop/**/*.pdf
+def glob_base(pattern):
+    parts = []
+    for part in pattern.split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or "."
+
+
+# POST endpoint that sorts files which are already on the server's disk (no upload): they are moved with a rename on the same file system,
+# through the shared workers, and recorded in ONE database transaction; returns a job id right away (see GET /jobs/{id})
+# The listed paths are checked before answering; a glob only has its fixed base folder checked up front and is expanded by the job (a pattern
+# matching 100,000 files would otherwise hold the request for seconds), where matches escaping the roots through symlinks are skipped
+@app.post("/move-batch", status_code=202)
+def move_batch(request: BatchMoveRequest):
+    roots = BATCH_ROOTS or [os.path.realpath(intake.path) for intake in main.intakes()]
+    if len(request.paths) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_FILES} files per batch")
+    paths, rejected = resolve_paths(request.paths, roots)
+    if request.glob and not allowed(os.path.realpath(glob_base(request.glob)), roots):
+        rejected.append(request.glob)
+    if rejected:
+        raise HTTPException(status_code=403, detail={"error": "Paths outside the allowed roots", "roots": roots, "paths": rejected[:20]})
+    if not paths and not request.glob:
+        raise HTTPException(status_code=400, detail="No files matched")
+    if not request.glob:
+        return start_move_job("move-batch", paths)
+
+    def expand_and_move(job):
+        matched, _ = resolve_paths(paths + glob.glob(request.glob, recursive=True), roots)
+        if len(matched) > MAX_BATCH_FILES:
+            raise ValueError(f"{len(matched)} files matched, at most {MAX_BATCH_FILES} per batch")
+        job.total = len(matched)
+        main.move_batch(matched, key=f"job-{job.id}", progress=job.progress, cancelled=job.cancelled)
 
-    cursor.execute("SELECT * FROM files_table")
+    return start_job("move-batch", None, expand_and_move)
 
-    rows = cursor.fetchall()
 
-    conn.close()
-    return {"files": rows}
+# POST endpoint that sorts whatever is sitting in the intake folders right now (eg: files dropped while nothing was watching); returns a job id
+# right away: the intakes are listed by the job (a folder of 100,000 files would otherwise hold the request, like a glob for /move-batch)
+@app.post("/rescan", status_code=202)
+def rescan():
+    def list_and_move(job):
+        paths = [file_path for intake in main.intakes() for file_path in main.intake_files(intake) if not main.is_queued(file_path)]
+        job.total = len(paths)
+        main.move_batch(paths, key=f"job-{job.id}", progress=job.progress, cancelled=job.cancelled)
+
+    return start_job("rescan", None, list_and_move)
+
+
+# the answer of a query (a reader call - get_readers().run(func) - or a catalog read) for this request; if the client disconnects first, the
+# query is cancelled (or interrupted, if it already runs) instead of finishing for nobody. Every DB endpoint reads through this, so a request
+# waiting on the database only holds a coroutine - never a threadpool thread
+async def read(request, query):
+    query = asyncio.ensure_future(query)
+    disconnected = asyncio.ensure_future(client_gone(request))
+    try:
+        await asyncio.wait((query, disconnected), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnected.cancel()
+    if not query.done():
+        query.cancel()
+        raise HTTPException(status_code=499, detail="Client closed the request")    # nobody reads it; 499 as in nginx, for the logs
+    return query.result()
+
+
+async def client_gone(request):
+    while (await request.receive())["type"] != "http.disconnect":    # the (empty) body of a GET, then nothing until the client goes away
+        pass
+
+
+# GET endpoint with the status and progress of a background job
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    job = jobs.live(job_id) or await read(request, get_readers().run(lambda conn: jobs.load(conn, job_id)))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+# POST endpoint that cancels a job: files not started yet are skipped, the ones already moved stay moved (and recorded)
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    job = jobs.cancel(job_id)
+    if job is not None:
+        return job
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    raise HTTPException(status_code=409, detail=f"Job already {job['status']}")
+
+
+# GET endpoint that returns DB rows (files from files_table), optionally filtered: ?file_type=Image, ?after_id=1200 (rows newer than that id),
+# ?limit=500, ?history=true (also the rows retention.py moved into monthly partitions). Rows are only ever added, or moved out by retention
+# (which bumps history_generation in meta, also when an exported partition is dropped), so MAX(id) and the generation plus the filters identify the answer: they are sent as the ETag, and
+# a client that sends it back in If-None-Match gets 304 Not Modified from two primary-key lookups, without any row being read. The body is
+# streamed a page at a time (never the whole table in memory) and compressed on the fly when the client accepts it (gzip, or br if the
+# brotli package is installed)
+@app.get("/files")
+async def list_files(request: Request, file_type: Optional[str] = None, after_id: Optional[int] = None, limit: Optional[int] = None,
+                     history: bool = False, if_none_match: Optional[str] = Header(None), accept_encoding: Optional[str] = Header(None)):
+    if history:
+        require_sqlite("history")
+    max_id, generation = await read(request, get_catalog().head())
+    params = json.dumps([file_type, after_id, limit, history])
+    etag = f'W/"{generation or 0}-{max_id or 0}-{zlib.crc32(params.encode()):08x}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if if_none_match and (if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+
+    max_id = max_id or 0    # up to the row the ETag was computed for, so the body matches it
+    if history:
+        body = stream_rows(HistoryPages(file_type, max_id), after_id or 0, limit)
+    else:
+        body = stream_rows(lambda last_id, count: get_catalog().page(last_id, count, file_type, max_id), after_id or 0, limit)
+    encoding = pick_encoding(accept_encoding)
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+        body = compress(body, encoding)
+    return StreamingResponse(body, media_type="application/json", headers=headers)
 # this basically fetches all the records from the files_table and returns them as a JSON response when the /files endpoint is accessed with a GET request. Each record contains metadata about the files that have been uploaded and moved, such as filename, file type, source path, destination path, and the time they were moved.
 
 
+# {"files": [[...], ...]} written out a page (FILES_PAGE rows) at a time, each page a query of its own - await fetch(last id sent, count) -
+# continuing after the last id sent: between two pages nothing is held for the client, however slowly it reads, and the id <= MAX(id)
+# bound keeps the pages to what the ETag was computed for
+async def stream_rows(fetch, after_id, limit=None):
+    try:
+        yield '{"files": ['
+        separator = ""
+        last_id, left = after_id, limit
+        while left is None or left > 0:
+            rows = await fetch(last_id, FILES_PAGE if left is None else min(left, FILES_PAGE))
+            if not rows:
+                break
+            yield separator + ",".join(json.dumps(row) for row in rows)
+            separator = ","
+            last_id = rows[-1][0]
+            if left is not None:
+                left -= len(rows)
+        yield "]}"
+    finally:
+        if hasattr(fetch, "close"):
+            fetch.close()
+
+
+# pages of files_history (the catalog plus the partitions attached by retention.connect(), plain text rows): that connection is this stream's
+# own, so its pages run on the threadpool (hence check_same_thread)
+class HistoryPages:
+    def __init__(self, file_type, max_id):
+        self.conn = retention.connect(check_same_thread=False)
+        where, self.args = ["id <= ?"], [max_id]
+        if file_type is not None:
+            where.append("file_type = ?")
+            self.args.append(file_type)
+        self.sql = f"SELECT * FROM files_history WHERE {' AND '.join(where)} AND id > ? ORDER BY id LIMIT ?"
+
+    async def __call__(self, last_id, count):
+        return await run_in_threadpool(lambda: self.conn.execute(self.sql, self.args + [last_id, count]).fetchall())
+
+    def close(self):
+        self.conn.close()
+
+
+# /search, /stats and history are sqlite features: 501 when the catalog is kept elsewhere (FILE_SORTER_CATALOG=log)
+def require_sqlite(feature):
+    if catalog.BACKEND != "sqlite":
+        raise HTTPException(status_code=501, detail=f"{feature} needs FILE_SORTER_CATALOG=sqlite (this server uses {catalog.BACKEND})")
+
+
+# GET /files/lookup?path=/srv/drop/scan.pdf: the latest move of the file that was at that path (404: it was never moved from there), or
+# ?digest=<sha256 hex>: every move of a file with that content (recorded with FILE_SORTER_HASH=1). One index lookup either way
+@app.get("/files/lookup")
+async def lookup_file(request: Request, path: Optional[str] = None, digest: Optional[str] = None):
+    if (path is None) == (digest is None):
+        raise HTTPException(status_code=400, detail="give either path or digest")
+    columns = feed.COLUMNS + ("digest",)
+    if path is not None:
+        row = await read(request, get_catalog().lookup_path(os.path.abspath(path)))
+        if row is None:
+            raise HTTPException(status_code=404, detail="No move recorded from that path")
+        return dict(zip(columns, row))
+    try:
+        rows = await read(request, get_catalog().lookup_digest(digest))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="digest must be a hex sha256")
+    return {"files": [dict(zip(columns, row)) for row in rows]}
+
+
+# the best encoding both sides support, from an Accept-Encoding header (None = send it uncompressed)
+def pick_encoding(accept_encoding):
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        name, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:     # "gzip;q=0" means: not gzip
+            accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+async def compress(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        async for chunk in chunks:
+            data = compressor.process(chunk.encode())
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)    # 16 + MAX_WBITS: gzip framing, not raw zlib
+        async for chunk in chunks:
+            data = compressor.compress(chunk.encode())
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+# GET /search?q=invoice march: files whose name contains every word, best matches first (see search.py), optionally only one file_type
+# and/or moved between since and until (dates or "YYYY-MM-DD HH:MM:SS")
+@app.get("/search")
+async def search_files(request: Request, q: str, file_type: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                       limit: int = 50):
+    require_sqlite("/search")
+    if not q.split():
+        raise HTTPException(status_code=400, detail="q must contain at least one word")
+    if not 1 <= limit <= search.MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {search.MAX_LIMIT}")
+    try:
+        rows, how = await read(request, get_readers().run(lambda conn: search.search(conn, q, file_type=file_type, since=since, until=until, limit=limit)))
+    except ValueError as e:     # since/until that aren't dates
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"results": [dict(zip(feed.COLUMNS, row)) for row in rows], "index": how}
+
+
+# GET /stats?period=day (or hour): files, bytes and average move time per category per day/hour, plus totals for the range, read from the
+# rollups the db writer keeps (stats_daily/stats_hourly) - a primary-key range of at most a few rows per category and period, however long
+# the history is. since/until default to the last 30 days (last 48 hours for period=hour)
+STATS_PERIODS = {"day": ("stats_daily", "%Y-%m-%d", timedelta(days=30)), "hour": ("stats_hourly", "%Y-%m-%d %H:00", timedelta(hours=48))}
+
+
+@app.get("/stats")
+async def get_stats(request: Request, period: str = "day", since: Optional[str] = None, until: Optional[str] = None, file_type: Optional[str] = None):
+    require_sqlite("/stats")
+    if period not in STATS_PERIODS:
+        raise HTTPException(status_code=400, detail=f"period must be one of {list(STATS_PERIODS)}")
+    table, bucket_format, default_range = STATS_PERIODS[period]
+    try:
+        end = datetime.fromisoformat(until) if until else datetime.now()
+        if until and len(until) == 10:      # a plain date covers that whole day (its last hour too for period=hour), like /search's
+            end += timedelta(days=1, microseconds=-1)
+        start = datetime.fromisoformat(since) if since else end - default_range
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    sql = f"SELECT {period}, file_type, files, bytes, seconds FROM {table} WHERE {period} BETWEEN ? AND ?"
+    args = [start.strftime(bucket_format), end.strftime(bucket_format)]
+    if file_type is not None:
+        sql += " AND file_type = ?"
+        args.append(file_type)
+    rows = await read(request, get_readers().run(lambda conn: conn.execute(sql + f" ORDER BY {period}, file_type", args).fetchall()))
+
+    buckets, totals = [], {}
+    for bucket, category, files, size, seconds in rows:
+        buckets.append({period: bucket, "file_type": category, "files": files, "bytes": size, "avg_seconds": seconds / files if files else 0.0})
+        total = totals.setdefault(category, {"files": 0, "bytes": 0, "seconds": 0.0})
+        total["files"] += files
+        total["bytes"] += size
+        total["seconds"] += seconds
+    for total in totals.values():
+        total["avg_seconds"] = total.pop("seconds") / total["files"] if total["files"] else 0.0
+    return {"period": period, "since": args[0], "until": args[1], "buckets": buckets, "totals": totals}
+
+
+# one event in the text/event-stream format; the id is what EventSource sends back as Last-Event-ID when it reconnects
+def sse(event):
+    return f"id: {event['id']}\nevent: move\ndata: {json.dumps(event)}\n\n"
+
+
+# catalog rows after after_id, oldest first, as feed events (only for clients resuming from further back than the feed keeps in memory)
+async def rows_after(after_id, limit=1000):
+    return [dict(zip(feed.COLUMNS, row)) for row in await get_catalog().page(after_id, limit)]
+
+
+async def feed_stream(after_id):
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    subscriber, backlog = feed.subscribe(lambda: loop.call_soon_threadsafe(ready.set), after_id)
+    last_sent = after_id
+    try:
+        yield "retry: 2000\n\n"
+        if backlog is None:     # resuming from before what the feed keeps: catch up from the table, a chunk at a time
+            while True:
+                backlog = await rows_after(last_sent)
+                if not backlog:
+                    break
+                for event in backlog:
+                    yield sse(event)
+                last_sent = backlog[-1]["id"]
+        else:
+            for event in backlog:
+                yield sse(event)
+                last_sent = event["id"]
+
+        while True:
+            try:
+                await asyncio.wait_for(ready.wait(), FEED_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            ready.clear()
+            if subscriber.dropped:      # fell too far behind; the client reconnects with Last-Event-ID and resumes where it was
+                yield "event: dropped\ndata: {}\n\n"
+                return
+            for event in subscriber.take():
+                if last_sent is None or event["id"] > last_sent:    # the catch-up above may already have sent it
+                    yield sse(event)
+                    last_sent = event["id"]
+    finally:
+        feed.unsubscribe(subscriber)
+
+
+# GET endpoint streaming new move records as they are committed (Server-Sent Events; in a browser: new EventSource("/events"))
+# replaces polling /files: nothing is read from the database unless a client resumes from further back than the last 10,000 moves.
+# Resume with the Last-Event-ID header (sent automatically by EventSource on reconnect) or ?last_id=
+@app.get("/events")
+async def events(last_id: Optional[int] = None, last_event_id: Optional[str] = Header(None)):
+    after_id = last_id
+    if after_id is None and last_event_id and last_event_id.isdigit():
+        after_id = int(last_event_id)
+    return StreamingResponse(feed_stream(after_id), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# GET endpoint in the Prometheus text exposition format (point a Prometheus scrape job at /metrics)
+# rendering only reads the per-thread counters kept by metrics.py, so scraping never blocks or slows down move_file
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
+# POST endpoint that starts the sampling profiler (only available when the server runs with FILE_SORTER_PROFILING=1)
+# returns immediately; the collapsed stacks and the move_file summary are written to profiles/ once the N seconds are up
+@app.post("/debug/profile")
+def start_profile(seconds: int = 30):
+    if not profiler.ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled (set FILE_SORTER_PROFILING=1)")
+    if seconds < 1 or seconds > 600:
+        raise HTTPException(status_code=400, detail="seconds must be between 1 and 600")
 
+    base_path = profiler.start(seconds=seconds)
+    if base_path is None:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    return {"status": "started", "seconds": seconds, "flamegraph": base_path + ".folded", "summary": base_path + ".summary.txt"}
@@ -0,0 +1,232 @@
+import os
+import time
+import uuid
+import logging
+import tarfile
+import threading
+import zipfile
+import claims
+import main
+import metrics
+from catalog import get_catalog
+
+# Optional archive expansion (FILE_SORTER_ARCHIVES=1, see main.move_file()): a .zip/.tar/.tar.gz/... dropped into an intake folder has its members sorted like
+# any other file, and the archive itself is then sorted normally (kept, eg: in Others) once they are all done.
+# - members are streamed straight out of the archive with zipfile/tarfile, one at a time, into a hidden staging file inside the intake folder
+#   (the watcher ignores hidden folders) and from there renamed into the folder their own name/content classifies them into; nothing is
+#   ever unpacked into a temporary tree. Folder structure inside the archive is not kept, member names clash-proofed by claims.place()
+# - zip members are independent, so each one is its own task on the shared worker pool (decompressed in parallel, all reading through one
+#   ZipFile); a tar(.gz) is a single stream that can only be read in order, so its members are extracted by one task and handed to the pool
+#   for classifying/moving as they come out
+# - zip bombs: archives with more than MAX_MEMBERS members, more than MAX_TOTAL_SIZE bytes inside, or compressed more than MAX_RATIO times
+#   (as a whole or per member) are not expanded. Declared sizes can lie, so the limits are also enforced on the bytes actually written
+# - members that are archives themselves are sorted as files, not expanded (no recursion)
+
+MAX_MEMBERS = 10_000
+MAX_TOTAL_SIZE = 20 * 1024 ** 3     # bytes, all members together
+MAX_RATIO = 100                     # uncompressed / compressed
+RATIO_EXEMPT = 1024 ** 2            # bytes; tiny members (and archives) legitimately compress better than that
+COPY_BUFFER = 1024 * 1024
+
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+
+class ArchiveLimitError(Exception):
+    pass
+
+
+def is_archive(name):
+    name = name.lower()
+    return name.endswith(".zip") or name.endswith(TAR_SUFFIXES)
+
+
+# one archive being expanded: counts the members still in flight and sorts the archive itself after the last one
+class Expansion:
+    def __init__(self, archive_path, intake, name, outside=False, source=None):
+        self.archive_path = archive_path
+        self.intake = intake
+        self.outside = outside      # handed over by the API from outside the intakes (see main.relocate_file())
+        self.name = name    # what the archive is really called (archive_path can be a claim or an upload's staging file: "<hex>.part")
+        # where it was dropped (archive_path can be its claim, see claims.py, or an upload's staging file: then the caller says)
+        self.source = source or os.path.join(os.path.dirname(claims.origin(intake, archive_path)), name)
+        self.staging = os.path.join(intake.path, ".archives")
+        self.members = 0
+        self.moved = 0
+        self.failed = 0
+        self._pending = 1       # the extraction itself, until every member has been handed out
+        self._lock = threading.Lock()
+        self.on_done = None
+        self.plain = False      # it turned out unreadable: expand() returns None and move_file() sorts it as a plain file instead
+
+    def add(self):
+        with self._lock:
+            self.members += 1
+            self._pending += 1
+
+    def done(self, moved):
+        with self._lock:
+            if moved:
+                self.moved += 1
+            elif moved is not None:
+                self.failed += 1
+            self._pending -= 1
+            finished = self._pending == 0
+        if finished:
+            if self.on_done is not None:
+                self.on_done()
+            logging.info(f"[ARCHIVE] {self.name}: {self.moved} member(s) sorted, {self.failed} failed")
+            if not self.plain:    # the archive itself, under its own name, by the normal rules (and without expanding it again)
+                main._fair_queue.submit(self.intake.name, self.archive_path, lambda path: main.process_file(path, name=self.name, expand=False, outside=self.outside, source=self.source))
+
+    # Future callback for a member task
+    def member_done(self, future):
+        self.done(None if future.cancelled() or future.exception() is not None else future.result())
+
+    # copies one member's bytes (read from `source`, a file object) into a staging file; returns its path
+    def stage(self, name, source, limit):
+        staged = os.path.join(self.staging, f"{uuid.uuid4().hex}-{name}")
+        try:
+            with open(staged, "wb") as target:
+                copy_limited(source, target, limit)
+        except BaseException:
+            os.remove(staged)
+            raise
+        return staged
+
+    # sorts a staged member under its own name (path: where it is in the archive); True if it was moved, False if that failed
+    def sort_staged(self, staged, name, path):
+        try:
+            moved = main.relocate(staged, name=name)
+            if moved is None:
+                return None
+            row, size, start_time = moved
+            row = (row[0], row[1], f"{self.source}/{member_path(path)}", *row[3:])     # where it really came from, not the staging file
+            get_catalog().insert(row, (size, time.time() - start_time)).result()
+            main.record_move(row, size, start_time)
+            return True
+        except Exception:
+            metrics.inc("sorter_errors_total", stage="archive")
+            logging.exception(f"[ERROR] failed to sort {name} from {self.archive_path}")
+            return False
+        finally:
+            try:
+                os.remove(staged)
+            except FileNotFoundError:
+                pass
+
+
+def copy_limited(source, target, limit):
+    written = 0
+    while True:
+        data = source.read(COPY_BUFFER)
+        if not data:
+            return written
+        written += len(data)
+        if written > limit:
+            raise ArchiveLimitError(f"member is bigger than its declared size or the archive limits ({limit} bytes)")
+        target.write(data)
+
+
+def member_name(path):
+    name = os.path.basename(path.rstrip("/"))
+    if not name or name.startswith(".") or "__MACOSX/" in path:     # hidden files and macOS resource forks
+        return None
+    return name
+
+
+# a member's path inside its archive as it is recorded (sub/three.mp3): no leading "/" or "./", no empty or "." parts
+def member_path(path):
+    return "/".join(part for part in path.replace("\\", "/").split("/") if part not in ("", "."))
+
+
+def too_compressed(size, compressed):
+    return size > RATIO_EXEMPT and size > MAX_RATIO * max(compressed, 1)
+
+
+# called by move_file() for archives: queues the members and returns straight away (the worker isn't held while they are sorted), or returns
+# None if the archive can't or mustn't be expanded (unreadable, over the limits), in which case it is sorted as a plain file. name: what
+# the archive is called (its zip/tar type and where it ends up go by that, not by archive_path)
+def expand(archive_path, intake, name, outside=False, source=None):
+    expansion = Expansion(archive_path, intake, name, outside, source)
+    os.makedirs(expansion.staging, exist_ok=True)
+    try:
+        if name.lower().endswith(".zip"):
+            expand_zip(expansion)
+        else:
+            expand_tar(expansion)
+    except (ArchiveLimitError, zipfile.BadZipFile) as e:
+        metrics.inc("sorter_errors_total", stage="archive")
+        logging.warning(f"[ARCHIVE] not expanding {name}: {e}")
+        return None
+    if expansion.plain:
+        return None
+    metrics.inc("sorter_archives_expanded_total")
+    return {"filename": name, "file_type": "Archive", "destination": None, "members": expansion.members}
+
+
+def expand_zip(expansion):
+    archive = zipfile.ZipFile(expansion.archive_path)
+    try:
+        members = [info for info in archive.infolist() if not info.is_dir() and member_name(info.filename)]
+        total = sum(info.file_size for info in members)
+        if len(members) > MAX_MEMBERS:
+            raise ArchiveLimitError(f"{len(members)} members (limit {MAX_MEMBERS})")
+        if total > MAX_TOTAL_SIZE or too_compressed(total, os.path.getsize(expansion.archive_path)):
+            raise ArchiveLimitError(f"{total} bytes uncompressed from {os.path.getsize(expansion.archive_path)}")
+        bomb = next((info for info in members if too_compressed(info.file_size, info.compress_size)), None)
+        if bomb is not None:
+            raise ArchiveLimitError(f"{bomb.filename} is compressed {bomb.file_size // max(bomb.compress_size, 1)}x")
+    except Exception:
+        archive.close()
+        raise
+
+    def sort_zip_member(info):
+        name = member_name(info.filename)
+        try:
+            with archive.open(info) as source:      # ZipFile serializes the raw reads; decompression runs in parallel
+                staged = expansion.stage(name, source, info.file_size)
+        except Exception:     # corrupt member (bad CRC...), or bigger than it claimed
+            metrics.inc("sorter_errors_total", stage="archive")
+            logging.exception(f"[ERROR] failed to extract {info.filename} from {expansion.archive_path}")
+            return False
+        return expansion.sort_staged(staged, name, info.filename)
+
+    expansion.on_done = archive.close
+    key = f"archive:{expansion.archive_path}"     # its own round-robin lane: a 10,000-member zip doesn't hold up the intakes
+    for info in members:
+        expansion.add()
+        main._fair_queue.submit(key, expansion.archive_path, lambda _, info=info: sort_zip_member(info)).add_done_callback(expansion.member_done)
+    expansion.done(None)
+
+
+def expand_tar(expansion):
+    compressed = os.path.getsize(expansion.archive_path)
+    total = 0
+    key = f"archive:{expansion.archive_path}"
+    try:
+        with tarfile.open(expansion.archive_path, mode="r|*") as archive:     # stream mode: one pass, members in order, no seeking
+            for member in archive:
+                name = member_name(member.name)
+                if not member.isfile() or name is None:     # folders, links, devices...
+                    continue
+                if expansion.members >= MAX_MEMBERS:
+                    raise ArchiveLimitError(f"more than {MAX_MEMBERS} members")
+                total += member.size
+                if total > MAX_TOTAL_SIZE or too_compressed(total, compressed):
+                    raise ArchiveLimitError(f"{total} bytes uncompressed from {compressed}")
+
+                # the stream can't be shared with the pool, so the bytes are staged here and only the classifying/moving is handed out
+                staged = expansion.stage(name, archive.extractfile(member), member.size)
+                expansion.add()
+                # queued under the archive's path, like zip members: it counts as queued (reconciliation leaves it alone) until all are sorted
+                sort = lambda _, staged=staged, name=name, path=member.name: expansion.sort_staged(staged, name, path)
+                main._fair_queue.submit(key, expansion.archive_path, sort).add_done_callback(expansion.member_done)
+    except (ArchiveLimitError, tarfile.TarError, EOFError) as e:     # the members before the problem stay sorted
+        metrics.inc("sorter_errors_total", stage="archive")
+        logging.warning(f"[ARCHIVE] stopped expanding {expansion.name} after {expansion.members} member(s): {e}")
+        expansion.plain = True      # the archive is sorted as a plain file right away (done() doesn't queue it a second time)
+    finally:
+        expansion.done(None)
+
+
+metrics.counter("sorter_archives_expanded_total", "Archives whose members were sorted individually")
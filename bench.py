@@ -0,0 +1,581 @@
+# Reproducible benchmark suite for the sorter (backs the "~1 ms per file" numbers in the README)
+# It generates a synthetic corpus inside a temp folder, points the sorter at it through FILE_SORTER_DIR / FILE_SORTER_DB / FILE_SORTER_LOG
+# (so the real FileSorter folder and files_db.db are never touched) and then times the same files going through:
+#   move   -> move_file() via the ThreadPoolExecutor (same path process_existing_files() uses)
+#   watcher -> Observer + MoverHandler picking up newly created files
+#   upload -> POST /upload-files through an in-process client (no network involved)
+#   latency -> file-appears -> row-committed latency of the watcher while files are created at a controlled rate (steady, burst or ramp);
+#              not part of --mode all since it runs for --duration seconds
+#   catalog -> the two catalog backends (catalog.py) head to head, without moving any file: --rows rows inserted one per call from
+#              MAX_WORKERS threads (each waiting for its row to be durable, like move_file), then all of them paged through, looked up by
+#              path, and (log backend) the index rebuilt from the file like at a restart; not part of --mode all either
+#   processes -> CPU-bound sorting (FILE_SORTER_HASH=1 over files of at least HASHED_FILE_BYTES) through the threads, then through 1, 2, 4...
+#              cpu_count worker processes (procpool.py); files/s and the speedup over the threads for each; not part of --mode all either
+# Results are printed (or written with --output) as JSON so runs can be diffed/compared
+#
+# eg: python bench.py --files 200 --sizes mixed --collisions 0.1 --output before.json
+#     python bench.py --mode latency --pattern ramp --rate 50 --duration 20
+#     python bench.py --mode catalog --rows 200000
+#     python bench.py --mode processes --files 400
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# size distributions (bytes) used when generating the corpus
+SIZE_PROFILES = {
+    "tiny": lambda rng: rng.randint(0, 1024),
+    "small": lambda rng: rng.randint(1024, 64 * 1024),
+    "mixed": lambda rng: int(min(rng.lognormvariate(10, 2), 64 * 1024 * 1024)),    # mostly small files with a long tail of big ones (like a real downloads folder)
+    "large": lambda rng: rng.randint(8 * 1024 * 1024, 32 * 1024 * 1024),
+}
+
+# relative weight of each category in the corpus
+EXTENSION_MIXES = {
+    "default": {"Audio": 1, "Video": 1, "Image": 3, "Document": 3, "Unknown": 1},
+    "images": {"Image": 1},
+    "documents": {"Document": 1},
+    "unknown": {"Unknown": 1},
+}
+
+UNKNOWN_EXTENSIONS = [".txt", ".csv", ".json", ".log", ".bin", ".py"]
+
+HASHED_FILE_BYTES = 4 * 1024 * 1024     # --mode processes: smallest file, so hashing it is worth shipping to another process
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(latencies, wall_time):
+    return {
+        "files": len(latencies),
+        "wall_seconds": round(wall_time, 6),
+        "throughput_files_per_sec": round(len(latencies) / wall_time, 2) if wall_time else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 4) if latencies else None,
+            "p50": round(percentile(latencies, 50) * 1000, 4) if latencies else None,
+            "p99": round(percentile(latencies, 99) * 1000, 4) if latencies else None,
+            "max": round(max(latencies) * 1000, 4) if latencies else None,
+        },
+    }
+
+
+# read/write syscall counters of this process (Linux only; /proc/self/io doesn't exist elsewhere so we just report None)
+def syscall_counts():
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return {"read": int(fields["syscr"]), "write": int(fields["syscw"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024     # macOS reports bytes, Linux reports kilobytes
+
+
+# runs fn() and attaches the syscall delta and peak RSS to whatever result dict it returns
+def measured(fn):
+    before = syscall_counts()
+    result = fn()
+    after = syscall_counts()
+    if before and after:
+        result["syscalls"] = {key: after[key] - before[key] for key in before}
+    else:
+        result["syscalls"] = None
+    result["peak_rss_bytes"] = peak_rss_bytes()
+    return result
+
+
+# builds the list of files to generate: (name, size, collides) tuples; a "collisions" fraction of them reuses a name that is ALSO pre-placed in the destination
+# folder, so move_file() has to pick another name for those
+def build_corpus(args, count=None):
+    import main    # imported lazily so FILE_SORTER_* env vars are already set when main reads them
+
+    rng = random.Random(args.seed)
+    extensions = {"Unknown": UNKNOWN_EXTENSIONS}
+    for rule in main.rules.current().rules:     # file_type -> extensions, taken from the routing rules in use
+        extensions.setdefault(rule.file_type, []).extend(sorted(rule.extensions))
+    mix = EXTENSION_MIXES[args.mix]
+    categories = list(mix)
+    weights = [mix[category] for category in categories]
+    size_of = SIZE_PROFILES[args.sizes]
+
+    corpus = []
+    for i in range(args.files if count is None else count):
+        category = rng.choices(categories, weights)[0]
+        name = f"file_{i:06d}{rng.choice(extensions[category])}"
+        corpus.append((name, size_of(rng), rng.random() < args.collisions))
+    return corpus
+
+
+def write_file(path, size):
+    with open(path, "wb") as f:
+        remaining = size
+        chunk = b"\0" * min(size, 1024 * 1024)
+        while remaining > 0:
+            f.write(chunk[:remaining])
+            remaining -= len(chunk)
+
+
+# empties the destination folders and the table so every scenario starts from the same state
+def reset(main, db):
+    for folder in main.rules.current().destinations():
+        folder = os.path.join(main.source_dir, folder)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+    for entry in os.scandir(main.source_dir):
+        if entry.is_file():
+            os.remove(entry.path)
+    conn = db.get_connection()
+    conn.execute("DELETE FROM files")
+    conn.commit()
+    conn.close()
+
+
+# pre-places a same-named file in the destination for every corpus entry flagged as a collision
+def place_collisions(main, corpus):
+    for name, _, collides in corpus:
+        if collides:
+            open(os.path.join(destination_for(main, name), name), "wb").close()
+
+
+def destination_for(main, name):
+    return os.path.join(main.source_dir, main.rules.current().classify(name).dest)
+
+
+# wraps main.move_file so every call (whichever path it came through) records its own duration and the time its row was committed
+# (move_file commits the row before returning)
+@contextlib.contextmanager
+def timed_move_file(main):
+    original = main.move_file
+    latencies = []
+    committed = {}
+    lock = threading.Lock()
+
+    def wrapper(file_path, *args, **kwargs):
+        start = time.perf_counter()
+        result = original(file_path, *args, **kwargs)
+        end = time.perf_counter()
+        with lock:
+            latencies.append(end - start)
+            committed[os.path.basename(file_path)] = end
+        return result
+
+    main.move_file = wrapper
+    try:
+        yield latencies, committed
+    finally:
+        main.move_file = original
+
+
+def bench_move(main, db, corpus, args):
+    reset(main, db)
+    place_collisions(main, corpus)
+    for name, size, _ in corpus:
+        write_file(os.path.join(main.source_dir, name), size)
+
+    def run():
+        with timed_move_file(main) as (latencies, _):
+            start = time.perf_counter()
+            futures = [main.submit(os.path.join(main.source_dir, name)) for name, _, _ in corpus]
+            for future in futures:
+                future.result()
+            wall = time.perf_counter() - start
+        return summarize(latencies, wall)
+
+    return measured(run)
+
+
+def bench_watcher(main, db, corpus, args, timeout=60):
+    from watchdog.observers import Observer
+    from watcher import MoverHandler
+
+    reset(main, db)
+    place_collisions(main, corpus)
+
+    def run():
+        observer = Observer()
+        observer.schedule(MoverHandler(), main.source_dir, recursive=True)
+        observer.start()
+        try:
+            with timed_move_file(main) as (_, committed):
+                created = {}
+                start = time.perf_counter()
+                for name, size, _ in corpus:
+                    write_file(os.path.join(main.source_dir, name), size)
+                    created[name] = time.perf_counter()
+
+                deadline = time.perf_counter() + timeout
+                while time.perf_counter() < deadline and not all(name in committed for name in created):
+                    time.sleep(0.005)
+                wall = time.perf_counter() - start
+                latencies = [committed[name] - created[name] for name in created if name in committed]
+        finally:
+            observer.stop()
+            observer.join()
+
+        result = summarize(latencies, wall)
+        result["missed"] = len(created) - len(latencies)    # files the watcher never picked up before the timeout
+        return result
+
+    return measured(run)
+
+
+def bench_upload(main, db, corpus, args, batch_size=20):
+    from fastapi.testclient import TestClient
+    import api
+
+    reset(main, db)
+    place_collisions(main, corpus)
+    payloads = [(name, b"\0" * size) for name, size, _ in corpus]
+    client = TestClient(api.app)
+
+    def run():
+        latencies = []
+        start = time.perf_counter()
+        for i in range(0, len(payloads), batch_size):
+            batch = payloads[i:i + batch_size]
+            request_start = time.perf_counter()
+            response = client.post("/upload-files", files=[("files", (name, data)) for name, data in batch])
+            response.raise_for_status()
+            per_file = (time.perf_counter() - request_start) / len(batch)    # requests carry several files, so spread the request time over them
+            latencies.extend([per_file] * len(batch))
+        wall = time.perf_counter() - start
+        result = summarize(latencies, wall)
+        result["batch_size"] = batch_size
+        return result
+
+    return measured(run)
+
+
+# creation schedule for the latency benchmark: a list of (offset_seconds, step) pairs, one per file
+#   steady -> rate files/s spread evenly over the whole duration
+#   burst  -> the same average rate, but delivered as one burst every --burst-interval seconds
+#   ramp   -> --steps equal-length steps, the rate doubling every step (rate, 2*rate, 4*rate, ...) to find where the pipeline stops keeping up
+def build_schedule(pattern, rate, duration, burst_interval=1.0, steps=5):
+    schedule = []
+    if pattern == "steady":
+        count = int(rate * duration)
+        schedule = [(i / rate, 0) for i in range(count)]
+    elif pattern == "burst":
+        per_burst = max(1, int(rate * burst_interval))
+        bursts = max(1, int(duration / burst_interval))
+        schedule = [(b * burst_interval, 0) for b in range(bursts) for _ in range(per_burst)]
+    elif pattern == "ramp":
+        step_length = duration / steps
+        for step in range(steps):
+            step_rate = rate * 2 ** step
+            schedule.extend((step * step_length + i / step_rate, step) for i in range(int(step_rate * step_length)))
+    return schedule
+
+
+def bench_latency(main, db, corpus, args):
+    reset(main, db)
+    return measured(lambda: run_latency(main, args))
+
+
+def run_latency(main, args):
+    from watchdog.observers import Observer
+    from watcher import MoverHandler
+
+    schedule = build_schedule(args.pattern, args.rate, args.duration, args.burst_interval, args.steps)
+    corpus = build_corpus(args, count=len(schedule))
+    step_count = args.steps if args.pattern == "ramp" else 1
+
+    observer = Observer()
+    observer.schedule(MoverHandler(), main.source_dir, recursive=True)
+    observer.start()
+
+    # backlog = events the observer has not dispatched yet + files waiting for a worker; sampled in the background while files are being created
+    samples = []
+    sampling = threading.Event()
+
+    def sample_backlog():
+        while not sampling.is_set():
+            samples.append((time.perf_counter(), observer.event_queue.qsize() + main.queue_depth()))
+            time.sleep(0.01)
+
+    sampler = threading.Thread(target=sample_backlog, daemon=True)
+
+    try:
+        with timed_move_file(main) as (_, committed):
+            created = {}
+            step_of = {}
+            sampler.start()
+            start = time.perf_counter()
+            for (offset, step), (name, size, _) in zip(schedule, corpus):
+                delay = start + offset - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                write_file(os.path.join(main.source_dir, name), size)
+                now = time.perf_counter()
+                created[name] = now
+                step_of[name] = step
+            produced = time.perf_counter() - start
+
+            deadline = time.perf_counter() + args.drain_timeout
+            while time.perf_counter() < deadline and not all(name in committed for name in created):
+                time.sleep(0.005)
+            sampling.set()
+            sampler.join()
+            committed = dict(committed)
+    finally:
+        observer.stop()
+        observer.join()
+
+    latencies = [committed[name] - created[name] for name in created if name in committed]
+    result = summarize(latencies, produced)
+    result["pattern"] = args.pattern
+    result["offered_events_per_sec"] = round(len(schedule) / args.duration, 2)
+    result["achieved_events_per_sec"] = round(len(created) / produced, 2) if produced else None    # lower than offered if creating the files was itself the bottleneck
+    result["missed"] = len(created) - len(latencies)
+    result["max_backlog"] = max((depth for _, depth in samples), default=0)
+
+    # per step: latency distribution and whether the backlog kept growing during it. A step is "sustainable" if the backlog at the end of
+    # the step is no bigger than one worker pool's worth of files, ie. the queues were keeping up with the arrival rate
+    workers = main.MAX_WORKERS
+    steps = []
+    step_length = args.duration / step_count
+    for step in range(step_count):
+        names = [name for name in created if step_of[name] == step]
+        if not names:
+            continue
+        step_latencies = [committed[name] - created[name] for name in names if name in committed]
+        step_end = start + (step + 1) * step_length     # scheduled end of the step (for bursts: after the quiet time following the last burst)
+        window = [depth for t, depth in samples if t <= step_end]
+        end_backlog = window[-1] if window else 0
+        steps.append({
+            "events_per_sec": round(len(names) / step_length, 2),
+            "files": len(names),
+            "p50_ms": round(percentile(step_latencies, 50) * 1000, 4) if step_latencies else None,
+            "p99_ms": round(percentile(step_latencies, 99) * 1000, 4) if step_latencies else None,
+            "end_backlog": end_backlog,
+            "sustainable": end_backlog <= workers and len(step_latencies) == len(names),
+        })
+    result["steps"] = steps
+    sustainable = [step["events_per_sec"] for step in steps if step["sustainable"] and step["events_per_sec"]]
+    result["max_sustainable_events_per_sec"] = max(sustainable) if sustainable else None
+    return result
+
+
+def bench_catalog(main, db, corpus, args):
+    import catalog
+
+    reset(main, db)
+    results = {}
+    for backend in ("sqlite", "log"):
+        if backend == "sqlite":
+            make = catalog.SQLiteCatalog
+        else:
+            log_path = os.path.join(os.path.dirname(db.DB_FILE), "moves.log")
+            make = lambda: catalog.LogCatalog(log_path)
+        results[backend] = measured(lambda: run_catalog(main, make, args, rebuild=backend == "log"))
+    return results
+
+
+def run_catalog(main, make, args, rebuild=False):
+    import asyncio
+
+    rng = random.Random(args.seed)
+    types = sorted({rule.file_type for rule in main.rules.current().rules})
+    rows = []
+    for i in range(args.rows):
+        file_type = rng.choice(types)
+        name = f"file_{i:07d}.bin"
+        rows.append((name, file_type, os.path.join(main.source_dir, name), os.path.join(main.source_dir, file_type, name), time.time_ns(), None))
+
+    backend = make()
+    latencies = []
+    lock = threading.Lock()
+
+    def insert(part):
+        own = []
+        for row in part:
+            start = time.perf_counter()
+            backend.insert(row).result()
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=insert, args=(rows[i::main.MAX_WORKERS],)) for i in range(main.MAX_WORKERS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = {"insert": summarize(latencies, time.perf_counter() - start)}
+
+    async def page_through(file_type=None):
+        count, last_id = 0, 0
+        while True:
+            page = await backend.page(last_id, 1000, file_type)
+            if not page:
+                return count
+            count += len(page)
+            last_id = page[-1][0]
+
+    async def look_up(paths):
+        found = 0
+        for path in paths:
+            found += await backend.lookup_path(path) is not None
+        return found
+
+    start = time.perf_counter()
+    paged = asyncio.run(page_through())
+    result["page_all"] = {"rows": paged, "seconds": round(time.perf_counter() - start, 6)}
+    start = time.perf_counter()
+    paged = asyncio.run(page_through(types[0]))
+    result["page_one_type"] = {"rows": paged, "seconds": round(time.perf_counter() - start, 6)}
+    paths = [row[2] for row in rng.sample(rows, min(10_000, len(rows)))]
+    start = time.perf_counter()
+    found = asyncio.run(look_up(paths))
+    elapsed = time.perf_counter() - start
+    result["lookup_path"] = {"lookups": len(paths), "found": found, "mean_us": round(elapsed / len(paths) * 1e6, 2) if paths else None}
+
+    if rebuild:     # a second instance over the same file: what a restart costs
+        start = time.perf_counter()
+        make()
+        result["rebuild_index_seconds"] = round(time.perf_counter() - start, 6)
+    return result
+
+
+def bench_processes(main, db, corpus, args):
+    os.environ["FILE_SORTER_HASH"] = "1"    # for the worker processes (they read it when they import main)
+    hashing = main.HASH_CONTENT
+    main.HASH_CONTENT = True
+    counts = sorted({1, 2, os.cpu_count() or 1} | {2 ** i for i in range(10) if 2 ** i <= (os.cpu_count() or 1)})
+    results = {}
+    try:
+        results["threads"] = measured(lambda: run_processes(main, db, corpus, 0))
+        for count in counts:
+            results[f"processes_{count}"] = measured(lambda: run_processes(main, db, corpus, count))
+    finally:
+        main.HASH_CONTENT = hashing
+        os.environ.pop("FILE_SORTER_HASH", None)
+    base = results["threads"]["files_per_sec"]
+    for result in results.values():
+        result["speedup"] = round(result["files_per_sec"] / base, 3) if base else None
+    return results
+
+
+# one pass over the corpus with `count` worker processes (0 = main's threads); pool startup isn't timed
+def run_processes(main, db, corpus, count):
+    reset(main, db)
+    for name, size, _ in corpus:
+        write_file(os.path.join(main.source_dir, name), max(size, HASHED_FILE_BYTES))
+    main.start_processes(count)
+    try:
+        if main._processes is not None:    # wait for every worker to be up (the first move on each would otherwise pay for its import)
+            for i in range(count * 4):     # hidden names: relocate_file() skips them right away; several, since they are spread by path hash
+                main._processes.relocate(os.path.join(main.source_dir, f".warmup-{i}"), None)
+        start = time.perf_counter()
+        futures = [main.submit(os.path.join(main.source_dir, name)) for name, _, _ in corpus]
+        for future in futures:
+            future.result()
+        wall = time.perf_counter() - start
+    finally:
+        main.stop_processes()
+        if main._executor is not None:     # sized for this pass (start_processes() grows it); the next one gets its own
+            main._executor.shutdown()
+            main._executor = None
+        main._executor_threads = main.MAX_WORKERS
+        main._fair_queue.max_in_flight = main.MAX_WORKERS * 2
+    return {"processes": count, "files": len(corpus), "seconds": round(wall, 6), "files_per_sec": round(len(corpus) / wall, 2) if wall else None}
+
+
+MODES = {
+    "move": bench_move,
+    "watcher": bench_watcher,
+    "upload": bench_upload,
+    "latency": bench_latency,
+    "catalog": bench_catalog,
+    "processes": bench_processes,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the file sorter on a synthetic corpus")
+    parser.add_argument("--mode", choices=list(MODES) + ["all"], default="all")
+    parser.add_argument("--files", type=int, default=200, help="number of files in the corpus")
+    parser.add_argument("--sizes", choices=list(SIZE_PROFILES), default="tiny", help="file size distribution")
+    parser.add_argument("--mix", choices=list(EXTENSION_MIXES), default="default", help="extension/category mix")
+    parser.add_argument("--collisions", type=float, default=0.0, help="fraction of files whose name already exists in the destination (0-1)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--pattern", choices=["steady", "burst", "ramp"], default="steady", help="file creation pattern for --mode latency")
+    parser.add_argument("--rate", type=float, default=100.0, help="files created per second (starting rate for ramp)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to keep creating files for --mode latency")
+    parser.add_argument("--burst-interval", type=float, default=1.0, help="seconds between bursts for --pattern burst")
+    parser.add_argument("--steps", type=int, default=5, help="number of rate doublings for --pattern ramp")
+    parser.add_argument("--rows", type=int, default=100_000, help="rows inserted per backend for --mode catalog")
+    parser.add_argument("--drain-timeout", type=float, default=30.0, help="seconds to wait for the backlog to drain after the last file")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the temp folder after the run (for inspection)")
+    return parser.parse_args(argv)
+
+
+def run_benchmarks(args):
+    workdir = tempfile.mkdtemp(prefix="sorter-bench-")
+    os.environ["FILE_SORTER_DIR"] = os.path.join(workdir, "FileSorter")
+    os.environ["FILE_SORTER_DB"] = os.path.join(workdir, "files_db.db")
+    os.environ["FILE_SORTER_LOG"] = os.path.join(workdir, "file_mover.log")
+
+    try:
+        import db
+        import main
+
+        main.setup()
+        db.initialize_database()
+        corpus = build_corpus(args)
+        modes = ["move", "watcher", "upload"] if args.mode == "all" else [args.mode]
+
+        results = {}
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):    # move_file prints a line per file; keep that out of the timings/report
+            for mode in modes:
+                results[mode] = MODES[mode](main, db, corpus, args)
+
+        return {
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "keep")},
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "workers": main.MAX_WORKERS,
+            },
+            "corpus_bytes": sum(size for _, size, _ in corpus),
+            "results": results,
+        }
+    finally:
+        if args.keep:
+            print(f"kept benchmark folder: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def cli(argv=None):
+    args = parse_args(argv)
+    report = json.dumps(run_benchmarks(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    cli()
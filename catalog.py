@@ -0,0 +1,297 @@
+import os
+import json
+import fcntl
+import asyncio
+import queue
+import logging
+import threading
+from array import array
+from bisect import bisect_right
+from concurrent.futures import Future
+import db
+from db import FILES_COLUMNS, FILES_FROM, CATEGORY_ID_SQL, get_readers, get_writer, moved_at_text
+import metrics
+
+# The move catalog (one row per file moved) behind one interface, so the movers and the API don't depend on where it is kept:
+#   insert_many(rows, stats) / insert(row, stats) -> Future resolving to the new ids once they are durable; a row is
+#       (filename, file_type, source_path, destination_path, moved_ns, digest), stats (size in bytes, seconds the move took) per row
+#   listeners -> called on the writing thread with [(id, row), ...] after each commit (eg: feed.publish)
+#   await head() -> (last id, generation): identifies the current content for ETags (the generation changes when rows go away)
+#   await page(after_id, limit, file_type=None, max_id=None) -> rows after after_id in id order, as
+#       (id, filename, file_type, source_path, destination_path, moved_at)
+#   await lookup_path(path) -> the latest move of the file that was at `path` (None: nothing was ever moved from there)
+#   await lookup_digest(digest) -> every move of a file with that sha256 (FILE_SORTER_HASH=1), oldest first
+#   lookups return (id, filename, file_type, source_path, destination_path, moved_at, digest)
+# FILE_SORTER_CATALOG picks the backend:
+#   sqlite (default) -> files_db.db, written by the db writer and read through the read pool; /search, /stats, /files?history=true and
+#                       retention only exist with this one
+#   log -> LogCatalog: an append-only file, for deployments that only ask "was this moved already?" and for the recent moves, where a
+#          sqlite transaction per batch (plus the search index, rollups and indexes it maintains) is the bottleneck
+# Jobs and the other bookkeeping tables stay in files_db.db either way
+
+BACKEND = os.environ.get("FILE_SORTER_CATALOG", "sqlite")
+LOG_PATH = os.environ.get("FILE_SORTER_CATALOG_LOG", os.path.join(os.path.dirname(os.path.abspath(db.DB_FILE)), "moves.log"))
+
+LOOKUP_COLUMNS = f"{FILES_COLUMNS}, lower(hex(f.digest)) AS digest"
+LOOKUP_DIGESTS_MAX = 100
+
+
+class SQLiteCatalog:
+    name = "sqlite"
+
+    def __init__(self):
+        self._writer = get_writer()
+        self.listeners = self._writer.listeners
+
+    def insert_many(self, rows, stats=None):
+        return self._writer.insert_many(rows, stats)
+
+    def insert(self, row, stats=None):
+        return self._writer.insert(row, stats)
+
+    async def head(self):
+        return await get_readers().run(lambda conn: conn.execute(
+            "SELECT (SELECT MAX(id) FROM files), (SELECT value FROM meta WHERE key = 'history_generation')").fetchone())
+
+    async def page(self, after_id, limit, file_type=None, max_id=None):
+        where, args = ["f.id > ?"], [after_id]
+        if max_id is not None:
+            where.append("f.id <= ?")
+            args.append(max_id)
+        if file_type is not None:
+            where.append(f"f.category = {CATEGORY_ID_SQL}")
+            args.append(file_type)
+        sql = f"SELECT {FILES_COLUMNS} {FILES_FROM} WHERE {' AND '.join(where)} ORDER BY f.id LIMIT ?"
+        return await get_readers().run(lambda conn: conn.execute(sql, args + [limit]).fetchall())
+
+    async def lookup_path(self, path):
+        directory, name = os.path.split(path)
+        # the same expression as the files_source index, so it is a lookup, not a scan
+        sql = (f"SELECT {LOOKUP_COLUMNS} {FILES_FROM} WHERE f.source_dir = (SELECT id FROM directories WHERE path = ?) "
+               f"AND coalesce(f.source_name, f.filename) = ? ORDER BY f.id DESC LIMIT 1")
+        return await get_readers().run(lambda conn: conn.execute(sql, (directory, name)).fetchone())
+
+    async def lookup_digest(self, digest):
+        value = bytes.fromhex(digest)     # ValueError for anything that isn't hex
+        sql = f"SELECT {LOOKUP_COLUMNS} {FILES_FROM} WHERE f.digest = ? ORDER BY f.id LIMIT ?"
+        return await get_readers().run(lambda conn: conn.execute(sql, (value, LOOKUP_DIGESTS_MAX)).fetchall())
+
+
+# Append-only catalog: one JSON line per move - [id, filename, file_type, source_path, destination_path, moved_ns, digest] - appended by a
+# writer thread in batches (group commit, like DBWriter: whatever piled up while the previous batch was being written goes out in one
+# write() + one fdatasync()). Nothing but the file is durable; the index lives in memory and is rebuilt by reading the file once at startup:
+# - the byte offset of every line (ids are 1, 2, 3... in file order, so a page of ids is one contiguous pread)
+# - the ids of each file_type (pages filtered by type: a bisect, then a pread per line)
+# - source path -> id of its latest move, digest -> ids (the lookups)
+# Rows are read back from the file (the page cache), not kept in memory. Several processes (the watcher and the API) can share one log:
+# appends happen under an exclusive flock, after indexing whatever the others appended meanwhile (so ids stay consecutive), and readers
+# pick up the lines other processes appended before each query. A line half-written by a process that died is cut off by the next writer
+class LogCatalog:
+    name = "log"
+    BATCH_MAX = 500     # rows per write at most
+    READ_SIZE = 16 * 1024 * 1024    # bytes read at a time while indexing
+
+    def __init__(self, path=LOG_PATH):
+        self.path = path
+        self.listeners = []
+        self._lock = threading.Lock()   # the index (appends by the writer thread vs lookups by the API)
+        self._offsets = array("q", [0])     # _offsets[id - 1] = where line `id` starts; the last entry is where the next one will
+        self._by_type = {}
+        self._by_source = {}
+        self._by_digest = {}
+        self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            self._catch_up()
+            self._cut_torn_line()
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        logging.info(f"[CATALOG] {path}: {len(self._offsets) - 1} move(s) indexed")
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="catalog-log", daemon=True)
+        self._thread.start()
+
+    def insert_many(self, rows, stats=None):
+        future = Future()
+        self._queue.put((list(rows), future))
+        return future
+
+    def insert(self, row, stats=None):
+        return self.insert_many([row])
+
+    # the reads below are file I/O (pread/fstat, indexing what other processes appended): off the event loop, on its default executor
+    @staticmethod
+    async def _off_loop(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def head(self):
+        return await self._off_loop(self._head)
+
+    async def page(self, after_id, limit, file_type=None, max_id=None):
+        return await self._off_loop(self._page, after_id, limit, file_type, max_id)
+
+    async def lookup_path(self, path):
+        return await self._off_loop(self._lookup_path, path)
+
+    async def lookup_digest(self, digest):
+        bytes.fromhex(digest)     # ValueError for anything that isn't hex, like the sqlite backend
+        return await self._off_loop(self._lookup_digest, digest)
+
+    def _head(self):
+        self._catch_up()
+        return len(self._offsets) - 1, 0    # nothing is ever removed: the generation never changes
+
+    def _page(self, after_id, limit, file_type, max_id):
+        self._catch_up()
+        with self._lock:
+            last = len(self._offsets) - 1 if max_id is None else min(max_id, len(self._offsets) - 1)
+            if file_type is None:
+                ids = range(max(after_id, 0) + 1, min(last, max(after_id, 0) + limit) + 1)
+            else:
+                typed = self._by_type.get(file_type, ())
+                start = bisect_right(typed, after_id)
+                ids = [row_id for row_id in typed[start:start + limit] if row_id <= last]
+            spans = [(self._offsets[row_id - 1], self._offsets[row_id]) for row_id in ids]
+        if not spans:
+            return []
+        if file_type is None:       # consecutive ids: consecutive lines
+            lines = os.pread(self._fd, spans[-1][1] - spans[0][0], spans[0][0]).splitlines()
+        else:
+            lines = [os.pread(self._fd, end - start, start) for start, end in spans]
+        return [self._as_row(json.loads(line))[:6] for line in lines]
+
+    def _lookup_path(self, path):
+        self._catch_up()
+        with self._lock:
+            row_id = self._by_source.get(path)
+        return self._read(row_id) if row_id is not None else None
+
+    def _lookup_digest(self, digest):
+        self._catch_up()
+        with self._lock:
+            ids = list(self._by_digest.get(digest.lower(), ())[:LOOKUP_DIGESTS_MAX])
+        return [self._read(row_id) for row_id in ids]
+
+    def _read(self, row_id):
+        start, end = self._offsets[row_id - 1], self._offsets[row_id]
+        return self._as_row(json.loads(os.pread(self._fd, end - start, start)))
+
+    @staticmethod
+    def _as_row(line):
+        row_id, filename, file_type, source_path, destination_path, moved_ns, digest = line
+        return row_id, filename, file_type, source_path, destination_path, moved_at_text(moved_ns // 1_000_000_000), digest
+
+    # indexes the complete lines appended (by anyone) since the last call. Our own writer indexes its lines while still holding _lock (see
+    # _append()), so this never sees them half-way: only other processes' lines, which are durable once their flock is released
+    def _catch_up(self):
+        size = os.fstat(self._fd).st_size
+        if size <= self._offsets[-1]:
+            return
+        with self._lock:
+            position = self._offsets[-1]
+            while position < size:
+                data = os.pread(self._fd, min(self.READ_SIZE, size - position), position)
+                complete = data.rfind(b"\n") + 1
+                if not complete:    # the rest is a line still being written (or a torn one)
+                    break
+                for line in data[:complete].splitlines(keepends=True):
+                    self._index(json.loads(line), len(line))
+                position += complete
+
+    def _index(self, line, length):
+        row_id, _, file_type, source_path, _, _, digest = line
+        if row_id != len(self._offsets):
+            raise ValueError(f"{self.path}: expected id {len(self._offsets)} at offset {self._offsets[-1]}, found {row_id}")
+        self._offsets.append(self._offsets[-1] + length)
+        self._by_type.setdefault(file_type, array("q")).append(row_id)
+        self._by_source[source_path] = row_id
+        if digest:
+            self._by_digest.setdefault(digest, []).append(row_id)
+
+    # with the flock held (so nobody is halfway through an append): bytes after the last complete line were left by a writer that died
+    def _cut_torn_line(self):
+        if os.fstat(self._fd).st_size > self._offsets[-1]:
+            logging.warning(f"[CATALOG] {self.path}: removing an incomplete last line at offset {self._offsets[-1]}")
+            os.ftruncate(self._fd, self._offsets[-1])
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]     # blocks until there is something to write
+            rows = len(batch[0][0])
+            while rows < self.BATCH_MAX:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                rows += len(item[0])
+
+            try:
+                results = self._append(batch)
+            except Exception as e:
+                logging.exception("[CATALOG] append failed")
+                metrics.inc("sorter_errors_total", stage="catalog")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            metrics.observe("sorter_db_batch_rows", rows)
+            for (_, future), ids in zip(batch, results):
+                future.set_result(ids)
+            if self.listeners:
+                committed = [(row_id, row) for (item_rows, _), ids in zip(batch, results) for row_id, row in zip(ids, item_rows)]
+                for listener in self.listeners:
+                    try:
+                        listener(committed)
+                    except Exception:
+                        logging.exception("[CATALOG] commit listener failed")
+
+    def _append(self, batch):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            self._catch_up()    # another process's lines first: ours get the ids after them
+            self._cut_torn_line()
+            next_id = len(self._offsets)
+            lines, results = [], []
+            for item_rows, _ in batch:
+                results.append(list(range(next_id, next_id + len(item_rows))))
+                for row in item_rows:
+                    line = [next_id, *row]
+                    lines.append((line, (json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n").encode()))
+                    next_id += 1
+            data = b"".join(encoded for _, encoded in lines)
+            # _lock from the write to the end of the indexing: a reader's _catch_up() would otherwise index these lines itself (before they
+            # are durable, even) and ours would then find their ids taken
+            with self._lock:
+                try:
+                    written = 0
+                    while written < len(data):
+                        written += os.write(self._fd, data[written:])
+                    os.fdatasync(self._fd)
+                except BaseException:
+                    os.ftruncate(self._fd, self._offsets[-1])   # no half batch left behind for the next append to build on
+                    raise
+                for line, encoded in lines:
+                    self._index(line, len(encoded))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return results
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+# the catalog of this process (FILE_SORTER_CATALOG), created the first time it is needed
+def get_catalog():
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                if BACKEND == "log":
+                    _catalog = LogCatalog()
+                elif BACKEND == "sqlite":
+                    _catalog = SQLiteCatalog()
+                else:
+                    raise ValueError(f"FILE_SORTER_CATALOG must be 'sqlite' or 'log', not {BACKEND!r}")
+    return _catalog
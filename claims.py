@@ -0,0 +1,204 @@
+import os
+import time
+import uuid
+import errno
+import atexit
+import shutil
+import socket
+import logging
+import threading
+import metrics
+
+# Several sorter instances on one intake folder (two watchers for HA, one per host over shared storage, or the worker processes of
+# procpool.py): every file must be sorted by exactly one of them, and none may overwrite a file another one just placed.
+# - claiming: before touching a file an instance renames it into its own claim folder, <intake>/.claims/<instance>/ (hidden, so watchers
+#   ignore it). rename() is atomic on one file system: exactly one instance gets the file, the others get FileNotFoundError and skip it
+# - placing: the claimed file is hard-linked to its final name (os.link fails if that name exists, so a clash can't overwrite anything; the
+#   next free "name(1).ext" is tried instead) and then unlinked from the claim folder. Where hard links aren't possible (another file system)
+#   the name is created with O_EXCL and the bytes copied
+# - leases: each instance touches <claim folder>/.lease every LEASE_SECONDS / 4. A claim folder whose lease is older than LEASE_SECONDS
+#   belongs to an instance that died (or hung) mid-move: recover() - run by every reconciliation scan - takes the whole folder over with
+#   one rename (so only one instance recovers it) and puts the files back in the intake, where they are sorted again
+# The claimed file's name records where it came from (<token>-<path relative to the intake, / escaped as %2F>), so the catalog still shows
+# the path the file was dropped at
+
+CLAIM_DIR = ".claims"
+LEASE_FILE = ".lease"
+LEASE_SECONDS = float(os.environ.get("FILE_SORTER_LEASE_SECONDS", "120"))     # generous: mtimes on shared storage come from other clocks
+INSTANCE = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"     # this process (worker processes each get their own)
+COPY_BUFFER = 1024 * 1024
+NO_LINK = (errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK)     # os.link() can't be used here: copy instead
+
+_folders = set()     # claim folders of this instance (one per intake), kept alive by the lease thread
+_lock = threading.Lock()
+_lease_thread = None
+
+
+def claim_root(intake):
+    return os.path.join(intake.path, CLAIM_DIR)
+
+
+def folder_for(intake):
+    folder = os.path.join(claim_root(intake), INSTANCE)
+    if folder not in _folders:
+        with _lock:
+            if folder not in _folders:
+                open_folder(folder)
+                _folders.add(folder)
+                start_lease_thread()
+    return folder
+
+
+# at exit: our claim folders go away with us if nothing was left in them (else recover() returns the files once the lease runs out)
+@atexit.register
+def close():
+    for folder in list(_folders):
+        try:
+            if os.listdir(folder) == [LEASE_FILE]:
+                os.remove(os.path.join(folder, LEASE_FILE))
+                os.rmdir(folder)
+        except OSError:
+            pass
+
+
+def open_folder(folder):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, LEASE_FILE), "a"):
+        pass
+    os.utime(os.path.join(folder, LEASE_FILE))
+
+
+def start_lease_thread():
+    global _lease_thread
+    if _lease_thread is None:
+        _lease_thread = threading.Thread(target=renew_leases, name="claim-leases", daemon=True)
+        _lease_thread.start()
+
+
+def renew_leases():
+    while True:
+        time.sleep(LEASE_SECONDS / 4)
+        for folder in list(_folders):
+            try:
+                open_folder(folder)     # re-created if another instance thought we were dead and recovered it
+            except OSError:
+                metrics.inc("sorter_errors_total", stage="claims")
+                logging.exception(f"[ERROR] failed to renew the lease of {folder}")
+
+
+def is_hidden(intake, file_path):
+    return any(part.startswith(".") for part in os.path.relpath(file_path, intake.path).split(os.sep))
+
+
+# takes file_path (in intake) for this instance; returns the path it now has, or None if another instance got it first. Files that are
+# already only ours (in a hidden folder: a claim folder, the upload/archive staging folders) are returned as they are
+def claim(intake, file_path):
+    if not intake.contains(file_path) or is_hidden(intake, file_path):
+        return file_path
+    relative = os.path.relpath(file_path, intake.path).replace("%", "%25").replace(os.sep, "%2F")
+    claimed = os.path.join(folder_for(intake), f"{uuid.uuid4().hex}-{relative}")
+    try:
+        os.rename(file_path, claimed)
+    except FileNotFoundError:
+        if os.path.exists(file_path):     # it's our claim folder that went missing (recovered while we were stalled): once more
+            open_folder(os.path.dirname(claimed))
+            return claim(intake, file_path)
+        metrics.inc("sorter_claims_lost_total")
+        return None
+    return claimed
+
+
+# where a claimed file was dropped (file_path itself if it isn't a claimed file)
+def origin(intake, file_path):
+    folder, name = os.path.split(file_path)
+    if os.path.dirname(folder) != claim_root(intake) or "-" not in name:
+        return file_path
+    relative = name.split("-", 1)[1].replace("%2F", os.sep).replace("%25", "%")
+    return os.path.join(intake.path, relative)
+
+
+# puts a claimed file back where it was dropped (a move that failed half-way), so it is tried again later
+def release(intake, claimed):
+    source = origin(intake, claimed)
+    if source == claimed:
+        return
+    try:
+        os.makedirs(os.path.dirname(source), exist_ok=True)
+        place(claimed, os.path.dirname(source), os.path.basename(source))
+    except OSError:
+        metrics.inc("sorter_errors_total", stage="claims")
+        logging.exception(f"[ERROR] failed to put {claimed} back to {source}")
+
+
+# moves `path` to folder/name without ever replacing an existing file ("name(1).ext", "name(2).ext"... if it is taken); returns the name used
+def place(path, folder, name):
+    stem, extension = os.path.splitext(name)
+    counter = 0
+    while True:
+        target = os.path.join(folder, name)
+        try:
+            try:
+                os.link(path, target)
+            except OSError as e:
+                if e.errno not in NO_LINK:
+                    raise
+                copy_exclusive(path, target)
+        except FileExistsError:
+            counter += 1
+            name = f"{stem}({counter}){extension}"
+            continue
+        os.remove(path)
+        return name
+
+
+def copy_exclusive(path, target):
+    fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)     # FileExistsError if the name is taken
+    try:
+        with open(fd, "wb") as out, open(path, "rb") as source:
+            shutil.copyfileobj(source, out, COPY_BUFFER)
+        shutil.copystat(path, target)
+    except BaseException:
+        os.remove(target)
+        raise
+
+
+# puts the files of dead instances' claim folders (lease older than LEASE_SECONDS) back into the intake; returns how many
+def recover(intake):
+    root = claim_root(intake)
+    try:
+        entries = [entry for entry in os.scandir(root) if entry.is_dir() and entry.name != INSTANCE]
+    except FileNotFoundError:
+        return 0
+    recovered = 0
+    now = time.time()
+    for entry in entries:
+        try:
+            try:
+                renewed = os.stat(os.path.join(entry.path, LEASE_FILE)).st_mtime
+            except FileNotFoundError:
+                renewed = entry.stat().st_mtime     # no lease yet (being created) or any more (half recovered by a dead instance)
+            if now - renewed < LEASE_SECONDS:
+                continue
+            taken = os.path.join(root, f"{INSTANCE}.{uuid.uuid4().hex[:8]}")
+            os.rename(entry.path, taken)     # one rename: if two instances recover it at once, only one gets it
+            open_folder(taken)      # a fresh lease, so nobody else takes it over from us while we empty it
+        except FileNotFoundError:
+            continue
+        for name in os.listdir(taken):
+            if name == LEASE_FILE:
+                continue
+            path = os.path.join(taken, name)
+            if os.stat(path).st_nlink > 1:     # already linked to its destination, it died before unlinking the claim: done
+                os.remove(path)
+                continue
+            release(intake, path)
+            recovered += 1
+        shutil.rmtree(taken, ignore_errors=True)
+        logging.warning(f"[CLAIMS] {intake.name}: recovered the claims of {entry.name} (lease expired)")
+    if recovered:
+        metrics.inc("sorter_claims_recovered_total", recovered)
+    return recovered
+
+
+metrics.counter("sorter_claims_lost_total", "Files another sorter instance claimed first (skipped here)")
+metrics.counter("sorter_claims_recovered_total", "Files put back into an intake from the claim folder of an instance whose lease expired")
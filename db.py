@@ -1,28 +1,477 @@
 import sqlite3
 import os
+import asyncio
+import time
+import queue
+import threading
+import logging
+from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import Future
+import metrics
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_FILE = os.path.join(BASE_DIR, "files_db.db")
+DB_FILE = os.environ.get("FILE_SORTER_DB", os.path.join(BASE_DIR, "files_db.db"))    # FILE_SORTER_DB overrides the database location (eg: bench.py uses a throwaway one)
+READ_POOL_SIZE = int(os.environ.get("FILE_SORTER_READ_POOL", "8"))     # reader threads (one read-only connection each) running the API's queries
+READ_STATEMENTS = int(os.environ.get("FILE_SORTER_READ_STATEMENTS", "256"))     # prepared statements each of them keeps (sqlite3's default is 128)
 
 
-def get_connection():
-    return sqlite3.connect(DB_FILE)     # returns a new sqlite3 connection for each request bcoz sqlite3 connections should be shared across threads. Each thread/request gets its own connection
+def get_connection(**options):
+    return sqlite3.connect(DB_FILE, **options)     # returns a new sqlite3 connection for each request bcoz sqlite3 connections should be shared across threads. Each thread/request gets its own connection
 # Note:- type of error which occurs when we dont do this: 'SQLite objects created in a thread can only be used in that same thread. The object was created in thread id 8382603584 and this is thread id 6109884416'
 
+SCHEMA_VERSION = 3
+MIGRATE_BATCH = 10_000     # v1 rows converted per transaction
+
+# Schema v2: a move is a row of small integers - when (ns since the epoch), category (categories.id) and the source/destination folders
+# (directories.id, each folder path stored once) - plus the file name; source_name/dest_name are only set when the file was called something
+# else there (eg: renamed on a name clash, or an upload's staging file). Rows are a fraction of the v1 size (category name, two full paths and
+# a formatted date as text on every row), so are the indexes, and time ranges are integer comparisons.
+# files_table is now a view decoding that back into the v1 columns (for readers like /files, /events catch-up and ad-hoc queries); the moves
+# themselves are written to `files` by the db writer (see Encoder)
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS directories (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    moved_ns INTEGER,
+    category INTEGER,
+    filename TEXT,
+    source_dir INTEGER,
+    source_name TEXT,
+    dest_dir INTEGER,
+    dest_name TEXT,
+    digest BLOB
+);
+CREATE INDEX IF NOT EXISTS files_category_moved ON files (category, moved_ns);
+CREATE INDEX IF NOT EXISTS files_moved ON files (moved_ns);
+"""
+
+# v3: the sha256 of the content (only with FILE_SORTER_HASH=1, NULL otherwise) and the lookups by it and by the source path
+# (see catalog.py); created after migrate(), so a v1 database gets them built once over all its rows rather than kept up to date row by row
+LOOKUP_SQL = """
+CREATE INDEX IF NOT EXISTS files_source ON files (source_dir, coalesce(source_name, filename));
+CREATE INDEX IF NOT EXISTS files_digest ON files (digest) WHERE digest IS NOT NULL;
+"""
+
+# `files` decoded into the v1 columns (id, filename, file_type, source_path, destination_path, moved_at); filter on f.* to use the indexes
+FILES_COLUMNS = """
+    f.id, f.filename, c.name AS file_type,
+    CASE s.path WHEN '' THEN '' WHEN '/' THEN '/' ELSE s.path || '/' END || coalesce(f.source_name, f.filename) AS source_path,
+    CASE d.path WHEN '' THEN '' WHEN '/' THEN '/' ELSE d.path || '/' END || coalesce(f.dest_name, f.filename) AS destination_path,
+    strftime('%Y-%m-%d %H:%M:%S', f.moved_ns / 1000000000, 'unixepoch', 'localtime') AS moved_at
+"""
+FILES_FROM = "FROM files f JOIN categories c ON c.id = f.category JOIN directories s ON s.id = f.source_dir JOIN directories d ON d.id = f.dest_dir"
+FILES_SELECT = f"SELECT {FILES_COLUMNS} {FILES_FROM}"
+
+CATEGORY_ID_SQL = "(SELECT id FROM categories WHERE name = ?)"
+
+
 def initialize_database():
     conn = get_connection()
+
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")     # only takes effect on a new (empty) database: lets retention.py give freed pages back a few at a time
+    conn.execute("PRAGMA journal_mode=WAL")     # readers (the API) and the writer thread don't block each other; the setting is stored in the db file
+
+    conn.executescript(SCHEMA_SQL)
+    if "digest" not in [column[1] for column in conn.execute("PRAGMA table_info(files)")]:     # v2
+        conn.execute("ALTER TABLE files ADD COLUMN digest BLOB")
+    migrate(conn)     # before anything else holds a statement open on this connection: it commits batch by batch
+    conn.executescript(LOOKUP_SQL)
+
     cursor = conn.cursor()
+    cursor.execute(f"CREATE VIEW IF NOT EXISTS files_table AS {FILES_SELECT}")
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    # filename search index (see search.py): an FTS5 table with the trigram tokenizer, so any 3+ character piece of a name ("invoice", "2024-03",
+    # "voic") is an index lookup instead of a LIKE over every row. It stores no copy of the names (content=files); the triggers keep it
+    # in step with `files` inside the same transaction as the row itself
+    try:
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_search'").fetchone()
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS files_search USING fts5(filename, content='files', content_rowid='id', tokenize='trigram')")
+        cursor.executescript("""
+        CREATE TRIGGER IF NOT EXISTS files_search_insert AFTER INSERT ON files BEGIN
+            INSERT INTO files_search (rowid, filename) VALUES (new.id, new.filename);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_search_delete AFTER DELETE ON files BEGIN
+            INSERT INTO files_search (files_search, rowid, filename) VALUES ('delete', old.id, old.filename);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_search_update AFTER UPDATE OF filename ON files BEGIN
+            INSERT INTO files_search (files_search, rowid, filename) VALUES ('delete', old.id, old.filename);
+            INSERT INTO files_search (rowid, filename) VALUES (new.id, new.filename);
+        END;
+        """)
+        if not exists:
+            cursor.execute("INSERT INTO files_search (files_search) VALUES ('rebuild')")     # rows moved before the index existed
+    except sqlite3.OperationalError as e:     # sqlite built without FTS5, or older than 3.34 (no trigram tokenizer): /search scans instead
+        logging.warning(f"[DB] filename search index unavailable, /search will scan: {e}")
+
+    # rollups for GET /stats, maintained by the db writer in the same transaction as the rows themselves (see DBWriter._roll_up()): files,
+    # bytes and seconds spent moving them per category per hour and per day, so stats for any range read a handful of rows, not the history
+    for table, column in (("stats_hourly", "hour"), ("stats_daily", "day")):
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            {column} TEXT,
+            file_type TEXT,
+            files INTEGER,
+            bytes INTEGER,
+            seconds REAL,
+            PRIMARY KEY ({column}, file_type)
+        ) WITHOUT ROWID
+        """)
+        if not exists:     # files moved before the rollups existed: their counts can be rebuilt, their sizes and timings weren't recorded
+            bucket = "substr(moved_at, 1, 13) || ':00'" if column == "hour" else "substr(moved_at, 1, 10)"
+            cursor.execute(f"INSERT INTO {table} SELECT {bucket}, file_type, COUNT(*), 0, 0.0 FROM files_table GROUP BY 1, 2")
+
+    # small key/value settings kept with the data (eg: history_generation, bumped whenever retention.py moves old rows out of `files` or drops a partition)
+    cursor.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
 
+    # background jobs started through the API (see jobs.py); kept after they finish so their outcome can still be looked up
     cursor.execute("""
-    CREATE TABLE IF NOT EXISTS files_table (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        filename TEXT,
-        file_type TEXT,
-        source_path TEXT,
-        destination_path TEXT,
-        moved_at TEXT
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT,
+        status TEXT,
+        total INTEGER,
+        done INTEGER,
+        failed INTEGER,
+        error TEXT,
+        created_at TEXT,
+        finished_at TEXT
     )
     """)
 
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+
+
+# v1 database (files_table is a table of text rows) -> v2: the rows are converted into `files` MIGRATE_BATCH at a time, each batch its own
+# transaction, so the WAL stays small and an interrupted migration carries on after the last id copied. Then the old table (with its
+# indexes, search index and triggers) is swapped for the files_table view in one transaction
+def migrate(conn):
+    if conn.execute("SELECT type FROM sqlite_master WHERE name = 'files_table'").fetchone() != ("table",):
+        return
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM files").fetchone()[0]
+    remaining = conn.execute("SELECT COUNT(*) FROM files_table WHERE id > ?", (last_id,)).fetchone()[0]
+    logging.info(f"[DB] migrating {remaining} row(s) of files_table to schema v{SCHEMA_VERSION}")
+    encoder = Encoder()
+    while True:
+        rows = conn.execute("SELECT id, filename, file_type, source_path, destination_path, moved_at FROM files_table WHERE id > ? ORDER BY id LIMIT ?",
+                            (last_id, MIGRATE_BATCH)).fetchall()
+        if not rows:
+            break
+        with conn:
+            conn.executemany(MIGRATE_FILE_SQL, [(row[0], *encoder.encode(conn, (*row[1:5], parse_moved_at(row[5]), None))) for row in rows])
+        last_id = rows[-1][0]
+
+    conn.execute("BEGIN IMMEDIATE")     # DDL doesn't open a transaction by itself
+    try:
+        if conn.execute("SELECT type FROM sqlite_master WHERE name = 'files_table'").fetchone() == ("table",):    # not done by another process meanwhile
+            conn.execute("DROP TABLE IF EXISTS files_search")     # indexed files_table; rebuilt over `files` by initialize_database()
+            conn.execute("DROP TABLE files_table")
+            conn.execute(f"CREATE VIEW files_table AS {FILES_SELECT}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    logging.info(f"[DB] files_table migrated to schema v{SCHEMA_VERSION}")
+
+
+# v1 moved_at ("YYYY-MM-DD HH:MM:SS", local time) -> ns since the epoch
+def parse_moved_at(text):
+    if not text:
+        return 0
+    return int(datetime.strptime(text, "%Y-%m-%d %H:%M:%S").timestamp()) * 1_000_000_000
+
+
+# the other way round (for rows the writer hands out before anyone read them back, eg: the /events feed); cached per second
+@lru_cache(maxsize=4096)
+def moved_at_text(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+
+
+# turns a move row as the rest of the code builds it - (filename, file_type, source_path, destination_path, moved_ns, digest) - into the values of
+# INSERT_FILE_SQL, adding categories/directories as they show up. The ids are cached: every folder and category is looked up in sqlite once
+# per connection. Only used by one thread (the writer, or a migration)
+class Encoder:
+    def __init__(self):
+        self.categories = {}
+        self.directories = {}
+
+    def clear(self):    # after a rollback: ids cached during it may not exist
+        self.categories.clear()
+        self.directories.clear()
+
+    def _id(self, conn, cache, table, column, value):
+        row_id = cache.get(value)
+        if row_id is None:
+            conn.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (value,))
+            row_id = cache[value] = conn.execute(f"SELECT id FROM {table} WHERE {column} = ?", (value,)).fetchone()[0]
+        return row_id
+
+    def encode(self, conn, row):
+        filename, file_type, source_path, destination_path, moved_ns, digest = row
+        source_dir, source_name = os.path.split(source_path or "")
+        dest_dir, dest_name = os.path.split(destination_path or "")
+        return (moved_ns, self._id(conn, self.categories, "categories", "name", file_type), filename,
+                self._id(conn, self.directories, "directories", "path", source_dir), None if source_name == filename else source_name,
+                self._id(conn, self.directories, "directories", "path", dest_dir), None if dest_name == filename else dest_name,
+                bytes.fromhex(digest) if digest else None)     # 32 bytes instead of 64 hex characters
+
+
+INSERT_FILE_SQL = """
+    INSERT INTO files (moved_ns, category, filename, source_dir, source_name, dest_dir, dest_name, digest)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+MIGRATE_FILE_SQL = """
+    INSERT OR IGNORE INTO files (id, moved_ns, category, filename, source_dir, source_name, dest_dir, dest_name, digest)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+ROLL_UP_SQL = """
+    INSERT INTO {table} VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT DO UPDATE SET files = files + excluded.files, bytes = bytes + excluded.bytes, seconds = seconds + excluded.seconds
+"""
+
+
+# Single background thread that owns the one write connection and commits rows in batches ("group commit")
+# Every worker (executor threads, API requests, every intake folder) hands its row to the writer and waits for the returned Future; while the
+# writer is busy committing one batch, the rows arriving meanwhile pile up and go out together in the next transaction. So under load there
+# is one commit (one fsync) for many files instead of one connect + commit per file, and sqlite never sees two writers fighting over the lock
+class DBWriter:
+    BATCH_MAX = 500    # rows per transaction at most
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self.listeners = []     # called on the writer thread with [(id, row), ...] after each commit of move rows (eg: feed.publish)
+        self._encoder = Encoder()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    # queues move rows - (filename, file_type, source_path, destination_path, moved_ns, digest) tuples, encoded into `files` rows by the writer - to be
+    # committed together in ONE transaction; the Future resolves to their ids once they are committed. stats: (size in bytes, seconds it took to move) for each row, added to the /stats rollups in the same transaction
+    def insert_many(self, rows, stats=None):
+        return self.write(INSERT_FILE_SQL, rows, stats)
+
+    # same for any other statement (eg: job status updates), so everything that writes goes through this one connection
+    def write(self, sql, rows, stats=None):
+        future = Future()
+        self._queue.put((sql, list(rows), future, stats))
+        return future
+
+    def insert(self, row, stats=None):
+        return self.insert_many([row], None if stats is None else [stats])
+
+    # runs func(connection) on the writer thread, on its own between two batches (so it may ATTACH, VACUUM, or commit several transactions
+    # itself, eg: retention.py moving old rows out in chunks); the Future resolves to what it returns. Keep it short: moves wait meanwhile
+    def call(self, func):
+        future = Future()
+        self._queue.put((func, None, future, None))
+        return future
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        conn = get_connection()
+        held = None     # a call() that showed up while a batch was being gathered; it runs right after that batch
+        while True:
+            item, held = held or self._queue.get(), None     # blocks until there is something to write
+            if callable(item[0]):
+                self._call(conn, item)
+                continue
+            batch = [item]
+            rows = len(item[1])
+            while rows < self.BATCH_MAX:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if callable(item[0]):
+                    held = item
+                    break
+                batch.append(item)
+                rows += len(item[1])
+
+            results = []
+            try:
+                with conn:      # one transaction for the whole batch (commits on success, rolls back on error)
+                    for sql, item_rows, _, _ in batch:
+                        if sql is INSERT_FILE_SQL:
+                            conn.executemany(sql, [self._encoder.encode(conn, row) for row in item_rows])
+                            # the transaction holds sqlite's write lock, so nobody can insert in between: the rows got consecutive ids ending at the last one
+                            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                            results.append(list(range(last_id - len(item_rows) + 1, last_id + 1)))
+                        else:
+                            conn.executemany(sql, item_rows)
+                            results.append(None)
+                    self._roll_up(conn, batch)
+            except Exception as e:
+                self._encoder.clear()
+                logging.exception("[DB] batch insert failed")
+                metrics.inc("sorter_errors_total", stage="db")
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            metrics.observe("sorter_db_batch_rows", rows)
+            for (_, _, future, _), ids in zip(batch, results):
+                future.set_result(ids)
+            if self.listeners:
+                committed = [(row_id, row) for (sql, item_rows, _, _), ids in zip(batch, results) if ids for row_id, row in zip(ids, item_rows)]
+                for listener in self.listeners:
+                    try:
+                        listener(committed)
+                    except Exception:
+                        logging.exception("[DB] commit listener failed")
+
+
+    def _call(self, conn, item):
+        func, _, future, _ = item
+        try:
+            result = func(conn)
+        except Exception as e:
+            self._encoder.clear()
+            if conn.in_transaction:
+                conn.rollback()
+            logging.exception("[DB] writer call failed")
+            metrics.inc("sorter_errors_total", stage="db")
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    # adds the batch's files_table rows to stats_hourly/stats_daily: summed per (hour, category) here first, so a batch of 500 moves is a few
+    # upserts, not 1000. Rows written without stats count as files with unknown (0) bytes and seconds
+    def _roll_up(self, conn, batch):
+        hourly = {}
+        hours = {}      # minute -> "YYYY-MM-DD HH:00" local time (per minute: time zones can be off by 30 or 45 minutes)
+        for sql, item_rows, _, stats in batch:
+            if sql is not INSERT_FILE_SQL:
+                continue
+            for row, (size, seconds) in zip(item_rows, stats or [(0, 0.0)] * len(item_rows)):
+                minute = row[4] // 60_000_000_000
+                hour = hours.get(minute)
+                if hour is None:
+                    hour = hours[minute] = time.strftime("%Y-%m-%d %H:00", time.localtime(minute * 60))
+                totals = hourly.setdefault((hour, row[1]), [0, 0, 0.0])
+                totals[0] += 1
+                totals[1] += size
+                totals[2] += seconds
+        if not hourly:
+            return
+        daily = {}
+        for (hour, file_type), (files, size, seconds) in hourly.items():
+            totals = daily.setdefault((hour[:10], file_type), [0, 0, 0.0])
+            totals[0] += files
+            totals[1] += size
+            totals[2] += seconds
+        conn.executemany(ROLL_UP_SQL.format(table="stats_hourly"), [(*key, *totals) for key, totals in hourly.items()])
+        conn.executemany(ROLL_UP_SQL.format(table="stats_daily"), [(*key, *totals) for key, totals in daily.items()])
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+# the shared writer (started the first time something needs to be written)
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = DBWriter()
+    return _writer
+
+
+# Read-only connections for the API's queries (/files, /search, /stats, /jobs/{id}, /events catch-up), each owned by a reader thread of its
+# own (READ_POOL_SIZE of them) that runs the queries handed to it, one at a time, instead of a sqlite3.connect() per request: file:...?mode=ro
+# so a reader can never take the write lock from the db writer (and in WAL mode readers and the writer never block each other - each query
+# reads the snapshot of the last commit from when it started), and a big cached_statements, so the handful of queries the API runs are
+# parsed and planned once per connection, not per request.
+# Async endpoints `await get_readers().run(func)`: while the query runs, the request only waits on the event loop - no threadpool thread is
+# held, so thousands of slow clients cost thousands of coroutines, not threads - and a request cancelled meanwhile (eg: its client went
+# away) takes its query with it: dropped if it hasn't started yet, otherwise stopped with conn.interrupt(). Sync code uses submit()
+class ReadPool:
+    def __init__(self, size=READ_POOL_SIZE):
+        self._queue = queue.SimpleQueue()
+        for index in range(size):
+            threading.Thread(target=self._run, name=f"db-reader-{index}", daemon=True).start()
+
+    # runs func(connection) on a reader thread; the concurrent.futures.Future resolves to what it returns (or raises what it raised)
+    def submit(self, func):
+        task = ReadTask(func)
+        self._queue.put(task)
+        return task.future
+
+    async def run(self, func):
+        task = ReadTask(func)
+        self._queue.put(task)
+        try:
+            return await asyncio.wrap_future(task.future)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+
+    def _run(self):
+        conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True, cached_statements=READ_STATEMENTS, check_same_thread=False)
+        while True:
+            task = self._queue.get()
+            if not task.future.set_running_or_notify_cancel():     # cancelled while it was queued
+                continue
+            metrics.observe("sorter_read_queue_seconds", time.perf_counter() - task.queued_at)
+            with task.lock:
+                task.conn = conn
+            try:
+                result = task.func(conn)
+            except BaseException as e:
+                with task.lock:
+                    task.conn = None
+                if conn.in_transaction:
+                    conn.rollback()
+                task.future.set_exception(e)
+            else:
+                with task.lock:
+                    task.conn = None
+                task.future.set_result(result)
+
+
+class ReadTask:
+    def __init__(self, func):
+        self.func = func
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+        self.lock = threading.Lock()
+        self.conn = None    # the connection running it, while it runs
+
+    def cancel(self):
+        if self.future.cancel():
+            return
+        with self.lock:     # only while func still runs on it: afterwards the connection is already on the next query
+            if self.conn is not None:
+                self.conn.interrupt()      # the running statement fails with OperationalError("interrupted")
+                metrics.inc("sorter_read_interrupted_total")
+
+
+_readers = None
+
+
+# the shared read pool (its threads connect on start, so after initialize_database())
+def get_readers():
+    global _readers
+    if _readers is None:
+        with _writer_lock:
+            if _readers is None:
+                _readers = ReadPool()
+    return _readers
+
+
+metrics.histogram("sorter_read_queue_seconds", "Time an API query waited for a free reader thread")
+metrics.counter("sorter_read_interrupted_total", "API queries interrupted because the request was cancelled (eg: the client disconnected)")
@@ -0,0 +1,92 @@
+import threading
+from collections import deque
+from db import moved_at_text
+import metrics
+
+# Live feed of move records for the API (GET /events, Server-Sent Events): the catalog hands every committed move row to publish(),
+# which fans it out to the connected subscribers, so dashboards get new moves pushed to them instead of re-reading /files every few seconds.
+# - every subscriber has a bounded buffer; one that falls more than SUBSCRIBER_BUFFER events behind is dropped (disconnected) instead of
+#   making the writer wait or the server hold an ever growing backlog for it
+# - the last HISTORY events are kept in memory, so a client that reconnects with the last id it saw (Last-Event-ID) resumes from there without
+#   touching the database; only one that was gone for longer is caught up from files_table, once
+# Only rows committed by THIS process are published: run the watcher inside the API (`sorter.py serve --watch`) to see its moves here
+
+SUBSCRIBER_BUFFER = 1000
+HISTORY = 10_000
+
+COLUMNS = ("id", "filename", "file_type", "source_path", "destination_path", "moved_at")
+
+
+class Subscriber:
+    def __init__(self, wake):
+        self._wake = wake      # called (from the writer thread) whenever there is something new; must be thread-safe
+        self._events = deque()
+        self._lock = threading.Lock()
+        self.dropped = False
+
+    def push(self, events):
+        with self._lock:
+            if self.dropped:
+                return
+            if len(self._events) + len(events) > SUBSCRIBER_BUFFER:
+                self.dropped = True
+                self._events.clear()
+                metrics.inc("sorter_feed_dropped_total")
+            else:
+                self._events.extend(events)
+        self._wake()
+
+    def take(self):
+        with self._lock:
+            events = list(self._events)
+            self._events.clear()
+        return events
+
+
+_subscribers = set()
+_history = deque(maxlen=HISTORY)
+_lock = threading.Lock()
+
+
+# a committed move row as the event (and /files) shows it: moved_ns formatted like files_table's moved_at
+def record(row_id, row):
+    filename, file_type, source_path, destination_path, moved_ns = row[:5]
+    return dict(zip(COLUMNS, (row_id, filename, file_type, source_path, destination_path, moved_at_text(moved_ns // 1_000_000_000))))
+
+
+# catalog listener: [(id, row), ...] just committed
+def publish(committed):
+    events = [record(row_id, row) for row_id, row in committed]
+    with _lock:
+        _history.extend(events)
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        subscriber.push(events)
+
+
+# registers a subscriber and returns it with the kept events newer than after_id (None = only new ones), or None instead of that list if
+# after_id is older than the history or nothing is kept yet (the caller catches up from the database). Both happen under the same lock, so nothing published in
+# between is missed or delivered twice
+def subscribe(wake, after_id=None):
+    subscriber = Subscriber(wake)
+    with _lock:
+        _subscribers.add(subscriber)
+        if after_id is None:
+            return subscriber, []
+        if not _history or after_id < _history[0]["id"] - 1:
+            return subscriber, None
+        return subscriber, [event for event in _history if event["id"] > after_id]
+
+
+def unsubscribe(subscriber):
+    with _lock:
+        _subscribers.discard(subscriber)
+
+
+def subscriber_count():
+    with _lock:
+        return len(_subscribers)
+
+
+metrics.counter("sorter_feed_dropped_total", "Live feed subscribers disconnected for falling too far behind")
+metrics.gauge("sorter_feed_subscribers", "Clients connected to the live feed", subscriber_count)
@@ -0,0 +1,137 @@
+import threading
+import time
+import uuid
+import logging
+from datetime import datetime
+from db import get_readers, get_writer
+import metrics
+
+# Background jobs started by the API (batch moves, rescans, uploads): the request returns a job id in milliseconds and the work runs on its own
+# thread; GET /jobs/{id} reports progress and POST /jobs/{id}/cancel stops it. Every job is also recorded in the `jobs` table (through the
+# shared db writer) so its outcome can be looked up after it finished, or after a restart.
+# Backpressure: at most MAX_RUNNING jobs run at a time (the rest wait, status "queued") and new jobs are refused (Busy) once MAX_PENDING
+# are unfinished; within a running job the files go through the shared worker pool as their own round-robin lane (see main.move_batch())
+
+MAX_RUNNING = 2
+MAX_PENDING = 32
+SAVE_EVERY = 1.0    # seconds; progress is written to the jobs table at most this often (the in-memory counters are always current)
+
+SAVE_JOB_SQL = """
+    INSERT OR REPLACE INTO jobs (id, kind, status, total, done, failed, error, created_at, finished_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class Busy(Exception):
+    pass
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class Job:
+    def __init__(self, kind, total):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"      # queued -> running -> done / failed / cancelled
+        self.total = total          # None until known (eg: a glob not expanded yet)
+        self.done = 0
+        self.failed = 0
+        self.error = None
+        self.created_at = _now()
+        self.finished_at = None
+        self.cancelled = threading.Event()    # checked by the work (eg: main.move_batch() stops handing out files once it is set)
+        self._saved_at = 0.0
+
+    def progress(self, done, failed):
+        self.done = done
+        self.failed = failed
+        if time.monotonic() - self._saved_at >= SAVE_EVERY:
+            self.save()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def save(self):
+        self._saved_at = time.monotonic()
+        return get_writer().write(SAVE_JOB_SQL, [(self.id, self.kind, self.status, self.total, self.done, self.failed, self.error,
+                                           self.created_at, self.finished_at)])     # usually not waited for: the writer logs and counts failures
+
+    def as_dict(self):
+        return {"id": self.id, "kind": self.kind, "status": self.status, "total": self.total, "done": self.done, "failed": self.failed,
+                "error": self.error, "created_at": self.created_at, "finished_at": self.finished_at}
+
+
+_jobs = {}      # unfinished jobs of this process (finished ones are read back from the table)
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(MAX_RUNNING)
+
+
+# the job as a dict: live counters while it runs here, otherwise its row in the jobs table (None if there is no such job)
+def get(job_id):
+    return live(job_id) or get_readers().submit(lambda conn: load(conn, job_id)).result()
+
+
+def live(job_id):
+    with _lock:
+        job = _jobs.get(job_id)
+    return job.as_dict() if job is not None else None
+
+
+# reader call (see db.ReadPool): the job's row as a dict, or None
+def load(conn, job_id):
+    row = conn.execute("SELECT id, kind, status, total, done, failed, error, created_at, finished_at FROM jobs WHERE id = ?",
+                       (job_id,)).fetchone()
+    if row is None:
+        return None
+    return dict(zip(("id", "kind", "status", "total", "done", "failed", "error", "created_at", "finished_at"), row))
+
+
+# returns the job's status afterwards, or None if it isn't running in this process (unknown, or already finished)
+def cancel(job_id):
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return None
+    job.cancel()
+    return job.as_dict()
+
+
+# creates a job and runs target(job) on a background thread once a slot is free; raises Busy if too many jobs are waiting already
+def start(kind, total, target):
+    job = Job(kind, total)
+    with _lock:
+        if len(_jobs) >= MAX_PENDING:
+            raise Busy(f"{len(_jobs)} jobs are already queued or running")
+        _jobs[job.id] = job
+    job.save()
+    threading.Thread(target=_run, args=(job, target), name=f"job-{job.id[:8]}", daemon=True).start()
+    return job
+
+
+def _run(job, target):
+    with _slots:
+        if not job.cancelled.is_set():
+            job.status = "running"
+            job.save()
+            try:
+                target(job)
+            except Exception as e:
+                job.error = str(e)
+                metrics.inc("sorter_errors_total", stage="job")
+                logging.exception(f"[ERROR] job {job.id} ({job.kind}) failed")
+
+    job.finished_at = _now()
+    job.status = "failed" if job.error else "cancelled" if job.cancelled.is_set() else "done"     # last, so whoever sees the final status also sees finished_at
+    try:
+        job.save().result()     # committed before the job leaves _jobs, so get() never falls back to a stale row
+    except Exception:
+        pass
+    with _lock:
+        del _jobs[job.id]
+
+
+# jobs that were still queued/running when the previous server process stopped will never finish; called once at startup
+def mark_interrupted():
+    get_writer().write("UPDATE jobs SET status = 'interrupted', finished_at = ? WHERE status IN ('queued', 'running')", [(_now(),)]).result()
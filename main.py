@@ -1,93 +1,281 @@
 import os    
 from os import scandir     # scandir() returns an iterator of DirEntry objects; a DirEntry object has attributes like name, path, is_file() [checks if its a file], is_dir() [checks if its a directory]
-from os.path import splitext, exists, join   # join combines paths with /
-import shutil   # shutil.move() is used to move files from source to destination: shutil is a high-level file operations library that provides functions for copying, moving, and deleting files and directories
-from time import sleep      
+from os.path import join   # join combines paths with /
+import hashlib
 import logging    
-# Watchdog: a python library that monitors folders for changes
-from watchdog.observers import Observer    # triggers events when files/folders change; Observer continuously watches a folder
-from watchdog.events import FileSystemEventHandler      # class to handle file system events like creation, modification, deletion
-from concurrent.futures import ThreadPoolExecutor    # for concurrent processing of multiple files (without this files will be moved sequentially ie. one at a time, which is slower)
-from datetime import datetime
-from db import get_connection, initialize_database
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, as_completed
+from db import initialize_database
+from catalog import get_catalog
 import time
+import claims
+import metrics    # counters/histograms exposed by the /metrics endpoint in api.py
+import rules
+
+# NOTE: importing this module has no side effects (no folders created, no logging configured, no threads started) so the API workers, the CLI (sorter.py)
+# and bench.py don't pay for things they don't use; whoever actually sorts files calls setup() first, and the watchdog parts live in watcher.py
 
 # BASE_DIR dynamically determines the project root directory so that all paths are relative to the project instead of being hardcoded.
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-LOG_FILE = os.path.join(BASE_DIR, "file_mover.log")
-
-# Logging configuration
-logging.basicConfig(
-    filename=LOG_FILE,   # logs will be written to the file named file_mover.log; this file is pure record-keeping (we nerver edit it manualy) it basically keeps a record of what files moved, when, or if something failed; for debugging and tracking purposes
-    level=logging.INFO,      # records INFO level and above (WARNING, ERROR, CRITICAL)
-    format='%(asctime)s - %(message)s',     # timestamp - message
-    datefmt='%Y-%m-%d %H:%M:%S')
+LOG_FILE = os.environ.get("FILE_SORTER_LOG", os.path.join(BASE_DIR, "file_mover.log"))
 
-# setup
-source_dir = os.path.join(BASE_DIR, "FileSorter")      
-dest_dir_music = os.path.join(source_dir, "Audio")
-dest_dir_video = os.path.join(source_dir, "Videos")
-dest_dir_image = os.path.join(source_dir, "Images")
-dest_dir_documents = os.path.join(source_dir, "Documents")
-dest_dir_others = os.path.join(source_dir, "Others")
+source_dir = os.environ.get("FILE_SORTER_DIR", os.path.join(BASE_DIR, "FileSorter"))      # FILE_SORTER_DIR lets us point the sorter at another folder (eg: the temp corpus used by bench.py)
+# where each kind of file goes is decided by the routing rules in rules.yaml (see rules.py); destinations are folders relative to source_dir
+# rules.yaml can also list several `intakes:` (one folder per team/scanner...), each with its own destinations and rules; without that list
+# source_dir is the only intake
 
-# making sure all directories exist at startup
-for folder in [source_dir, dest_dir_music, dest_dir_video, dest_dir_image, dest_dir_documents, dest_dir_others]:  
-    os.makedirs(folder, exist_ok=True)
+MAX_WORKERS = 4    # concurrent processing of 4 files (audio, video, image, document)
 
-image_extensions = [".jpg", ".jpeg", ".jpe", ".jif", ".jfif", ".jfi", ".png", ".gif", ".webp", ".tiff", ".tif",
-".psd", ".raw", ".arw", ".cr2", ".nrw", ".k25", ".bmp", ".dib", ".heif", ".heic", ".ind", ".indd", ".indt", ".jp2",
-".j2k", ".jpf", ".jpf", ".jpx", ".jpm", ".mj2", ".svg", ".svgz", ".ai", ".eps", ".ico"]
+EXPAND_ARCHIVES = os.environ.get("FILE_SORTER_ARCHIVES") == "1"    # sort the members of zip/tar drops too (see archives.py)
+HASH_CONTENT = os.environ.get("FILE_SORTER_HASH") == "1"    # record the sha256 of every file moved (GET /files/lookup?digest=); reads each file once
 
-video_extensions = [".webm", ".mpg", ".mp2", ".mpeg", ".mpe", ".mpv", ".ogg",
-                    ".mp4", ".mp4v", ".m4v", ".avi", ".wmv", ".mov", ".qt", ".flv", ".swf", ".avchd"]
+# reconciliation scans (see reconcile()) feed files left behind in an intake folder back into the queue at this pace, so catching up after
+# lost watcher events doesn't crowd out the live ones
+RECONCILE_RATE = 200                    # files per second
+RECONCILE_MIN_AGE = 2.0                 # seconds; younger files most likely still have their "created" event on the way
+RECONCILE_MAX_BACKLOG = MAX_WORKERS * 50    # pause the scan while this many files are already waiting
 
-audio_extensions = [".m4a", ".flac", ".mp3", ".wav", ".wma", ".aac"]
+_executor = None
+_executor_threads = MAX_WORKERS
+_processes = None     # procpool.ProcessPool in process-pool mode (see start_processes())
+_setup_lock = threading.Lock()
+_setup_done = False
 
-document_extensions = [".doc", ".docx", ".odt",
-                       ".pdf", ".xls", ".xlsx", ".ppt", ".pptx"]
 
-executor = ThreadPoolExecutor(max_workers=4)    # executor = ThreadPoolExecutor object for concurrent processing of 4 files (audio, video, image, document) 
-
-# function to make filename unique if it already exists ie. handle duplicates
-def make_unique(dest, name):
-    filename, extension = splitext(name)     # eg: file(1).txt on splitext gives filename = file(1), extension = .txt
-    counter = 1
+# one-time setup for anything that sorts files (the watcher, `sorter.py scan`, the API): logging configuration and the category folders
+def setup():
+    global _setup_done
+    with _setup_lock:
+        if _setup_done:
+            return
 
-    while exists(join(dest, name)):      # looping until no file exists with that name in the destination
-        name = f"{filename}({counter}){extension}"
-        counter += 1
-    return name
+        # Logging configuration
+        logging.basicConfig(
+            filename=LOG_FILE,   # logs will be written to the file named file_mover.log; this file is pure record-keeping (we nerver edit it manualy) it basically keeps a record of what files moved, when, or if something failed; for debugging and tracking purposes
+            level=logging.INFO,      # records INFO level and above (WARNING, ERROR, CRITICAL)
+            format='%(asctime)s - %(message)s',     # timestamp - message
+            datefmt='%Y-%m-%d %H:%M:%S')
+
+        # making sure all directories exist at startup
+        for intake in intakes():
+            os.makedirs(intake.path, exist_ok=True)
+            for folder in intake.rules.destinations():  
+                os.makedirs(join(intake.dest_root, folder), exist_ok=True)
+
+        _setup_done = True
+
+
+# the ThreadPoolExecutor is only created the first time someone needs it (the API, for example, moves files on its own request threads and never needs one)
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _setup_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor    # for concurrent processing of multiple files (without this files will be moved sequentially ie. one at a time, which is slower)
+                _executor = ThreadPoolExecutor(max_workers=_executor_threads)
+    return _executor
+
+
+# process-pool mode (see procpool.py; count defaults to FILE_SORTER_PROCESSES, 0 = off): relocate() runs relocate_file() in `count` worker
+# processes from then on. The worker threads then mostly wait on those, so there are enough of them - and enough files in flight - to keep
+# every process busy. Call it before the first file is queued (the executor's size is fixed once it exists)
+def start_processes(count=None):
+    global _processes, _executor_threads
+    import procpool
+    count = procpool.PROCESSES if count is None else count
+    with _setup_lock:
+        if _processes is not None or count <= 0:
+            return
+        _processes = procpool.ProcessPool(count)
+        _executor_threads = max(MAX_WORKERS, 2 * count)
+        _fair_queue.max_in_flight = 2 * _executor_threads
+    logging.info(f"[PROCPOOL] moving files in {count} worker processes")
+
+
+def stop_processes():
+    global _processes
+    with _setup_lock:
+        processes, _processes = _processes, None
+    if processes is not None:
+        processes.stop()
+
+
+# the intake folders currently configured (re-read on every call so a hot-reloaded rules.yaml applies to the next file)
+def intakes():
+    ruleset = rules.current()
+    return ruleset.intakes or [rules.Intake(os.path.basename(source_dir), os.path.abspath(source_dir), os.path.abspath(source_dir), ruleset)]
+
+
+# the intake a file was dropped into (the deepest one, in case intake folders are nested); None if it isn't in any
+def intake_for(file_path, configured=None):
+    configured = configured or intakes()
+    best = None
+    for intake in configured:
+        if intake.contains(file_path) and (best is None or len(intake.path) > len(best.path)):
+            best = intake
+    return best
+
+
+# Fair scheduling between intake folders: files are queued per intake and handed to the shared executor round-robin, with only a few more
+# files in the executor than there are workers. So a scanner dumping 50,000 files into one intake can't starve the others; every intake with
+# pending work gets the next free worker in turn
+class FairQueue:
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self._queues = OrderedDict()    # intake name -> deque of (future, file_path, func); order = whose turn it is
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._paths = {}     # file -> number of tasks queued or running for it (so reconciliation scans don't submit it twice)
+        self._idle = threading.Condition(self._lock)
+
+    # func: what the worker runs on the file (process_file unless the caller wants something else, eg: move_batch() and relocate)
+    def submit(self, key, file_path, func=None):
+        future = Future()
+        with self._lock:
+            self._queues.setdefault(key, deque()).append((future, file_path, func or process_file))
+            path = os.path.abspath(file_path)
+            self._paths[path] = self._paths.get(path, 0) + 1
+            self._pump()
+        return future
+
+    def __contains__(self, file_path):
+        return file_path in self._paths
+
+    def pending(self):
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    # blocks until nothing is queued or running (tasks may queue more tasks, eg: archive members)
+    def wait_idle(self):
+        with self._lock:
+            self._idle.wait_for(lambda: not self._paths)
+
+    # must be called with the lock held: hands queued files to the executor while there is room, one intake at a time
+    def _pump(self):
+        while self._in_flight < self.max_in_flight and self._queues:
+            key, pending = next(iter(self._queues.items()))
+            item = pending.popleft()
+            if pending:
+                self._queues.move_to_end(key)     # back of the line until every other intake had its turn
+            else:
+                del self._queues[key]
+            self._in_flight += 1
+            get_executor().submit(self._run, *item)
+
+    def _run(self, future, file_path, func):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(file_path))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                path = os.path.abspath(file_path)
+                if self._paths[path] == 1:
+                    del self._paths[path]
+                else:
+                    self._paths[path] -= 1
+                self._pump()
+                if not self._paths:
+                    self._idle.notify_all()
+
+
+_fair_queue = FairQueue(max_in_flight=MAX_WORKERS * 2)
+
+
+# queue a file for sorting (watcher events, scans); returns a Future with move_file()'s result (None for a file outside every intake: skipped)
+def submit(file_path, intake=None):
+    intake = intake or intake_for(os.path.abspath(file_path))
+    if intake is None:
+        logging.warning(f"[SKIPPED] {file_path}: not in any intake folder")
+        future = Future()
+        future.set_result(None)
+        return future
+    return _fair_queue.submit(intake.name, file_path)
+
+
+# True while the file is waiting for a worker or being sorted
+def is_queued(file_path):
+    return os.path.abspath(file_path) in _fair_queue
+
+
+def queue_depth():
+    return _fair_queue.pending() + (_executor._work_queue.qsize() if _executor is not None else 0)
+
+
+# number of files submitted but not yet picked up by a worker thread (read only when /metrics is scraped)
+metrics.gauge("sorter_executor_queue_depth", "Files waiting for a free worker thread", queue_depth)
 
 
 # dest here is the respective folder where the file is to be moved (ie. Music, Video, Image, Document)
 # The source is always the top-level FileSorter folder (where the file is intially placed). The destination is the proper subfolder inside FileSorter (where the file is eventually moved to)
 
-def move_file(file_path):
+# expand=False: sort an archive as a plain file even when FILE_SORTER_ARCHIVES is on (archives.py does that once its members are sorted)
+# outside: see relocate_file(). source: what the catalog records as where the file came from, when that isn't file_path (eg: an upload staged
+# under an internal name: the folder it was uploaded to + its name)
+def move_file(file_path, name=None, expand=True, outside=False, source=None):
+    if expand and EXPAND_ARCHIVES:
+        import archives     # zipfile/tarfile only get loaded when the feature is on
+        if archives.is_archive(name or os.path.basename(file_path)):
+            file_path = os.path.abspath(file_path)
+            intake = intake_for(file_path) or (intakes()[0] if outside else None)
+            if intake is None:
+                logging.warning(f"[SKIPPED] {file_path}: not in any intake folder")
+                return
+            claimed = claims.claim(intake, file_path)     # expanded by one instance only (the archive is then sorted from its claim folder)
+            if claimed is None:
+                return
+            try:
+                expanded = archives.expand(claimed, intake, name or os.path.basename(file_path), outside, source)
+            except BaseException:
+                claims.release(intake, claimed)
+                raise
+            if expanded is not None:
+                return expanded
+            file_path = claimed
+
+    moved = relocate(file_path, name, outside)
+    if moved is None:
+        return
+    row, size, start_time = moved
+    if source is not None:
+        row = (row[0], row[1], source, *row[3:])
+
+    # the catalog commits rows from all workers/intakes in batches; waiting here means the row is committed when move_file returns
+    get_catalog().insert(row, (size, time.time() - start_time)).result()
+    return record_move(row, size, start_time)
+
+
+# the file system half of move_file(): picks the destination and moves the file there (claims.place(): a hard link when it stays on the same file system)
+# returns (move row, size in bytes, start time), or None if there was nothing to move; writing the row is up to the caller, so batch
+# moves (move_batch()) can commit thousands of rows in one transaction. name: what the file is called at its destination (and classified as)
+# when that isn't its current name (eg: a finished resumable upload, see uploads.py). A file outside every intake is skipped, unless `outside`
+# says the API handed it over on purpose (uploads, /move-batch from FILE_SORTER_BATCH_ROOTS...): those are sorted by the first intake's rules
+def relocate_file(file_path, name=None, outside=False):
     start_time = time.time()   # to find time taken to move the file and log it
 
     file_path = os.path.abspath(file_path)
-    name = os.path.basename(file_path)
+    intake = intake_for(file_path)
+    if intake is None:
+        if not outside:
+            logging.warning(f"[SKIPPED] {file_path}: not in any intake folder")
+            return
+        intake = intakes()[0]
+    source = claims.origin(intake, file_path)     # where a file this instance had already claimed (eg: an expanded archive) was dropped
+    name = name or os.path.basename(source)
 
     if name.startswith("."):  # skip hidden files like .DS_Store
         return
 
-    ext = os.path.splitext(name)[1].lower()
-    if ext in audio_extensions:
-        dest = dest_dir_music
-        file_type = "Audio"
-    elif ext in video_extensions:
-        dest = dest_dir_video
-        file_type = "Video"
-    elif ext in image_extensions:
-        dest = dest_dir_image
-        file_type = "Image"
-    elif ext in document_extensions:
-        dest = dest_dir_documents
-        file_type = "Document"
-    else:
-        dest = dest_dir_others
-        file_type = "Unknown"
+    try:
+        rule = intake.rules.classify(name, file_path)    # first matching routing rule (extension, name pattern, size, age, sniffed type...)
+    except FileNotFoundError:    # another sorter instance got it first (see claims.py)
+        return
+    dest = os.path.normpath(join(intake.dest_root, rule.dest))
+    file_type = rule.file_type
 
     os.makedirs(dest, exist_ok=True)    # make sure destination folder exists (it should already exist from the setup code, but this is just to be safe in case something deleted it or if we add new file types in the future with new folders) exist_ok=True means it will not raise an error if the folder already exists, it will just do nothing and continue; this ensures that the script does not crash if the folder is already there, and it also ensures that the folder is created if it is missing for some reason, making the script more robust and reliable
 
@@ -96,69 +284,184 @@ def move_file(file_path):
         logging.info(f"File already in destination: {name}")
         return
 
-    if exists(join(dest, name)):    # if a file with the same name already exists in the destination folder, we need to make the new file's name unique to avoid overwriting the existing file
-        name = make_unique(dest, name)
+    # other sorter instances may be working this intake too: the file is first renamed into our claim folder (None: one of them was quicker),
+    # then linked into the destination under a name nobody has - a name clash can't overwrite a file another instance just placed there
+    claimed = claims.claim(intake, file_path)
+    if claimed is None:
+        logging.info(f"[SKIPPED] {name}: claimed by another instance")
+        return
+    try:
+        size = os.path.getsize(claimed)    # recorded for the bytes-moved metric
+        digest = file_digest(claimed) if HASH_CONTENT else None
+
+        # Move the file
+        name = claims.place(claimed, dest, name)    # the first free name of name, name(1), name(2)... (duplicates never overwrite each other)
+    except BaseException:
+        claims.release(intake, claimed)     # back where it was dropped, for the next try
+        raise
+    dest_path = os.path.join(dest, name)
+    logging.info(f"[MOVED] {name} -> {dest_path}")
 
-    dest_path = os.path.join(dest, name)    # final destination path for the file (after ensuring uniqueness if needed)
+    return (name, file_type, source, dest_path, time.time_ns(), digest), size, start_time
 
-    # Move the file
-    shutil.move(file_path, dest_path)
-    logging.info(f"[MOVED] {name} -> {dest_path}")
 
-    conn = get_connection()
-    cursor = conn.cursor()
+# relocate_file() in a worker process in process-pool mode (same result, exceptions included), on this thread otherwise
+def relocate(file_path, name=None, outside=False):
+    processes = _processes
+    if processes is not None:
+        return processes.relocate(file_path, name, outside)
+    return relocate_file(file_path, name, outside)
 
-    cursor.execute("""
-            INSERT INTO files_table (filename, file_type, source_path, destination_path, moved_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (name, file_type, file_path, dest_path, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    
-    conn.commit()
-    conn.close()
 
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+# timing line + metrics for a file whose row has been committed; returns what move_file() returns
+def record_move(row, size, start_time):
+    name, file_type, _, dest_path = row[:4]
     end_time = time.time()   # end timer
     print(f"[TIME] {name} processed in {end_time - start_time:.4f} sec")    
 
-    return {"filename": name, "file_type": file_type, "destination": dest_path}
+    metrics.inc("sorter_files_moved_total", category=file_type)
+    metrics.inc("sorter_bytes_moved_total", size, category=file_type)
+    metrics.observe("sorter_move_seconds", end_time - start_time, category=file_type)
 
+    return {"filename": name, "file_type": file_type, "destination": dest_path}
 
-class MoverHandler(FileSystemEventHandler):      # base class to respond to file system events; its job is to define what should happen when files change in the folder
 
-# on_created() is a method of the MoverHandler class that is called automatically by the Watchdog library whenever a new file is created in the monitored folder (source_dir). It receives an event object that contains information about the file creation event, such as the path of the new file and whether it is a directory or a file. This method checks if the event is for a file (not a directory) and then submits the file to be processed by the move_file() function in a separate thread using executor.submit(). 
-    def on_created(self, event):     # triggered when a new file is created in the monitored folder 
-# event eg: FileSorter/photo.jpg        
-        if event.is_directory:      # ignore folders (.is_directory is for folders, we only want to process files)
-            return
+# wrapper used for everything submitted to the executor: exceptions raised inside a ThreadPoolExecutor are stored on the (ignored) future and never
+# show up anywhere, so we log and count them here instead
+def process_file(file_path, expand=True, name=None, outside=False, source=None):
+    try:
+        return move_file(file_path, name=name, expand=expand, outside=outside, source=source)
+    except Exception:
+        metrics.inc("sorter_errors_total", stage="move")
+        logging.exception(f"[ERROR] failed to process {file_path}")
+
+
+# the files waiting to be sorted in an intake folder (only its top level; the subfolders are the destinations)
+def intake_files(intake):
+    if not os.path.isdir(intake.path):
+        return []
+    with scandir(intake.path) as entries:
+        return [entry.path for entry in entries if not entry.name.startswith(".") and entry.is_file()]
+
+
+# Processes/works for all files ALREADY present in the intake folders at startup/before ie. when the watcher was not running yet
+def process_existing_files():
+    futures = []
+    for intake in intakes():
+        claims.recover(intake)      # files a dead instance had claimed but not moved are back in the intake for the listing below
+        for file_path in intake_files(intake):
+            futures.append(submit(file_path, intake))
+    return futures
+
+
+# Batch move of files that are already on the server (eg: an NFS drop) for the API: the moves go through the shared workers as their own
+# round-robin lane `key` (so a batch of 10,000 files doesn't starve the intakes), and all the rows are committed in ONE transaction at the end.
+# progress(moved, failed) is called as files finish; once `cancelled` (a threading.Event) is set the files not started yet are dropped (the ones
+# already moved are still recorded). Paths outside the intakes (FILE_SORTER_BATCH_ROOTS) are sorted by the first intake's rules. staged:
+# path -> (name, source) for files staged under another name (eg: background uploads): sorted as `name`, recorded as coming from `source`
+# (like move_file()'s name and source). Returns (moved, failed)
+def move_batch(paths, key="batch", progress=None, cancelled=None, staged=None):
+    staged = staged or {}
+    futures = {_fair_queue.submit(key, path, lambda path: relocate(path, staged.get(path, (None,))[0], outside=True)): path for path in paths}
+    moved = []
+    failed = 0
+    for future in as_completed(futures):
+        if cancelled is not None and cancelled.is_set():
+            for each in futures:
+                each.cancel()       # only succeeds for files still waiting in the queue
+            cancelled = None
+        if future.cancelled():
+            continue
+        try:
+            result = future.result()
+        except Exception:
+            failed += 1
+            metrics.inc("sorter_errors_total", stage="batch")
+            logging.exception(f"[ERROR] failed to move {futures[future]}")
+        else:
+            if result is not None:
+                row, size, start_time = result
+                if futures[future] in staged:
+                    row = (row[0], row[1], staged[futures[future]][1], *row[3:])
+                moved.append((row, size, start_time, time.time()))     # finished at: the rollups get how long the move itself took, not the whole batch
+        if progress is not None:
+            progress(len(moved), failed)
+
+    if moved:
+        get_catalog().insert_many([row for row, _, _, _ in moved], [(size, end_time - start_time) for _, size, start_time, end_time in moved]).result()
+        for row, size, start_time, _ in moved:
+            record_move(row, size, start_time)
+    return len(moved), failed
+
+
+# Reconciliation scan: queues the files still sitting in an intake folder that the watcher never reported (the kernel's inotify queue overflowed
+# under a burst, the watch died, ...). It is incremental - the listing is consumed as it goes and only the intake root is read, not the
+# destination folders - and rate-limited (token bucket of RECONCILE_RATE files/s, paused while the queue is backed up) so it doesn't fight the
+# live event stream. Files already queued and files younger than min_age (their event is most likely still coming) are skipped.
+# Returns (files submitted, files skipped for being too new)
+def reconcile(intake, reason="sweep", rate=RECONCILE_RATE, min_age=RECONCILE_MIN_AGE, stop=None):
+    submitted = recent = 0
+    if not os.path.isdir(intake.path):
+        return submitted, recent
+    claims.recover(intake)      # files claimed by instances whose lease ran out go back into the intake first (see claims.py)
+
+    interval = 1.0 / rate
+    next_at = time.monotonic()
+    cutoff = time.time() - min_age
+    with scandir(intake.path) as entries:
+        for entry in entries:
+            if stop is not None and stop.is_set():
+                break
+            if entry.name.startswith(".") or entry.path in _fair_queue:
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                if entry.stat().st_ctime > cutoff:    # ctime, not mtime: a file moved in keeps its old mtime
+                    recent += 1
+                    continue
+            except FileNotFoundError:     # sorted (or removed) while we were listing
+                continue
 
-        file_path = event.src_path   # get path of the created file 
-        print(f"[EVENT DETECTED] New file: {file_path}")
+            while queue_depth() > RECONCILE_MAX_BACKLOG and not (stop is not None and stop.is_set()):
+                time.sleep(0.05)
+            now = time.monotonic()
+            if next_at > now:
+                time.sleep(next_at - now)
+            next_at = max(next_at, now - 1.0) + interval     # at most one second's worth of tokens saved up while idle
 
-        executor.submit(move_file, file_path)   # this sends the file to move_file() to be processed in a separate thread, allowing the main thread to continue monitoring for new events without delay; move_file() will handle moving the file to the correct subfolder and logging the action; using executor.submit() allows us to process multiple files concurrently if they are created in quick succession improving performance             
+            submit(entry.path, intake)
+            submitted += 1
 
-# Processes/works for all files ALREADY present in source_dir at startup/before ie. when script has not yet started running
-    def process_existing_files(self):
-        with scandir(source_dir) as entries:
-            for entry in entries:
-                if entry.name.startswith(".") or not entry.is_file():
-                    continue
+    if submitted:
+        metrics.inc("sorter_reconciled_files_total", submitted, reason=reason)
+        logging.info(f"[RECONCILE] {intake.name}: queued {submitted} file(s) missed by the watcher ({reason})")
+    return submitted, recent
 
-                executor.submit(move_file, entry.path)   
-                
 
+metrics.counter("sorter_reconciled_files_total", "Files found and queued by reconciliation scans instead of watcher events")
 
-if __name__ == "__main__":        # only runs if this python file is executed directly (like python main.py); if this file is imported as a module in another file, the code inside this block will not run (which was the motive, to prevent the script from running when imported)
-    initialize_database()   # initializes the database and creates the files_table if it doesn't already exist; this ensures that the database is ready to store file information before we start monitoring for file changes
-    event_handler = MoverHandler()    # creates an object of MoverHandler class (inherits from Watchdog); it is passed to observer.schedule() so that the observer knows which handler to call when files change
-    event_handler.process_existing_files()  # process files already in folder
-    observer = Observer()       # creates an observer object to observe the source_dir
-    observer.schedule(event_handler, source_dir, recursive=True)     # schedules the event handler to monitor source_dir; recursive=True means it will monitor all subdfolders of source_dir too (basically telling telling Observer to watch this folder and When something happens, send events to event_handler)
-    observer.start()       # starts monitoring the thread
-    print(f"Monitoring {source_dir} ...")
 
+# one-off sort of whatever is currently in the intake folders (`python sorter.py scan`); waits until every file has been handled
+def scan():
+    setup()
+    initialize_database()
+    start_processes()
     try:
-        while True:   # keeps the main thread alive to allow the observer to keep running and monitoring for file changes; without this loop, the main thread would exit immediately after starting the observer, which would stop the observer from working; this loop keeps the program running infinitely until the user decides to stop it (like by pressing Ctrl+C)
-            sleep(1)     # main thread sleeps for 1 second and then checks again; to not consume too much CPU
-    except KeyboardInterrupt:   # if user presses Ctrl+C to stop the program
-        observer.stop()
-    observer.join()     # waits for the observer thread to finish completely before exiting the program; without join() the program might exit immediately and leave Watchdog threads hanging  
-     
+        futures = process_existing_files()
+        for future in futures:
+            future.result()
+        _fair_queue.wait_idle()     # work the files queued themselves (eg: the members of an archive)
+    finally:
+        stop_processes()
+    return len(futures)
+
+
+if __name__ == "__main__":        # only runs if this python file is executed directly (like python main.py); kept so `python main.py` still starts the watcher (same as `python sorter.py watch`)
+    import watcher
+    watcher.run()
@@ -0,0 +1,132 @@
+import threading
+from bisect import bisect_left
+
+# Tiny in-process metrics registry rendered in the Prometheus text exposition format (served by GET /metrics in api.py)
+# Hot paths (move_file, the watcher, the db writes) only ever touch a dict that belongs to their OWN thread, so recording a metric never takes a lock
+# and never contends with other workers; scraping just walks every thread's dict and adds the values up
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)    # seconds
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)     # used for batch sizes (rows per db commit)
+
+_local = threading.local()    # each thread gets its own shard (a plain dict) stored here
+_shards = []                  # every shard ever created, so render() can sum them up
+_shards_lock = threading.Lock()   # only taken once per thread (when its shard is created), never on the recording path
+
+_metadata = {}    # metric name -> (type, help text)
+_gauges = {}      # metric name -> function returning the current value (evaluated at scrape time, eg: executor queue depth)
+_buckets = {}     # histogram name -> bucket upper bounds
+
+
+def _shard():
+    try:
+        return _local.shard
+    except AttributeError:      # first metric recorded by this thread
+        shard = {}
+        with _shards_lock:
+            _shards.append(shard)
+        _local.shard = shard
+        return shard
+
+
+def counter(name, help_text):
+    _metadata[name] = ("counter", help_text)
+
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS):
+    _metadata[name] = ("histogram", help_text)
+    _buckets[name] = tuple(buckets)
+
+
+def gauge(name, help_text, func):
+    _metadata[name] = ("gauge", help_text)
+    _gauges[name] = func
+
+
+def inc(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    shard = _shard()
+    shard[key] = shard.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    shard = _shard()
+    hist = shard.get(key)
+    if hist is None:
+        buckets = _buckets[name]
+        hist = shard[key] = [0] * (len(buckets) + 1) + [0.0]    # one slot per bucket, one for +Inf, and the running sum at the end
+    hist[bisect_left(_buckets[name], value)] += 1
+    hist[-1] += value
+
+
+# label values can be anything (eg: a category name from rules.yaml); the exposition format needs backslashes, " and newlines escaped in them
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _collect():
+    totals = {}
+    with _shards_lock:
+        shards = list(_shards)
+    for shard in shards:
+        for key, value in list(shard.items()):     # list() copies the items in one go so another thread adding a key can't break the loop
+            if isinstance(value, list):
+                merged = totals.get(key)
+                if merged is None:
+                    totals[key] = list(value)
+                else:
+                    totals[key] = [a + b for a, b in zip(merged, value)]
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def render():
+    totals = _collect()
+    lines = []
+
+    for name, (metric_type, help_text) in sorted(_metadata.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+        if metric_type == "gauge":
+            try:
+                lines.append(f"{name} {_gauges[name]()}")
+            except Exception:     # a broken gauge callback should not take the whole scrape down
+                pass
+            continue
+
+        for (metric, labels), value in sorted(totals.items()):
+            if metric != name:
+                continue
+            if metric_type == "counter":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+
+            # histograms are exported cumulatively, like Prometheus expects
+            cumulative = 0
+            for bound, count in zip(_buckets[name], value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            cumulative += value[-2]
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    return "\n".join(lines) + "\n"
+
+
+# metrics recorded by the sorter (main.py / db.py); declared here so they show up in /metrics even before the first file is moved
+counter("sorter_files_moved_total", "Files moved, by category")
+counter("sorter_bytes_moved_total", "Bytes moved, by category")
+counter("sorter_watcher_events_total", "File system events received by the watcher")
+counter("sorter_errors_total", "Errors raised while processing files, by stage")
+histogram("sorter_move_seconds", "Time taken by move_file, by category")
+histogram("sorter_db_batch_rows", "Rows written per database commit", buckets=SIZE_BUCKETS)
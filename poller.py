@@ -0,0 +1,140 @@
+import os
+import time
+from watchdog.events import DirCreatedEvent, DirDeletedEvent, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent
+from watchdog.observers.api import BaseObserver, EventEmitter
+import metrics
+
+# Polling watcher backend for network file systems (NFS/SMB mounts don't deliver inotify/FSEvents, so the normal Observer never fires there)
+# watchdog's own PollingObserver re-lists the WHOLE tree every interval, so its cost grows with the number of files. This one keeps a compact
+# snapshot per directory - {name: (inode, size, mtime_ns)} plus the directory's own mtime - and on every pass only stat()s the directories:
+# creating, deleting or renaming an entry bumps its parent directory's mtime, so only directories whose mtime changed are re-listed with
+# scandir and diffed. The cost of a pass is one stat per directory plus work proportional to what actually changed.
+# The differences come out as ordinary watchdog events (FileCreatedEvent, ...) so MoverHandler and the rest of the pipeline don't change.
+# Note: in-place edits of an existing file don't touch the directory mtime, so they are only noticed when that directory is re-listed anyway
+
+DEFAULT_INTERVAL = 2.0    # seconds between passes
+
+
+class IncrementalPollingEmitter(EventEmitter):
+    # directories modified this recently are re-listed even if their mtime looks unchanged: a second change within the file system's mtime
+    # granularity (1-2 s on some NFS servers) would otherwise leave the mtime identical and go unnoticed
+    RACY_WINDOW_NS = 2_000_000_000
+
+    def __init__(self, event_queue, watch, *, timeout=DEFAULT_INTERVAL, event_filter=None):
+        super().__init__(event_queue, watch, timeout=timeout, event_filter=event_filter)
+        self._dirs = {}     # directory path -> (directory mtime_ns, {name: (inode, size, mtime_ns, is_dir)})
+        self._created = {}  # inode -> path of files that appeared during the current pass
+        self._deleted = {}  # inode -> path of files that disappeared during the current pass
+
+    def on_thread_start(self):
+        try:
+            self._rescan(self.watch.path, os.stat(self.watch.path).st_mtime_ns, emit=False)
+        except OSError:
+            pass
+
+    def queue_events(self, timeout):
+        if self.stopped_event.wait(timeout):     # timeout works as the polling interval
+            return
+
+        if not self._dirs:      # root didn't exist (yet) when we started
+            self.on_thread_start()
+            return
+
+        now = time.time_ns()
+        for path in list(self._dirs):
+            if path not in self._dirs:      # dropped while handling a parent earlier in this pass
+                continue
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                self._forget(path)
+                continue
+            except OSError:
+                metrics.inc("sorter_errors_total", stage="poll")
+                continue
+
+            if mtime_ns != self._dirs[path][0] or now - mtime_ns < self.RACY_WINDOW_NS:
+                self._rescan(path, mtime_ns, emit=True)
+
+        # a file that vanished from one directory and showed up in another with the same inode was renamed (eg: moved into Images/ by the
+        # sorter itself); report it as a move like inotify does, instead of a "new file" that would be fed to the sorter again
+        for inode, dest_path in self._created.items():
+            src_path = self._deleted.pop(inode, None)
+            if src_path is not None:
+                self.queue_event(FileMovedEvent(src_path, dest_path))
+            else:
+                self.queue_event(FileCreatedEvent(dest_path))
+        for src_path in self._deleted.values():
+            self.queue_event(FileDeletedEvent(src_path))
+        self._created = {}
+        self._deleted = {}
+
+    # re-lists one directory, emits the differences against its previous snapshot and recurses into new subdirectories
+    def _rescan(self, path, mtime_ns, emit):
+        metrics.inc("sorter_poll_rescans_total")
+        old_entries = self._dirs.get(path, (None, {}))[1]
+        entries = {}
+        try:
+            with os.scandir(path) as listing:
+                for entry in listing:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            entries[entry.name] = (entry.inode(), 0, 0, True)
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            entries[entry.name] = (st.st_ino, st.st_size, st.st_mtime_ns, False)
+                    except FileNotFoundError:      # removed between the listing and the stat
+                        continue
+        except FileNotFoundError:
+            self._forget(path)
+            return
+        self._dirs[path] = (mtime_ns, entries)
+
+        for name, info in entries.items():
+            full_path = os.path.join(path, name)
+            old = old_entries.get(name)
+            is_dir = info[3]
+
+            if is_dir:
+                if self.watch.is_recursive and (old is None or old[0] != info[0] or full_path not in self._dirs):
+                    if emit:
+                        self.queue_event(DirCreatedEvent(full_path))
+                    try:
+                        self._rescan(full_path, os.stat(full_path).st_mtime_ns, emit)
+                    except FileNotFoundError:
+                        pass
+                continue
+
+            if emit:
+                if old is None or old[0] != info[0] or old[3]:     # new name, or a different file (inode) under the same name
+                    self._created[info[0]] = full_path
+                    if old is not None and not old[3]:
+                        self._deleted[old[0]] = full_path
+                elif old[1:3] != info[1:3]:
+                    self.queue_event(FileModifiedEvent(full_path))
+
+        for name, old in old_entries.items():
+            if name in entries and entries[name][3] == old[3]:
+                continue
+            full_path = os.path.join(path, name)
+            if old[3]:
+                self._forget(full_path)
+                if emit:
+                    self.queue_event(DirDeletedEvent(full_path))
+            elif emit:
+                self._deleted[old[0]] = full_path
+
+    # drops a directory and everything below it from the snapshot
+    def _forget(self, path):
+        prefix = path + os.sep
+        for known in [known for known in self._dirs if known == path or known.startswith(prefix)]:
+            del self._dirs[known]
+
+
+# drop-in replacement for watchdog's Observer: schedule()/start()/stop() work the same, handlers receive the same events
+class IncrementalPollingObserver(BaseObserver):
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        super().__init__(IncrementalPollingEmitter, timeout=interval)     # the observer hands its timeout to every emitter = the polling interval
+
+
+metrics.counter("sorter_poll_rescans_total", "Directories re-listed by the polling watcher")
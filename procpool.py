@@ -0,0 +1,161 @@
+import os
+import time
+import zlib
+import signal
+import logging
+import itertools
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import Future
+import metrics
+import rules
+
+# Process-pool mode (FILE_SORTER_PROCESSES=N or `sorter.py watch/scan --processes N`): the CPU-bound half of a move - classifying the file
+# (sniffing its first bytes), hashing it (FILE_SORTER_HASH=1) and the move itself, ie main.relocate_file() - runs in N worker processes
+# instead of the threads of this one, which all share one GIL. Everything else stays here: the watcher, the fair queue and its threads (they
+# now only hand files over and wait), and the single catalog writer the rows come back to, so the database still has exactly one writer.
+# - files are partitioned by a hash of their path: the same file always goes to the same process, so two processes never race on one file
+# - each process has a pipe for its requests and one for its results; a collector thread here resolves the waiting threads' Futures
+# - a process that dies fails the moves it had in hand (they are left in the intake, for the next reconciliation scan) and is replaced
+# - rules.yaml reloads are passed on to every process
+# Workers are started with "spawn", not fork: this process runs threads (db writer, observer...) whose locks a forked child could inherit
+# held; so they import main themselves and see the same FILE_SORTER_* environment
+
+PROCESSES = int(os.environ.get("FILE_SORTER_PROCESSES", "0"))     # 0 = no worker processes, moves run on main's threads
+RESTART_DELAY = 1.0     # seconds before replacing a dead worker (so one that dies on startup isn't restarted in a tight loop)
+
+
+class ProcessPool:
+    def __init__(self, processes):
+        self._context = multiprocessing.get_context("spawn")
+        self._ids = itertools.count()
+        self._lock = threading.Lock()   # _pending and _workers
+        self._pending = {}      # task id -> (Future, index of the worker that has it)
+        self._workers = [Worker(self._context) for _ in range(processes)]
+        self._stopping = False
+        self._collector = threading.Thread(target=self._collect, name="procpool-collector", daemon=True)
+        self._collector.start()
+        rules.listeners.append(self._reload_rules)
+
+    def __len__(self):
+        return len(self._workers)
+
+    # main.relocate_file(file_path, name, outside) in the worker process for that path; blocks until it is done and returns (or raises) what it did
+    def relocate(self, file_path, name=None, outside=False):
+        file_path = os.path.abspath(file_path)
+        index = zlib.crc32(os.fsencode(file_path)) % len(self._workers)
+        future = Future()
+        task_id = next(self._ids)
+        with self._lock:
+            self._pending[task_id] = (future, index)
+            worker = self._workers[index]
+        try:
+            worker.send((task_id, file_path, name, outside))
+        except OSError:     # died just now (the collector fails its other moves and replaces it)
+            with self._lock:
+                self._pending.pop(task_id, None)
+            raise
+        return future.result()
+
+    def stop(self):
+        self._stopping = True
+        if self._reload_rules in rules.listeners:
+            rules.listeners.remove(self._reload_rules)
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.process.join(timeout=5)
+
+    def _reload_rules(self, path):
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            worker.send(("rules", path))
+
+    def _collect(self):
+        while not self._stopping:
+            with self._lock:
+                workers = list(self._workers)
+            ready = wait([worker.results for worker in workers] + [worker.process.sentinel for worker in workers], timeout=1.0)
+            for index, worker in enumerate(workers):
+                if worker.results in ready:
+                    try:
+                        while worker.results.poll():
+                            task_id, result, error = worker.results.recv()
+                            with self._lock:
+                                future, _ = self._pending.pop(task_id)
+                            if error is not None:
+                                future.set_exception(error)
+                            else:
+                                future.set_result(result)
+                        continue
+                    except (EOFError, OSError):    # the process is gone; handled below
+                        pass
+                if worker.process.sentinel in ready or not worker.process.is_alive():
+                    if self._stopping:
+                        return
+                    self._replace(index, worker)
+
+    def _replace(self, index, dead):
+        logging.error(f"[PROCPOOL] worker process {dead.process.pid} exited with code {dead.process.exitcode}; starting a new one")
+        metrics.inc("sorter_errors_total", stage="procpool")
+        metrics.inc("sorter_worker_restarts_total")
+        with self._lock:
+            lost = [task_id for task_id, (_, owner) in self._pending.items() if owner == index]
+            failed = [self._pending.pop(task_id)[0] for task_id in lost]
+        for future in failed:
+            future.set_exception(RuntimeError(f"worker process exited with code {dead.process.exitcode}"))
+        time.sleep(RESTART_DELAY)
+        replacement = Worker(self._context)
+        with self._lock:
+            self._workers[index] = replacement
+
+
+# one worker process and its two pipes (requests: this process -> it, results: it -> this process)
+class Worker:
+    def __init__(self, context):
+        requests_out, self.requests = context.Pipe(duplex=False)
+        self.results, results_in = context.Pipe(duplex=False)
+        self.process = context.Process(target=work, args=(requests_out, results_in), name="sorter-worker", daemon=True)
+        self.process.start()
+        requests_out.close()
+        results_in.close()
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:    # Connection objects aren't thread-safe
+            self.requests.send(message)
+
+
+# the worker process: relocate requests until it gets None
+def work(requests, results):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # Ctrl+C is for the parent, which stops the pool
+    import main
+    main.setup()    # logging into the same file, category folders
+    while True:
+        try:
+            message = requests.recv()
+        except EOFError:    # the parent is gone
+            return
+        if message is None:
+            return
+        if message[0] == "rules":
+            rules.reload(message[1])
+            continue
+        task_id, file_path, name, outside = message
+        try:
+            results.send((task_id, main.relocate_file(file_path, name, outside), None))
+        except Exception as e:
+            try:
+                results.send((task_id, None, e))
+            except Exception:     # an exception that can't be pickled
+                results.send((task_id, None, RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+metrics.counter("sorter_worker_restarts_total", "Worker processes (process-pool mode) that died and were replaced")
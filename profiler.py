@@ -0,0 +1,115 @@
+import os
+import sys
+import threading
+import time
+import logging
+from collections import Counter
+from datetime import datetime
+
+# Opt-in sampling profiler for the running sorter (off unless FILE_SORTER_PROFILING=1)
+# Once triggered (kill -USR1 <pid> on the daemon, or POST /debug/profile on the API) a background thread grabs the stack of every other thread
+# (executor workers, watchdog observer/emitter threads, ...) every few milliseconds for N seconds. Nothing is instrumented, so the overhead is just
+# the sampling thread itself. When the time is up it writes:
+#   profile-<timestamp>.folded       -> collapsed stacks ("thread;outer;inner count"), feed it to flamegraph.pl or speedscope for a flamegraph
+#   profile-<timestamp>.summary.txt  -> cumulative (inclusive) and self time per function for move_file and everything it calls
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILE_DIR = os.environ.get("FILE_SORTER_PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))
+ENABLED = os.environ.get("FILE_SORTER_PROFILING", "").lower() in ("1", "true", "yes")
+
+DEFAULT_SECONDS = 30
+DEFAULT_INTERVAL = 0.005    # 200 samples/sec per thread
+FOCUS_FUNCTION = "move_file"
+
+_lock = threading.Lock()
+_running = None    # the sampler thread currently running (only one profile at a time)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample(seconds, interval):
+    stacks = Counter()
+    me = threading.get_ident()
+    deadline = time.perf_counter() + seconds
+    samples = 0
+
+    while time.perf_counter() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            stacks[tuple(reversed(stack))] += 1     # root (thread name) first, leaf last
+        samples += 1
+        time.sleep(interval)
+
+    return stacks, samples
+
+
+# inclusive/self time of FOCUS_FUNCTION and every function below it, from the stacks that went through it
+def _summarize(stacks, interval):
+    inclusive = Counter()
+    exclusive = Counter()
+    for stack, count in stacks.items():
+        start = next((i for i, label in enumerate(stack) if label.startswith(FOCUS_FUNCTION + " ")), None)
+        if start is None:
+            continue
+        for label in set(stack[start:]):     # set(): recursion should not count the same sample twice
+            inclusive[label] += count
+        exclusive[stack[-1]] += count
+
+    lines = [f"{'cumulative_s':>12} {'self_s':>10}  function"]
+    for label, count in inclusive.most_common():
+        lines.append(f"{count * interval:>12.3f} {exclusive[label] * interval:>10.3f}  {label}")
+    if len(lines) == 1:
+        lines.append(f"(no samples inside {FOCUS_FUNCTION} - nothing was being sorted while profiling)")
+    return "\n".join(lines) + "\n"
+
+
+def _run(seconds, interval, base_path):
+    global _running
+    try:
+        stacks, samples = _sample(seconds, interval)
+        with open(base_path + ".folded", "w") as f:
+            for stack, count in stacks.items():
+                f.write(";".join(label.replace(";", ":") for label in stack) + f" {count}\n")
+        with open(base_path + ".summary.txt", "w") as f:
+            f.write(f"# {samples} samples every {interval * 1000:.1f} ms over {seconds} s\n")
+            f.write(_summarize(stacks, interval))
+        logging.info(f"[PROFILE] written to {base_path}.folded / .summary.txt")
+    except Exception:
+        logging.exception("[PROFILE] profiling failed")
+    finally:
+        with _lock:
+            _running = None
+
+
+# starts a profile in the background and returns the path prefix of the files it will write (or None if one is already running)
+def start(seconds=DEFAULT_SECONDS, interval=DEFAULT_INTERVAL):
+    global _running
+    with _lock:
+        if _running is not None:
+            return None
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base_path = os.path.join(PROFILE_DIR, datetime.now().strftime("profile-%Y%m%d-%H%M%S"))
+        _running = threading.Thread(target=_run, args=(seconds, interval, base_path), name="profiler", daemon=True)
+        _running.start()
+    logging.info(f"[PROFILE] sampling all threads for {seconds} s")
+    return base_path
+
+
+# lets an operator trigger a profile of the daemon with `kill -USR1 <pid>` (no-op on platforms without SIGUSR1, eg: Windows)
+def install_signal_handler():
+    import signal
+
+    if not hasattr(signal, "SIGUSR1"):
+        return False
+    signal.signal(signal.SIGUSR1, lambda signum, frame: start())
+    return True
@@ -0,0 +1,242 @@
+import os
+import gzip
+import json
+import time
+import fcntl
+import logging
+import sqlite3
+import threading
+from datetime import date, datetime
+import db
+import catalog
+import metrics
+
+# Retention of the move history, so files_table (and with it the database file, its backups and every query over it) stops growing forever:
+# - `files` only keeps the last HOT_MONTHS calendar months. Older rows are moved, one month per partition, into their own database file
+#   history/files_YYYY-MM.db (as plain text rows in the files_table columns, readable without the main database), CHUNK_ROWS at a time
+#   through the db writer (each chunk is a short writer call of its own, so the moves queued meanwhile are committed in between instead of
+#   waiting for a whole month to be copied)
+# - connect() attaches the partitions of the last ATTACHED_MONTHS months before that and adds a files_history view spanning them and
+#   files_table (GET /files?history=true); the /stats rollups keep covering everything, they are never trimmed
+# - partitions older than that are exported to history/files_YYYY-MM.ndjson.gz (one JSON object per row) and their .db removed
+# - the pages freed in the main database are given back with PRAGMA incremental_vacuum, VACUUM_PAGES per writer call (databases created
+#   before this have to be converted once, with a blocking full VACUUM: `sorter.py maintain --convert`)
+# run() does all of it; the watcher runs it every INTERVAL seconds in the background (`sorter.py maintain` runs it once, eg: from cron)
+
+HISTORY_DIR = os.environ.get("FILE_SORTER_HISTORY_DIR", os.path.join(os.path.dirname(os.path.abspath(db.DB_FILE)), "history"))
+HOT_MONTHS = int(os.environ.get("FILE_SORTER_HOT_MONTHS", "3"))     # the current month and the 2 before it stay in `files`
+ATTACHED_MONTHS = int(os.environ.get("FILE_SORTER_ATTACHED_MONTHS", "6"))     # sqlite attaches at most 10 databases by default
+INTERVAL = float(os.environ.get("FILE_SORTER_RETENTION_INTERVAL", 6 * 3600))     # seconds between runs in the watcher (0 = never)
+CHUNK_ROWS = 1000     # rows per writer call: ~0.1 s of the writer each, moves get it in between
+VACUUM_PAGES = 2000
+PAUSE = 0.05    # seconds between two chunks/vacuum steps
+
+PARTITION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files_table (
+    id INTEGER PRIMARY KEY,
+    filename TEXT,
+    file_type TEXT,
+    source_path TEXT,
+    destination_path TEXT,
+    moved_at TEXT
+);
+CREATE INDEX IF NOT EXISTS files_type_moved_at ON files_table (file_type, moved_at);
+"""
+
+
+# "YYYY-MM" n months later (or earlier)
+def shift(month, n):
+    year, index = divmod(int(month[:4]) * 12 + int(month[5:7]) - 1 + n, 12)
+    return f"{year:04d}-{index + 1:02d}"
+
+
+def partition_path(month):
+    return os.path.join(HISTORY_DIR, f"files_{month}.db")
+
+
+def export_path(month):
+    return os.path.join(HISTORY_DIR, f"files_{month}.ndjson.gz")
+
+
+# months that have a partition database, oldest first
+def partitions():
+    if not os.path.isdir(HISTORY_DIR):
+        return []
+    return sorted(name[6:13] for name in os.listdir(HISTORY_DIR) if name.startswith("files_") and name.endswith(".db"))
+
+
+# a connection like db.get_connection() plus the attached partitions and the files_history view over them and files_table
+def connect(**options):
+    conn = db.get_connection(uri=True, **options)
+    selects = ["SELECT id, filename, file_type, source_path, destination_path, moved_at FROM main.files_table"]
+    for month in partitions()[-min(ATTACHED_MONTHS, conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)):]:
+        schema = "p_" + month.replace("-", "_")
+        try:
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (f"file:{partition_path(month)}?mode=ro",))
+        except sqlite3.OperationalError:     # exported and removed since partitions() listed it
+            continue
+        selects.append(f"SELECT id, filename, file_type, source_path, destination_path, moved_at FROM {schema}.files_table")
+    conn.execute("CREATE TEMP VIEW files_history AS " + " UNION ALL ".join(selects))
+    return conn
+
+
+# part of a writer call: tells cached /files answers (their ETag carries the generation) that the history changed
+def bump_generation(conn):
+    conn.execute("INSERT INTO meta VALUES ('history_generation', 1) ON CONFLICT DO UPDATE SET value = value + 1")
+
+
+# writer call: moves up to CHUNK_ROWS rows moved in [start, end) (ns) from `files` into the partition; returns how many
+def move_chunk(conn, path, start, end):
+    rows = conn.execute(f"{db.FILES_SELECT} WHERE f.moved_ns >= ? AND f.moved_ns < ? LIMIT ?", (start, end, CHUNK_ROWS)).fetchall()
+    if not rows:
+        return 0
+    conn.execute("ATTACH DATABASE ? AS partition", (path,))
+    try:
+        # two transactions, copy first: in WAL mode a transaction over two database files isn't atomic, so a crash in between leaves the rows
+        # in both places (the next run copies them again, ignored, and deletes them) rather than in neither
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO partition.files_table VALUES (?, ?, ?, ?, ?, ?)", rows)
+        with conn:
+            conn.executemany("DELETE FROM main.files WHERE id = ?", [(row[0],) for row in rows])
+            bump_generation(conn)
+    finally:
+        conn.execute("DETACH DATABASE partition")
+    return len(rows)
+
+
+# month of the oldest row in `files` (None if it is empty)
+def oldest_month():
+    conn = db.get_connection()
+    try:
+        oldest = conn.execute("SELECT MIN(moved_ns) FROM files").fetchone()[0]
+    finally:
+        conn.close()
+    return time.strftime("%Y-%m", time.localtime(oldest // 1_000_000_000)) if oldest is not None else None
+
+
+# ns since the epoch at the start of a month (local time, like the months moved_at is shown in)
+def month_ns(month):
+    return int(datetime(int(month[:4]), int(month[5:7]), 1).timestamp()) * 1_000_000_000
+
+
+def archive_month(month):
+    start, end = month_ns(month), month_ns(shift(month, 1))
+    path = partition_path(month)
+    partition = sqlite3.connect(path)
+    try:
+        partition.executescript(PARTITION_SCHEMA)
+    finally:
+        partition.close()
+    moved = 0
+    while True:
+        count = db.get_writer().call(lambda conn: move_chunk(conn, path, start, end)).result()
+        moved += count
+        if count < CHUNK_ROWS:
+            break
+        time.sleep(PAUSE)
+    metrics.inc("sorter_retention_rows_total", moved, action="archived")
+    logging.info(f"[RETENTION] moved {moved} row(s) from {month} to {path}")
+    return moved
+
+
+# partition -> gzip'ed NDJSON (written next to it under a temporary name first); the .db is only removed once the export is complete
+def export_month(month):
+    target = export_path(month)
+    if os.path.exists(target):      # never overwrite an export (the month got rows again, eg: the clock was set back): left for a human
+        logging.warning(f"[RETENTION] {target} already exists; keeping {partition_path(month)}")
+        return 0
+    conn = sqlite3.connect(partition_path(month))
+    exported = 0
+    try:
+        cursor = conn.execute("SELECT id, filename, file_type, source_path, destination_path, moved_at FROM files_table ORDER BY id")
+        columns = [column[0] for column in cursor.description]
+        with gzip.open(target + ".tmp", "wt", encoding="utf-8") as f:
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                f.writelines(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+                exported += len(rows)
+    finally:
+        conn.close()
+    os.replace(target + ".tmp", target)
+    os.remove(partition_path(month))
+
+    def removed(conn):      # its rows just left /files?history=true
+        with conn:
+            bump_generation(conn)
+    db.get_writer().call(removed).result()
+    metrics.inc("sorter_retention_rows_total", exported, action="exported")
+    logging.info(f"[RETENTION] exported {exported} row(s) from {month} to {target}")
+    return exported
+
+
+# writer call: one step of incremental vacuum; returns the pages freed
+def vacuum_step(conn):
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if free:
+        conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")     # frees one page per step: execute() would only step it once
+    return min(free, VACUUM_PAGES)
+
+
+def vacuum():
+    conn = db.get_connection()
+    try:
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    finally:
+        conn.close()
+    if not incremental:
+        return 0
+    freed = 0
+    while True:
+        pages = db.get_writer().call(vacuum_step).result()
+        if not pages:
+            return freed
+        freed += pages
+        time.sleep(PAUSE)
+
+
+# one-off, blocking: switches a database created before retention existed to incremental auto_vacuum (rewrites the whole file)
+def convert():
+    def full_vacuum(conn):
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    db.get_writer().call(full_vacuum).result()
+
+
+# only one process at a time (eg: the watcher and a cron'ed `sorter.py maintain`); returns None if another one is at it
+def run():
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    lock = os.open(os.path.join(HISTORY_DIR, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        hot_from = shift(date.today().strftime("%Y-%m"), -(HOT_MONTHS - 1))
+        archived = 0
+        month = oldest_month()
+        while month is not None and month < hot_from:
+            archived += archive_month(month)
+            month = oldest_month()      # the next month that has rows (one index lookup), however long the gap
+        exported = sum(export_month(month) for month in partitions() if month < shift(hot_from, -ATTACHED_MONTHS))
+        freed = vacuum()
+        return {"archived": archived, "exported": exported, "vacuumed_pages": freed}
+    finally:
+        os.close(lock)
+
+
+# background thread running run() every INTERVAL seconds until `stopped` is set (only for the sqlite catalog: the log one is never trimmed)
+def start(stopped):
+    def loop():
+        while not stopped.wait(INTERVAL):
+            try:
+                run()
+            except Exception:
+                metrics.inc("sorter_errors_total", stage="retention")
+                logging.exception("[ERROR] retention run failed")
+    if INTERVAL > 0 and catalog.BACKEND == "sqlite":
+        threading.Thread(target=loop, name="retention", daemon=True).start()
+
+
+metrics.counter("sorter_retention_rows_total", "Move history rows archived into monthly partitions / exported to NDJSON")
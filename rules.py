@@ -0,0 +1,395 @@
+import os
+import re
+import time
+import fnmatch
+import logging
+import threading
+import metrics
+
+# Routing rules: decide which folder (and which file_type in the db) a file goes to
+# The rules live in rules.yaml (or any .yaml/.yml/.toml file given by FILE_SORTER_RULES) and are compiled ONCE when loaded into a RuleSet:
+#   1. extension hash buckets  -> dict lookup on the file's extension gives the (few) rules that can possibly apply
+#   2. combined regexes         -> glob/regex rules without an extension condition are grouped by their literal prefix (eg: "invoice_") and each
+#                                  group is merged into a single alternation, so a name costs one dict lookup per prefix length plus one regex
+#                                  match per group that applies, instead of one match per rule
+#   3. predicate checks         -> size/age/MIME conditions are only evaluated for the candidates left over, and the file is only stat()-ed or
+#                                  sniffed if a candidate actually needs it
+# Rules are ordered by priority (higher first, ties keep file order); the first rule whose conditions all match wins, otherwise `default` applies
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RULES_FILE = os.environ.get("FILE_SORTER_RULES", os.path.join(BASE_DIR, "rules.yaml"))
+
+SIZE_UNITS = {"b": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3, "tb": 1024 ** 4}
+AGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# magic numbers used to sniff the real type of a file (only read when a rule has a `mime` condition)
+# (offset, bytes, mime type); checked in order so more specific signatures come first
+MAGIC_NUMBERS = [
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"BM", "image/bmp"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (8, b"WEBP", "image/webp"),
+    (8, b"WAVE", "audio/wav"),
+    (8, b"AVI ", "video/x-msvideo"),
+    (4, b"ftypqt", "video/quicktime"),
+    (4, b"ftypM4A", "audio/mp4"),
+    (4, b"ftyp", "video/mp4"),
+    (0, b"\x1a\x45\xdf\xa3", "video/webm"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"\xff\xfb", "audio/mpeg"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (257, b"ustar", "application/x-tar"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (0, b"Rar!\x1a\x07", "application/vnd.rar"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/x-ole-storage"),     # old .doc/.xls/.ppt
+    (0, b"{\\rtf", "application/rtf"),
+    (0, b"SQLite format 3\x00", "application/vnd.sqlite3"),
+    (0, b"\x7fELF", "application/x-executable"),
+]
+SNIFF_BYTES = 512
+
+
+class RulesError(Exception):
+    pass
+
+
+def sniff_mime(path):
+    try:
+        with open(path, "rb") as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError:
+        return None
+    for offset, magic, mime in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            return mime
+    if not head:
+        return "application/x-empty"
+    if b"\x00" not in head:
+        try:
+            head.decode("utf-8")
+            return "text/plain"
+        except UnicodeDecodeError:
+            pass
+    return "application/octet-stream"
+
+
+def parse_size(value):
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]?b)?\s*", str(value).lower())
+    if not match:
+        raise RulesError(f"invalid size: {value!r}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2) or "b"])
+
+
+def parse_age(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([smhdw]?)\s*", str(value).lower())
+    if not match:
+        raise RulesError(f"invalid age: {value!r}")
+    return float(match.group(1)) * AGE_UNITS[match.group(2) or "s"]
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+# facts about the file being classified; stat() and the MIME sniff are done at most once, and only if some rule asks for them
+class FileFacts:
+    __slots__ = ("path", "_stat", "_mime")
+
+    def __init__(self, path, stat=None):
+        self.path = path
+        self._stat = stat
+        self._mime = None
+
+    @property
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    @property
+    def mime(self):
+        if self._mime is None:
+            self._mime = sniff_mime(self.path) or ""
+        return self._mime
+
+
+class Rule:
+    __slots__ = ("name", "dest", "file_type", "priority", "extensions", "pattern", "prefix", "min_size", "max_size", "min_age", "max_age", "mimes", "has_predicates")
+
+    def __init__(self, spec, index):
+        if "dest" not in spec:
+            raise RulesError(f"rule #{index + 1} has no 'dest'")
+        self.name = spec.get("name", f"rule-{index + 1}")
+        self.dest = spec["dest"]
+        self.file_type = spec.get("file_type", os.path.basename(os.path.normpath(self.dest)))
+        self.priority = int(spec.get("priority", 0))
+        self.extensions = {ext.lower() if ext.startswith(".") else "." + ext.lower() for ext in _as_list(spec.get("extensions"))}
+
+        # globs and regexes are all turned into one regex source string (case-insensitive globs, case-sensitive regexes searched anywhere in the name)
+        globs = _as_list(spec.get("glob"))
+        regexes = _as_list(spec.get("regex"))
+        alternatives = [f"(?i:{fnmatch.translate(glob)})" for glob in globs]
+        alternatives += [f"(?s:.*?(?:{regex}))" for regex in regexes]
+
+        # literal (lowercased) start that every name matching this rule must have, eg: "invoice_" for invoice_*.pdf; used to bucket the
+        # pattern rules so a name is only matched against the rules that could possibly apply. Regexes can match anywhere, so no prefix
+        self.prefix = ""
+        if globs and not regexes:
+            self.prefix = os.path.commonprefix([re.split(r"[*?\[]", glob, maxsplit=1)[0].lower() for glob in globs])
+        self.pattern = "|".join(f"(?:{alt})" for alt in alternatives) or None
+        if self.pattern is not None:
+            try:
+                re.compile(self.pattern)
+            except re.error as e:
+                raise RulesError(f"rule {self.name!r}: invalid glob/regex ({e})")
+
+        self.min_size = parse_size(spec["min_size"]) if "min_size" in spec else None
+        self.max_size = parse_size(spec["max_size"]) if "max_size" in spec else None
+        self.min_age = parse_age(spec["min_age"]) if "min_age" in spec else None
+        self.max_age = parse_age(spec["max_age"]) if "max_age" in spec else None
+        self.mimes = [mime.lower() for mime in _as_list(spec.get("mime"))]
+        self.has_predicates = any(value is not None for value in (self.min_size, self.max_size, self.min_age, self.max_age)) or bool(self.mimes)
+
+    # size/age/MIME conditions (the name-based conditions were already checked by the caller)
+    def check(self, facts, now):
+        if not self.has_predicates:
+            return True
+        if facts is None:    # nothing on disk to look at (eg: classifying a bare name), so these rules can't apply
+            return False
+        try:
+            if self.min_size is not None or self.max_size is not None:
+                size = facts.stat.st_size
+                if self.min_size is not None and size < self.min_size:
+                    return False
+                if self.max_size is not None and size > self.max_size:
+                    return False
+            if self.min_age is not None or self.max_age is not None:
+                age = now - facts.stat.st_mtime
+                if self.min_age is not None and age < self.min_age:
+                    return False
+                if self.max_age is not None and age > self.max_age:
+                    return False
+        except OSError:
+            return False
+        if self.mimes:
+            mime = facts.mime
+            if not any(fnmatch.fnmatchcase(mime, wanted) for wanted in self.mimes):
+                return False
+        return True
+
+
+# one intake folder watched by the daemon: files dropped in `path` are routed with `rules` into folders under `dest_root`
+class Intake:
+    __slots__ = ("name", "path", "dest_root", "rules", "poll")
+
+    def __init__(self, name, path, dest_root, rules, poll=False):
+        self.name = name
+        self.path = path
+        self.dest_root = dest_root
+        self.rules = rules
+        self.poll = poll    # watch with the polling backend (poller.py) instead of native events, eg: for NFS/SMB mounts
+
+    # True if the file (at any depth) belongs to this intake
+    def contains(self, file_path):
+        return file_path.startswith(self.path + os.sep)
+
+    # what the watcher set up at startup depends on (the folder watches); everything else can change on a reload
+    def layout(self):
+        return (self.name, self.path, self.dest_root, self.poll)
+
+
+class RuleSet:
+    def __init__(self, config, source=None):
+        if not isinstance(config, dict):
+            raise RulesError("rules file must contain a mapping with a 'rules' list")
+        self.source = source
+        default = config.get("default") or {"dest": "Others", "file_type": "Unknown"}
+        self.default = Rule(default, -1)
+        self.default.name = "default"
+
+        specs = config.get("rules") or []
+        ordered = sorted(enumerate(specs), key=lambda pair: -int(pair[1].get("priority", 0)))    # stable sort: same priority keeps file order
+        self.rules = [Rule(spec, index) for index, spec in ordered]
+        self.intakes = self._parse_intakes(config, source)
+
+        # 1. extension buckets: ext -> indexes of the rules (in priority order) that list that extension
+        self.by_extension = {}
+        # 2. rules selected by name pattern only, bucketed by their literal prefix; every bucket is one combined alternation regex in which
+        #    each alternative (one rule) is an outer capturing group
+        buckets = {}
+        # rules with neither extensions nor patterns (eg: "anything over 2GB") have to be considered for every file
+        self.catch_all = []
+
+        for index, rule in enumerate(self.rules):
+            if rule.extensions:
+                for ext in rule.extensions:
+                    self.by_extension.setdefault(ext, []).append(index)
+            elif rule.pattern is not None:
+                buckets.setdefault(rule.prefix, []).append(index)
+            else:
+                self.catch_all.append(index)
+
+        self.by_extension = {ext: tuple(indexes) for ext, indexes in self.by_extension.items()}
+        self.compiled_patterns = {index: re.compile(rule.pattern) for index, rule in enumerate(self.rules) if rule.pattern is not None}
+
+        self.by_prefix = {}     # prefix -> (combined regex, {group number: rule index}, rule indexes in priority order)
+        for prefix, indexes in buckets.items():
+            parts = []
+            group_to_rule = {}
+            group = 1
+            for index in indexes:
+                parts.append(f"({self.rules[index].pattern})")
+                group_to_rule[group] = index
+                group += 1 + self.compiled_patterns[index].groups    # skip over any capturing groups inside the user's regex
+            try:
+                combined = re.compile("|".join(parts))
+            except re.error as e:     # each pattern compiled on its own, so together: the same (?P<name>) group used by several rules
+                names = ", ".join(repr(self.rules[index].name) for index in indexes)
+                raise RulesError(f"rules {names} can't be matched together ({e}); give their named groups different names")
+            self.by_prefix[prefix] = (combined, group_to_rule, tuple(indexes))
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.by_prefix})
+
+    # optional `intakes:` list; each intake has a `path`, an optional `dest` root (defaults to the intake folder itself) and optional
+    # `rules`/`default` of its own. An intake's rules are tried before the top-level ones (set `inherit_rules: false` to use only its own)
+    @staticmethod
+    def _parse_intakes(config, source):
+        base = os.path.dirname(os.path.abspath(source)) if source else BASE_DIR     # relative paths are relative to the rules file
+        intakes = []
+        for number, spec in enumerate(config.get("intakes") or [], start=1):
+            if not isinstance(spec, dict) or "path" not in spec:
+                raise RulesError(f"intake #{number} has no 'path'")
+            path = os.path.normpath(os.path.join(base, os.path.expanduser(spec["path"])))
+            dest_root = os.path.normpath(os.path.join(base, os.path.expanduser(spec.get("dest", path))))
+
+            own_rules = spec.get("rules") or []
+            inherited = (config.get("rules") or []) if spec.get("inherit_rules", True) else []
+            intake_rules = RuleSet({"rules": list(own_rules) + list(inherited), "default": spec.get("default") or config.get("default")}, source)
+            intakes.append(Intake(spec.get("name", os.path.basename(path)), path, dest_root, intake_rules, poll=bool(spec.get("poll", False))))
+        return intakes
+
+    # the folders (relative to the intake folder) that files can be routed to
+    def destinations(self):
+        return [rule.dest for rule in self.rules] + [self.default.dest]
+
+    # returns the Rule a file should follow; `path` is only needed for size/age/MIME rules (pass None to classify by name alone)
+    def classify(self, name, path=None, stat=None):
+        facts = FileFacts(path, stat) if path is not None else None
+        now = time.time()
+        best = len(self.rules)     # index of the best (lowest index = highest priority) rule found so far
+
+        # 1. rules keyed on this extension (already in priority order, so the first one that fully matches is the best of the bucket)
+        ext = os.path.splitext(name)[1].lower()
+        for index in self.by_extension.get(ext, ()):
+            rule = self.rules[index]
+            if rule.pattern is not None and not self.compiled_patterns[index].match(name):
+                continue
+            if rule.check(facts, now):
+                best = index
+                break
+
+        # 2. name-pattern rules: one dict lookup per distinct prefix length, then one regex match per bucket found; the alternation tries the
+        #    bucket's rules in priority order, so a hit is the best rule of that bucket
+        if self.by_prefix:
+            lowered = name.lower()
+            for length in self.prefix_lengths:
+                if length > len(lowered):
+                    break
+                bucket = self.by_prefix.get(lowered[:length])
+                if bucket is None or bucket[2][0] >= best:
+                    continue
+                combined, group_to_rule, indexes = bucket
+                match = combined.match(name)
+                if not match:
+                    continue
+                index = group_to_rule[match.lastindex]
+                if index >= best:
+                    continue
+                if self.rules[index].check(facts, now):
+                    best = index
+                else:     # rare: best name match failed its size/age/MIME check, try the bucket's lower-priority rules one by one
+                    for other in indexes:
+                        if index < other < best and self.compiled_patterns[other].match(name) and self.rules[other].check(facts, now):
+                            best = other
+                            break
+
+        # 3. rules with only predicates
+        for index in self.catch_all:
+            if index >= best:
+                break
+            if self.rules[index].check(facts, now):
+                best = index
+                break
+
+        return self.rules[best] if best < len(self.rules) else self.default
+
+
+def load(path=RULES_FILE):
+    with open(path, "rb") as f:
+        raw = f.read()
+    if path.endswith(".toml"):
+        import tomllib
+        config = tomllib.loads(raw.decode("utf-8"))
+    else:
+        import yaml    # PyYAML (already in requirements.txt)
+        config = yaml.safe_load(raw)
+    return RuleSet(config, source=path)
+
+
+_lock = threading.Lock()
+_active = None
+listeners = []      # called with the rules file's path after every successful reload (eg: procpool passing it on to the worker processes)
+
+
+# the rule set currently in use (loaded from RULES_FILE the first time it's needed)
+def current():
+    global _active
+    if _active is None:
+        with _lock:
+            if _active is None:
+                _active = load()
+    return _active
+
+
+# recompiles the rules file and swaps the new RuleSet in; a single reference assignment is atomic, so a move_file() that already fetched the
+# old rule set with current() simply finishes with it and nobody ever waits. If the new file is broken the old rules stay active.
+# The `intakes:` list itself (names, folders, dest roots, poll) can't change this way: the watcher schedules its folder watches once at
+# startup, so a reload that adds, removes or moves an intake is refused as a whole and the sorter has to be restarted for it
+def reload(path=None):
+    global _active
+    path = path or (_active.source if _active is not None else RULES_FILE)
+    try:
+        new_rules = load(path)
+    except Exception:
+        metrics.inc("sorter_rules_reloads_total", result="error")
+        logging.exception(f"[RULES] could not reload {path}, keeping the previous rules")
+        return False
+    if _active is not None and [intake.layout() for intake in new_rules.intakes] != [intake.layout() for intake in _active.intakes]:
+        metrics.inc("sorter_rules_reloads_total", result="error")
+        logging.error(f"[RULES] not reloading {path}: its intakes: changed, which needs a restart; keeping the previous rules")
+        return False
+    _active = new_rules
+    metrics.inc("sorter_rules_reloads_total", result="ok")
+    logging.info(f"[RULES] reloaded {len(new_rules.rules)} rules from {path}")
+    for listener in listeners:
+        try:
+            listener(path)
+        except Exception:
+            logging.exception("[RULES] reload listener failed")
+    return True
+
+
+metrics.counter("sorter_rules_reloads_total", "Routing rules reloads, by result")
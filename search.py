@@ -0,0 +1,73 @@
+import time
+from datetime import datetime, timedelta
+from db import FILES_SELECT, CATEGORY_ID_SQL
+import metrics
+
+# Filename search over the catalog (GET /search?q=): every word of the query must appear somewhere in the file name, case-insensitively
+# ("invoice march" finds "Invoice_2024-March.pdf"). Words of 3+ characters are looked up in the trigram index (files_search, see
+# db.initialize_database()) and the results ranked by bm25 - names where the words stand out come first; shorter words can't use a trigram
+# index, so they only narrow down those results with LIKE. A query made only of short words (or a database without FTS5) scans `files`
+# instead, newest first. file_type and date filters use the (category, moved_ns) / (moved_ns) indexes. Only `files` is searched: rows
+# retention.py moved into the monthly history partitions leave the index with it
+
+MAX_LIMIT = 1000
+
+_indexed = None     # whether files_search exists in this database (checked once)
+
+
+def indexed(conn):
+    global _indexed
+    if _indexed is None:
+        _indexed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_search'").fetchone() is not None
+    return _indexed
+
+
+# "2024-03-01" or "2024-03-01 12:00[:00]" (local time) -> the moved_ns it starts at; a plain date as `until` covers that whole day
+def moved_ns_bound(value, end=False):
+    moment = datetime.fromisoformat(value)     # ValueError for anything else
+    if end and len(value) == 10:
+        moment += timedelta(days=1)
+        return int(moment.timestamp()) * 1_000_000_000 - 1
+    return int(moment.timestamp() * 1_000_000_000)
+
+
+def like_pattern(word):
+    return "%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+# reader call (see db.ReadPool); returns (rows, how) - how is "index" or "scan", for the response and the metrics
+def search(conn, q, file_type=None, since=None, until=None, limit=50):
+    words = q.split()
+    long_words = [word for word in words if len(word) >= 3]
+    short_words = [word for word in words if len(word) < 3]
+
+    where, args = [], []
+    if file_type is not None:
+        where.append(f"f.category = {CATEGORY_ID_SQL}")
+        args.append(file_type)
+    if since is not None:
+        where.append("f.moved_ns >= ?")
+        args.append(moved_ns_bound(since))
+    if until is not None:
+        where.append("f.moved_ns <= ?")
+        args.append(moved_ns_bound(until, end=True))
+
+    start_time = time.perf_counter()
+    if long_words and indexed(conn):
+        how = "index"
+        match = " ".join('"' + word.replace('"', '""') + '"' for word in long_words)     # quoted: every word is a literal, AND-ed together
+        where = ["files_search MATCH ?"] + where + ["f.filename LIKE ? ESCAPE '\\'"] * len(short_words)
+        sql = (f"{FILES_SELECT} JOIN files_search ON files_search.rowid = f.id WHERE {' AND '.join(where)} "
+               f"ORDER BY bm25(files_search), f.id DESC LIMIT ?")
+        args = [match] + args + [like_pattern(word) for word in short_words]
+    else:
+        how = "scan"
+        where += ["f.filename LIKE ? ESCAPE '\\'"] * len(words)
+        sql = f"{FILES_SELECT}{' WHERE ' + ' AND '.join(where) if where else ''} ORDER BY f.id DESC LIMIT ?"
+        args += [like_pattern(word) for word in words]
+    rows = conn.execute(sql, args + [limit]).fetchall()
+    metrics.observe("sorter_search_seconds", time.perf_counter() - start_time, how=how)
+    return rows, how
+
+
+metrics.histogram("sorter_search_seconds", "Time to answer a /search query (how=index: trigram index, how=scan: LIKE over files)")
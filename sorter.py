@@ -0,0 +1,110 @@
+import argparse
+import sys
+
+# Command line entry point for everything the project can do:
+#   python sorter.py watch   -> sort existing files, then keep watching FileSorter (same as `python main.py`; --poll for network mounts)
+#   python sorter.py scan    -> sort whatever is in FileSorter right now and exit
+#   python sorter.py serve   -> run the REST API with uvicorn (--watch runs the watcher in the same process)
+#   python sorter.py maintain -> move old history out of files_table, export old partitions, vacuum (the watcher also does it every few hours)
+#   python sorter.py bench   -> run the benchmark suite (arguments after `bench` are passed to bench.py, eg: sorter.py bench --mode move)
+# Only argparse is imported up front; every subcommand imports what it needs (watchdog, fastapi/uvicorn, ...) when it runs, so `--help`
+# or `scan` never pay for the watcher or the web stack
+
+
+# --processes N: same as FILE_SORTER_PROCESSES=N (read by procpool.py when it is imported, so set before anything imports it)
+def use_processes(args):
+    import os
+    if args.processes is not None:
+        os.environ["FILE_SORTER_PROCESSES"] = str(args.processes)
+
+
+def cmd_watch(args):
+    use_processes(args)
+    import watcher
+    watcher.run(initial_scan=not args.no_initial_scan, poll=args.poll, poll_interval=args.poll_interval, sweep_interval=args.sweep_interval)
+
+
+def cmd_scan(args):
+    use_processes(args)
+    import main
+    count = main.scan()
+    print(f"Sorted {count} file(s) from {', '.join(intake.path for intake in main.intakes())}")
+
+
+def cmd_serve(args):
+    import os
+    import uvicorn
+    if args.watch:
+        os.environ["FILE_SORTER_SERVE_WATCH"] = "1"     # read by api.py (uvicorn imports it by name, possibly in a reloader subprocess)
+    uvicorn.run("api:app", host=args.host, port=args.port, reload=args.reload, workers=args.workers)
+
+
+def cmd_maintain(args):
+    import catalog
+    import main
+    import retention
+    from db import initialize_database
+    if catalog.BACKEND != "sqlite":
+        sys.exit(f"Retention only applies to the sqlite catalog (FILE_SORTER_CATALOG={catalog.BACKEND})")
+    main.setup()
+    initialize_database()
+    if args.convert:
+        retention.convert()
+    print(retention.run() or "Another process is already running maintenance")
+
+
+def cmd_bench(args):
+    import bench
+    bench.cli(args.extra)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="sorter", description="Automatic file sorter")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    watch = commands.add_parser("watch", help="sort existing files and keep watching the folder")
+    watch.add_argument("--no-initial-scan", action="store_true", help="skip sorting the files already in the folder at startup")
+    watch.add_argument("--poll", action="store_true", help="poll the intake folders instead of using native file system events (NFS/SMB mounts)")
+    watch.add_argument("--poll-interval", type=float, default=None, help="seconds between polling passes (default 2)")
+    watch.add_argument("--sweep-interval", type=float, default=300.0,
+                       help="seconds between safety-net rescans of the intake folders for files the watcher missed (0 = off, default 300)")
+    watch.add_argument("--processes", type=int, default=None, metavar="N",
+                       help="classify, hash and move files in N worker processes instead of threads (CPU-bound sorting, eg: FILE_SORTER_HASH=1)")
+    watch.set_defaults(func=cmd_watch)
+
+    scan = commands.add_parser("scan", help="sort the files currently in the folder and exit")
+    scan.add_argument("--processes", type=int, default=None, metavar="N", help="same as for watch")
+    scan.set_defaults(func=cmd_scan)
+
+    serve = commands.add_parser("serve", help="run the REST API")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--reload", action="store_true")
+    serve.add_argument("--workers", type=int, default=None)
+    serve.add_argument("--watch", action="store_true", help="also run the watcher in the server process (its moves then show up on /events)")
+    serve.set_defaults(func=cmd_serve)
+
+    maintain = commands.add_parser("maintain", help="apply the history retention policy once (see retention.py) and exit")
+    maintain.add_argument("--convert", action="store_true",
+                          help="first switch an existing database to incremental vacuum (one full VACUUM, blocks writes while it runs)")
+    maintain.set_defaults(func=cmd_maintain)
+
+    bench = commands.add_parser("bench", help="run the benchmark suite (see bench.py --help)", add_help=False)
+    bench.set_defaults(func=cmd_bench, passthrough=True)
+
+    return parser
+
+
+def cli(argv=None):
+    parser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+    if extra and not getattr(args, "passthrough", False):    # only `bench` forwards unknown arguments (to bench.py's own parser)
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    args.extra = extra
+    if getattr(args, "watch", False) and (args.workers or 1) > 1:
+        parser.error("--watch needs a single server process (one watcher per intake folder)")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import main
+
+# Resumable uploads for very large files (POST /uploads, PUT /uploads/{id}?offset=, GET /uploads/{id}, POST /uploads/{id}/complete):
+# the client declares the file's size, then sends it in chunks at any offsets - in any order, several at a time, again after a dropped
+# connection - and each chunk is written in place with pwrite() into a staging file of the final size. What arrived is kept as a list of
+# byte ranges next to it (fsync'ed first), so GET tells a client exactly what is still missing even after a server restart.
+# The staging folder lives inside the intake folder (hidden, so the watcher ignores it): completing an upload is one rename into the
+# destination folder, however big the file is
+
+UPLOAD_DIR = os.environ.get("FILE_SORTER_UPLOAD_DIR", os.path.join(main.source_dir, ".uploads"))
+EXPIRE_AFTER = 7 * 24 * 3600    # seconds; unfinished uploads untouched for this long are deleted at startup
+STAGED_SUFFIX = ".upload"     # whole files from POST /upload-files waiting to be sorted (see api.save_upload()); left over only by a crash
+
+
+class UploadError(Exception):
+    pass
+
+
+class Upload:
+    def __init__(self, upload_id, filename, size, received, updated_at):
+        self.id = upload_id
+        self.filename = filename
+        self.size = size
+        self.received = received      # sorted, non-overlapping [start, end) ranges already on disk
+        self.updated_at = updated_at
+
+    @property
+    def data_path(self):
+        return os.path.join(UPLOAD_DIR, self.id + ".part")
+
+    # bytes received from the start without a gap: where a client uploading sequentially continues
+    def offset(self):
+        return self.received[0][1] if self.received and self.received[0][0] == 0 else 0
+
+    def missing(self):
+        gaps, position = [], 0
+        for start, end in self.received:
+            if start > position:
+                gaps.append([position, start])
+            position = end
+        if position < self.size:
+            gaps.append([position, self.size])
+        return gaps
+
+    def status(self):
+        return {"upload_id": self.id, "filename": self.filename, "size": self.size, "offset": self.offset(),
+                "received": self.received, "missing": self.missing(), "complete": not self.missing()}
+
+
+def _meta_path(upload_id):
+    return os.path.join(UPLOAD_DIR, upload_id + ".json")
+
+
+def _save(upload):
+    temp_path = _meta_path(upload.id) + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"filename": upload.filename, "size": upload.size, "received": upload.received, "updated_at": upload.updated_at}, f)
+    os.replace(temp_path, _meta_path(upload.id))     # atomic: readers see the old list or the new one, never half a file
+
+
+# the ranges file is shared by every request (and server worker process) uploading chunks of the same file; updates hold an exclusive lock
+class _locked:
+    def __init__(self, upload_id):
+        self.path = os.path.join(UPLOAD_DIR, upload_id + ".lock")
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        os.close(self.fd)     # releases the lock
+
+
+def create(filename, size):
+    filename = os.path.basename(filename or "")
+    if not filename or filename.startswith("."):
+        raise UploadError("filename must be a plain, non-hidden file name")
+    if size < 0:
+        raise UploadError("size must not be negative")
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    upload = Upload(uuid.uuid4().hex, filename, size, [], time.time())
+    with open(upload.data_path, "wb") as f:
+        f.truncate(size)      # the full size up front (sparse): every chunk is written in place at its offset
+    _save(upload)
+    return upload
+
+
+def load(upload_id):
+    if len(upload_id) != 32 or any(c not in "0123456789abcdef" for c in upload_id):    # ids are uuid4 hex: nothing else can name a path
+        return None
+    try:
+        with open(_meta_path(upload_id)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    return Upload(upload_id, meta["filename"], meta["size"], meta["received"], meta["updated_at"])
+
+
+# records that [start, end) is on disk (the caller fsync'ed it) and returns the upload's updated state
+def add_range(upload_id, start, end):
+    with _locked(upload_id):
+        upload = load(upload_id)
+        if upload is None:
+            raise UploadError("upload no longer exists")
+        merged = []
+        for range_start, range_end in sorted(upload.received + [[start, end]]):
+            if merged and range_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], range_end)
+            else:
+                merged.append([range_start, range_end])
+        upload.received = merged
+        upload.updated_at = time.time()
+        _save(upload)
+    return upload
+
+
+def write_at(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+# sorts a completely received upload: the staging file is classified under its real name and renamed straight into its destination folder
+def complete(upload_id):
+    with _locked(upload_id):
+        upload = load(upload_id)
+        if upload is None:
+            raise UploadError("upload no longer exists")
+        if upload.missing():
+            raise UploadError(f"upload is incomplete, missing {upload.missing()[:10]}")
+        # recorded as uploaded into the intake under its name, not as the internal .part file it was assembled in
+        result = main.move_file(upload.data_path, name=upload.filename, outside=True, source=os.path.join(main.source_dir, upload.filename))
+        _remove(upload_id)
+    return result
+
+
+def abort(upload_id):
+    with _locked(upload_id):
+        try:
+            os.remove(os.path.join(UPLOAD_DIR, upload_id + ".part"))
+        except FileNotFoundError:
+            pass
+        _remove(upload_id)
+
+
+def _remove(upload_id):
+    for path in (_meta_path(upload_id), os.path.join(UPLOAD_DIR, upload_id + ".lock")):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# deletes unfinished uploads nobody touched for EXPIRE_AFTER seconds (and staged /upload-files files a crash or failed job left behind)
+def expire():
+    if not os.path.isdir(UPLOAD_DIR):
+        return
+    cutoff = time.time() - EXPIRE_AFTER
+    for entry in os.scandir(UPLOAD_DIR):
+        name, extension = os.path.splitext(entry.name)
+        if extension == ".json":
+            upload = load(name)
+            if upload is not None and upload.updated_at < cutoff:
+                abort(name)
+        elif extension in (".tmp", STAGED_SUFFIX) and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
@@ -0,0 +1,270 @@
+import os
+import sys
+import logging
+import threading
+import time
+from time import sleep
+# Watchdog: a python library that monitors folders for changes
+from watchdog.observers import Observer    # triggers events when files/folders change; Observer continuously watches a folder
+from watchdog.events import FileSystemEventHandler      # class to handle file system events like creation, modification, deletion
+import main
+import metrics
+import profiler
+import retention
+import rules
+from db import initialize_database
+
+# The real-time part of the sorter (kept out of main.py so that importing main, eg: from the API, doesn't pull watchdog in)
+
+
+class MoverHandler(FileSystemEventHandler):      # base class to respond to file system events; its job is to define what should happen when files change in the folder
+
+    def __init__(self, intake=None):     # intake: the intake folder this handler watches (None = work it out from the file path)
+        super().__init__()
+        self.intake = intake
+
+# on_created() is a method of the MoverHandler class that is called automatically by the Watchdog library whenever a new file is created in the monitored folder (source_dir). It receives an event object that contains information about the file creation event, such as the path of the new file and whether it is a directory or a file. This method checks if the event is for a file (not a directory) and then submits the file to be processed by the move_file() function in a separate thread using executor.submit().
+    def on_created(self, event):     # triggered when a new file is created in the monitored folder
+# event eg: FileSorter/photo.jpg
+        if event.is_directory:      # ignore folders (.is_directory is for folders, we only want to process files)
+            return
+
+        file_path = event.src_path   # get path of the created file
+        intake = self.intake or main.intake_for(os.path.abspath(file_path))
+        if intake is None:
+            return      # not in any intake folder (eg: an intake removed from rules.yaml)
+        if any(part.startswith(".") for part in os.path.relpath(file_path, intake.path).split(os.sep)):
+            return      # hidden files and anything inside hidden folders (eg: .uploads, where resumable uploads are assembled)
+        folder = os.path.dirname(os.path.abspath(file_path))
+        if any(folder == os.path.normpath(os.path.join(intake.dest_root, dest)) for dest in intake.rules.destinations()):
+            return      # a sorted file: placing one links it into its destination (see claims.place()), which is a "created" event too
+        print(f"[EVENT DETECTED] New file: {file_path}")
+        metrics.inc("sorter_watcher_events_total", event="created")
+
+        main.submit(file_path, self.intake)   # this sends the file to move_file() to be processed in a separate thread, allowing the main thread to continue monitoring for new events without delay; move_file() will handle moving the file to the correct subfolder and logging the action; using executor.submit() allows us to process multiple files concurrently if they are created in quick succession improving performance
+
+# Processes/works for all files ALREADY present in source_dir at startup/before ie. when script has not yet started running
+    def process_existing_files(self):
+        main.process_existing_files()
+
+
+# watches the routing rules file (with the same Observer as the intake folder) and recompiles it in the background whenever it changes, so
+# editing rules.yaml takes effect without restarting the watcher or re-scanning the folder
+class RulesFileHandler(FileSystemEventHandler):
+    DEBOUNCE = 0.5    # editors often write a file in several steps (truncate + write, or write a temp file and rename it); reload once it settles
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._timer = None
+        self._lock = threading.Lock()
+
+    RELOAD_ON = ("created", "modified", "moved", "closed")    # not "opened"/"closed_no_write": reloading reads the file, which would trigger another reload
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in self.RELOAD_ON:
+            return
+        paths = [event.src_path, getattr(event, "dest_path", "")]     # dest_path: the "save to temp file + rename over" case
+        if self.path not in (os.path.abspath(p) for p in paths if p):
+            return
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.DEBOUNCE, rules.reload, args=(self.path,))
+            self._timer.daemon = True
+            self._timer.start()     # compiled on the timer's own thread; the observer thread and the workers never wait for it
+
+
+# Lost events. When files arrive faster than the watcher reads them the kernel's inotify queue overflows: it drops events and queues one
+# IN_Q_OVERFLOW instead, which watchdog silently discards, so those files would sit in the intake folder until the next restart. The watch
+# itself can also die (the intake folder deleted and re-created, the inotify reader thread crashing) without any sign. The Reconciler is
+# how we recover: run() reports overflows and dead watches to it, and it runs a reconciliation scan (main.reconcile(), rate-limited) of the
+# affected intake on its own thread; it also sweeps every intake every `sweep_interval` seconds as a cheap safety net
+class Reconciler:
+    SWEEP_INTERVAL = 300.0    # seconds; one listing of each intake root per sweep
+    RETRY_REASONS = ("overflow", "restart")    # scans that skipped too-new files run once more after those files are old enough
+
+    def __init__(self, sweep_interval=SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self._pending = {}      # intake name -> (intake, reason); several requests for the same intake before it is scanned collapse into one
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="reconciler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+
+    # intake=None: every intake
+    def request(self, intake=None, reason="sweep"):
+        with self._lock:
+            for each in [intake] if intake is not None else main.intakes():
+                self._pending.setdefault(each.name, (each, reason))
+        self._wake.set()
+
+    def _run(self):
+        next_sweep = time.monotonic() + self.sweep_interval if self.sweep_interval else None
+        while not self._stop.is_set():
+            self._wake.wait(None if next_sweep is None else max(0.0, next_sweep - time.monotonic()))
+            self._wake.clear()
+            if next_sweep is not None and time.monotonic() >= next_sweep:
+                self.request()
+                next_sweep = time.monotonic() + self.sweep_interval
+
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for intake, reason in pending.values():
+                try:
+                    _, recent = main.reconcile(intake, reason, stop=self._stop)
+                except Exception:
+                    metrics.inc("sorter_errors_total", stage="reconcile")
+                    logging.exception(f"[ERROR] reconciliation scan of {intake.path} failed")
+                    continue
+                if recent and reason in self.RETRY_REASONS:
+                    retry = threading.Timer(main.RECONCILE_MIN_AGE, self.request, args=(intake, "retry"))
+                    retry.daemon = True
+                    retry.start()
+
+
+# watchdog reads inotify events in watchdog.observers.inotify_c and skips the overflow marker (watch descriptor -1); wrapping the parser it
+# uses is the only place we can see it. The reading thread is the watch's InotifyBuffer, whose Inotify knows which root it watches
+def report_overflows(reconciler):
+    if not sys.platform.startswith("linux"):
+        return
+    from watchdog.observers.inotify_c import Inotify, InotifyConstants
+    parse = getattr(Inotify._parse_event_buffer, "wrapped", Inotify._parse_event_buffer)
+
+    def parse_and_report(event_buffer):
+        for wd, mask, cookie, name in parse(event_buffer):
+            if wd == -1 and mask & InotifyConstants.IN_Q_OVERFLOW:
+                root = getattr(getattr(threading.current_thread(), "_inotify", None), "path", None)
+                intake = main.intake_for(os.fsdecode(root)) if root else None
+                metrics.inc("sorter_watcher_overflows_total")
+                logging.warning(f"[OVERFLOW] inotify queue overflowed watching {os.fsdecode(root) if root else 'the intakes'}; events were lost, rescanning")
+                reconciler.request(intake, "overflow")
+            yield wd, mask, cookie, name
+
+    parse_and_report.wrapped = parse
+    Inotify._parse_event_buffer = staticmethod(parse_and_report)
+
+
+# a native watch is healthy while its emitter thread and (for inotify) the thread reading the kernel queue are running and the intake folder
+# is still the one we started watching (a deleted and re-created folder is a new inode that no one watches)
+def watch_alive(observer, watch, inode):
+    emitter = next((each for each in observer.emitters if each.watch == watch), None)
+    if emitter is None or not emitter.is_alive():
+        return False
+    reader = getattr(emitter, "_inotify", None)     # watchdog keeps the inotify reader private
+    if reader is not None and not reader.is_alive():
+        return False
+    try:
+        return os.stat(watch.path).st_ino == inode
+    except OSError:
+        return False
+
+
+# poll=True watches every intake with the polling backend (for NFS/SMB mounts, where native events never arrive); intakes can also opt in
+# one by one with `poll: true` in rules.yaml. The rules file itself is always watched natively (it lives next to the code, not on the share)
+# Recovery from lost events (see Reconciler) is always on; sweep_interval=0 turns off the periodic sweep
+def run(initial_scan=True, poll=False, poll_interval=None, sweep_interval=Reconciler.SWEEP_INTERVAL):
+    watching = start(initial_scan, poll, poll_interval, sweep_interval)
+    try:
+        watching.supervise()    # keeps the main thread alive to allow the observer to keep running and monitoring for file changes; without this, the main thread would exit immediately after starting the observer, which would stop the observer from working; it keeps the program running infinitely until the user decides to stop it (like by pressing Ctrl+C)
+    except KeyboardInterrupt:   # if user presses Ctrl+C to stop the program
+        pass
+    watching.stop()
+
+
+# sets everything up and starts watching in background threads; returns the Watching that supervises/stops them (run() above, or the API
+# when it hosts the watcher: `sorter.py serve --watch`)
+def start(initial_scan=True, poll=False, poll_interval=None, sweep_interval=Reconciler.SWEEP_INTERVAL):
+    main.setup()
+    if profiler.ENABLED and threading.current_thread() is threading.main_thread():     # opt-in: FILE_SORTER_PROFILING=1 lets `kill -USR1 <pid>` write a flamegraph/summary of the next 30s (see profiler.py)
+        profiler.install_signal_handler()
+    initialize_database()   # initializes the database and creates the files_table if it doesn't already exist; this ensures that the database is ready to store file information before we start monitoring for file changes
+    main.start_processes()  # worker processes for the moves, if FILE_SORTER_PROCESSES/--processes asks for them (see procpool.py)
+    if initial_scan:
+        main.process_existing_files()  # process files already in the intake folders
+    watching = Watching(Reconciler(sweep_interval))
+    observer = watching.observer
+
+    intakes = main.intakes()
+    for intake in intakes:
+        event_handler = MoverHandler(intake)    # creates an object of MoverHandler class (inherits from Watchdog); it is passed to observer.schedule() so that the observer knows which handler to call when files change
+        target = observer
+        if poll or intake.poll:
+            if len(watching.observers) == 1:
+                from poller import IncrementalPollingObserver, DEFAULT_INTERVAL
+                watching.observers.append(IncrementalPollingObserver(interval=poll_interval or DEFAULT_INTERVAL))
+            target = watching.observers[1]
+        watch = target.schedule(event_handler, intake.path, recursive=True)     # schedules the event handler to monitor the intake folder; recursive=True means it will monitor all subdfolders too (basically telling telling Observer to watch this folder and When something happens, send events to event_handler)
+        if target is observer:
+            watching.native_watches[watch] = (intake, event_handler, os.stat(intake.path).st_ino)
+    rules_file = rules.current().source
+    observer.schedule(RulesFileHandler(rules_file), os.path.dirname(os.path.abspath(rules_file)), recursive=False)    # hot-reload of rules.yaml
+    for each in watching.observers:
+        each.start()       # starts monitoring the thread
+    watching.reconciler.start()
+    retention.start(watching.stopped)      # old move history out of files_table every few hours (see retention.py)
+    print(f"Monitoring {', '.join(intake.path for intake in intakes)} ...")
+    return watching
+
+
+# the running observers (the native one first, then the polling one if any intake needs it), the reconciler and the retention thread
+class Watching:
+    def __init__(self, reconciler):
+        self.observer = Observer()       # ONE observer for every intake folder (they all share the same worker pool and db writer)
+        self.observers = [self.observer]
+        self.reconciler = reconciler
+        self.stopped = threading.Event()     # set by stop(); background threads that only need to know when to quit wait on it
+        self.native_watches = {}     # watch -> (intake, handler, inode of the intake folder) for the health check
+        report_overflows(reconciler)
+
+    # health check of the native watches, once a second until `stopped` is set (forever if None)
+    def supervise(self, stopped=None):
+        while not (stopped.wait(1) if stopped is not None else sleep(1)):     # sleeps for 1 second and then checks again; to not consume too much CPU
+            for watch, (intake, handler, inode) in list(self.native_watches.items()):
+                if not watch_alive(self.observer, watch, inode):
+                    del self.native_watches[watch]
+                    restarted = restart_watch(self.observer, watch, intake, handler)
+                    if restarted is not None:
+                        self.native_watches[restarted[0]] = (intake, handler, restarted[1])
+                        self.reconciler.request(intake, "restart")    # whatever arrived while the watch was down
+                    else:
+                        self.native_watches[watch] = (intake, handler, inode)     # try again on the next pass
+
+    def stop(self):
+        self.stopped.set()
+        self.reconciler.stop()
+        for each in self.observers:
+            each.stop()
+        for each in self.observers:
+            each.join()     # waits for the observer thread to finish completely before exiting the program; without join() the program might exit immediately and leave Watchdog threads hanging
+        main.stop_processes()
+
+
+# replaces a dead native watch with a fresh one; returns (watch, inode of the intake folder) or None if it can't be watched right now
+def restart_watch(observer, watch, intake, handler):
+    metrics.inc("sorter_errors_total", stage="watch")
+    logging.warning(f"[WATCH] lost the watch on {intake.path}; restarting it")
+    try:
+        observer.unschedule(watch)      # stops what is left of the old emitter
+    except KeyError:    # already unscheduled by an earlier attempt
+        pass
+    try:
+        os.makedirs(intake.path, exist_ok=True)     # the intake folder itself was deleted: same as setup() at startup
+        return observer.schedule(handler, intake.path, recursive=True), os.stat(intake.path).st_ino
+    except OSError:
+        logging.exception(f"[ERROR] could not watch {intake.path}")
+        return None
+
+
+metrics.counter("sorter_watcher_overflows_total", "Times the kernel's inotify event queue overflowed and events were lost")
+
+
+if __name__ == "__main__":
+    run()